@@ -3,14 +3,29 @@ import pyodbc
 import configuration
 import logging
 import re
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from abc import ABCMeta
 import sys
 import pymsteams
 import pickle
+import json
 import operator
 import requests
 from lxml.html import fromstring
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+import random
+from contextlib import contextmanager
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+import routing
+
+
+SLABand = namedtuple('SLABand', ['rule_start', 'rule_end'])
 
 
 class Threat(object):
@@ -28,6 +43,7 @@ class CaseSLA(Threat):
     def __init__(self, target_notification_channel: str, case_info: tuple):
         Threat.__init__(self, target_notification_channel)
         self.info_tuple = case_info
+        self.current_SLA_loaded = False
 
 
 class KarmaEvent(Threat):
@@ -35,6 +51,116 @@ class KarmaEvent(Threat):
         Threat.__init__(self, target_notification_channel)
         self.info_tuple = event_info
         self.event_type = event_type
+        # filled by prefetch_karma_threats_page_stats before the card is rendered
+        self.page_metadata = None
+        self.page_stats = None
+        self.page_stats_loaded = False
+
+
+class TTLCache(object):
+    def __init__(self, ttl: float, negative_ttl: float = None, max_size: int = None):
+        # None values are stored as negative entries and expire after negative_ttl
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def lookup(self, key) -> tuple:
+        # returns (hit, value), a hit with None value is a negative entry
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return False, None
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self.entries[key]
+                return False, None
+            self.entries.move_to_end(key)
+            return True, value
+
+    def set(self, key, value):
+        if value is None:
+            expires_at = time.monotonic() + self.negative_ttl
+        else:
+            expires_at = time.monotonic() + self.ttl
+        with self.lock:
+            self.entries[key] = (value, expires_at)
+            self.entries.move_to_end(key)
+            if self.max_size is not None:
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class SFSessionManager(object):
+    def __init__(self, sf_config: configuration.SFConfig):
+        # keeps one authenticated session and its HTTP connection pool alive across cycles
+        self.sf_config = sf_config
+        self.http_session = requests.Session()
+        self.connection = None
+        self.logins = 0
+        self.lock = threading.RLock()
+        self.logging_inst = logging.getLogger()
+        self.login()
+
+    def login(self):
+        with self.lock:
+            self.connection = Salesforce(username=self.sf_config.user, password=self.sf_config.password,
+                                         security_token=self.sf_config.token, session=self.http_session)
+            self.logins += 1
+            return self.connection
+
+    def execute(self, operation, *args, **kwargs):
+        # operation receives a live Salesforce connection, it is replayed once if the session has expired
+        connection = self.connection
+        try:
+            return operation(connection, *args, **kwargs)
+        except exceptions.SalesforceExpiredSession:
+            with self.lock:
+                if self.connection is connection:
+                    self.logging_inst.info('SalesForce session has expired, re-authenticating')
+                    self.login()
+            return operation(self.connection, *args, **kwargs)
+
+    def query(self, query, **kwargs):
+        return self.execute(lambda connection: connection.query(query, **kwargs))
+
+    def query_all(self, query, **kwargs):
+        return self.execute(lambda connection: connection.query_all(query, **kwargs))
+
+    def __getattr__(self, name):
+        # sf_session_manager.CASE.get(...) behaves like Salesforce.CASE.get(...)
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return SFTypeProxy(self, name)
+
+
+class SFTypeProxy(object):
+    def __init__(self, session_manager: SFSessionManager, object_name: str):
+        self.session_manager = session_manager
+        self.object_name = object_name
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            return self.session_manager.execute(
+                lambda connection: getattr(getattr(connection, self.object_name), name)(*args, **kwargs))
+        return call
+
+
+# ids of a User (005) or a Group (00G), the only owners USER.get and GROUP.get can resolve
+SF_OWNER_ID_REGEX = re.compile(r'^(?:005|00G)[a-zA-Z0-9]{12}(?:[a-zA-Z0-9]{3})?$')
+sf_owner_name_cache = TTLCache(ttl=3600, negative_ttl=600, max_size=10000)
 
 
 def sf_get_user_name(sf_connection: Salesforce, user_id: str)->tuple:
@@ -64,50 +190,88 @@ def sf_get_group_name(sf_connection: Salesforce, group_id: str)->tuple:
 
 
 def sf_get_user_or_group(sf_connection: Salesforce, user_or_group_id: str)->tuple:
+    hit, owner_name = sf_owner_name_cache.lookup(user_or_group_id)
+    if hit is True:
+        return (owner_name,)
     try:
         user_name = sf_get_user_name(sf_connection=sf_connection, user_id=user_or_group_id)
+        sf_owner_name_cache.set(user_or_group_id, user_name[0])
         return user_name
     except (exceptions.SalesforceResourceNotFound, SFGetUserNameError):
         try:
             group_name = sf_get_group_name(sf_connection=sf_connection, group_id=user_or_group_id)
+            sf_owner_name_cache.set(user_or_group_id, group_name[0])
             return group_name
-        except (exceptions.SalesforceResourceNotFound, SFGetUserNameError):
+        except exceptions.SalesforceResourceNotFound:
+            sf_owner_name_cache.set(user_or_group_id, None)
             answer = (None,)
             return answer
+        except SFGetUserNameError as error:
+            if error.ErrorMessage == 'SalesforceResourceNotFound':
+                sf_owner_name_cache.set(user_or_group_id, None)
+            answer = (None,)
+            return answer
+
+
+def sf_resolve_owner_names(sf_connection: Salesforce, owner_ids: list, chunk_size: int = 200) -> dict:
+    # resolves all the distinct unseen ids by one User and one Group query (per chunk) and warms sf_owner_name_cache;
+    # values which are not User or Group ids, e.g. queue names, are skipped and not cached
+    logger_inst = logging.getLogger()
+    answer = {}
+    unseen_ids = []
+    for owner_id in dict.fromkeys(owner_id for owner_id in owner_ids if owner_id is not None):
+        hit, owner_name = sf_owner_name_cache.lookup(owner_id)
+        if hit is True:
+            answer[owner_id] = owner_name
+        elif SF_OWNER_ID_REGEX.match(str(owner_id)):
+            unseen_ids.append(owner_id)
+    for chunk_start in range(0, len(unseen_ids), chunk_size):
+        chunk = unseen_ids[chunk_start:chunk_start + chunk_size]
+        id_list = ", ".join("'" + owner_id + "'" for owner_id in chunk)
+        try:
+            found_names = {}
+            found_users = sf_connection.query_all("SELECT Id, Username from User WHERE Id in (" + id_list + ")")
+            for row in found_users['records']:
+                found_names[row['Id'][:15]] = row['Username']
+            found_groups = sf_connection.query_all("SELECT Id, Name from Group WHERE Id in (" + id_list + ")")
+            for row in found_groups['records']:
+                found_names.setdefault(row['Id'][:15], row['Name'])
+        except Exception as error:
+            logger_inst.error('sf_resolve_owner_names: bulk resolution has failed, ids will be resolved one by one\n' + str(error))
+            continue
+        for owner_id in chunk:
+            owner_name = found_names.get(owner_id[:15])
+            sf_owner_name_cache.set(owner_id, owner_name)
+            answer[owner_id] = owner_name
+    return answer
 
 
-def find_target_teams_channel_for_case_sla(current_case_owner_id: str, previous_case_owner_id: str, product: str, teams_channels_inst: configuration.TeamsChannels)-> str:
+def find_target_teams_channel_for_case_sla(current_case_owner_id: str, previous_case_owner_id: str, product: str, teams_channels_inst: configuration.TeamsChannels,
+                                           routing_index: routing.RoutingIndex = None)-> str:
     main_logger = logging.getLogger()
     target_teams_channel = 'undefined'
-    # supported_source_pretty_name = None
     logger_inst = logging.getLogger()
-    sf_queues_inst = configuration.SFQueues()
-    queue_dict = sf_queues_inst.queue_dict
-    if product in sf_queues_inst.monitor_products:
-        main_logger.info('Monitor product found, using extra logic')
-        target_teams_channel = teams_channels_inst.webhooks_dict['Tier 2 - EM:Europe']
-        return target_teams_channel
-    elif product in sf_queues_inst.agent_products:
-        main_logger.info('Agent product found, using extra logic')
-        target_teams_channel = teams_channels_inst.webhooks_dict['Tier 1 - Agents']
+    if routing_index is None:
+        # the callers of the main loop pass the index of the configuration snapshot
+        routing_index = routing.RoutingIndex(configuration.SFQueues(), teams_channels_inst)
+    product_channel = routing_index.get_product_channel(product)
+    if product_channel is not None:
+        main_logger.info(product_channel[0] + ' product found, using extra logic')
+        target_teams_channel = routing_index.webhooks_dict[product_channel[1]]
         return target_teams_channel
-    try:
-        supported_source_pretty_name = [key for key in queue_dict.keys() if (queue_dict[key] == current_case_owner_id)]
-        supported_source_pretty_name = supported_source_pretty_name[0]
-    except IndexError:
-        try:
-            supported_source_pretty_name = previous_case_owner_id
-            pass
-        except KeyError:
-            supported_source_pretty_name = None
-            logger_inst.error('Cannot find a target channel to notify about current_case_owner_id:' + str(current_case_owner_id) + ' and Previous_Owner_Queue__c:' + str(previous_case_owner_id))
+    supported_source_pretty_name = routing_index.get_queue_name(current_case_owner_id)
+    if supported_source_pretty_name is None:
+        # the case has left the queue, using the queue it came from
+        supported_source_pretty_name = previous_case_owner_id
     if supported_source_pretty_name is not None:
         try:
-            target_teams_channel = teams_channels_inst.webhooks_dict[supported_source_pretty_name]
+            target_teams_channel = routing_index.webhooks_dict[supported_source_pretty_name]
         except KeyError:
             logger_inst.error('Cannot find a target channel to notify about ' + str(supported_source_pretty_name))
         except Exception:
             logger_inst.error('Cannot find a target channel to notify about ' + str(supported_source_pretty_name))
+    else:
+        logger_inst.error('Cannot find a target channel to notify about current_case_owner_id:' + str(current_case_owner_id) + ' and Previous_Owner_Queue__c:' + str(previous_case_owner_id))
 
     return target_teams_channel
 
@@ -134,22 +298,44 @@ def find_target_teams_channel_for_karma_event(event_type: str, teams_channels_in
     return target_teams_channel
 
 
+CASE_QUERY_FIELDS = "id, " \
+                    "OwnerId, " \
+                    "Status, " \
+                    "CaseNumber, " \
+                    "Previous_Owner_Queue__c, " \
+                    "CreatedDate, " \
+                    "Subject, " \
+                    "AccountId, " \
+                    "Flag__c, " \
+                    "Product__c, " \
+                    "Time_to_Respond__c, " \
+                    "Manager_of_Case_Owner__c"
+
+
+def make_case_info(row: dict) -> dict:
+    case_info = {
+        'CaseNumber': row['CaseNumber'],
+        'Id': row['Id'],
+        'OwnerId': row['OwnerId'],
+        'Status': row['Status'],
+        'CreatedDate': row['CreatedDate'],
+        'Subject': row['Subject'],
+        'AccountId': row['AccountId'],
+        'Flag__c': row['Flag__c'],
+        'Previous_Owner__c': row['Previous_Owner_Queue__c'],
+        'Manager_of_Case_Owner__c': row['Manager_of_Case_Owner__c'],
+        'Product__c': row['Product__c'],
+        'Time_to_Respond__c': row['Time_to_Respond__c']
+    }
+    return case_info
+
+
 def find_cases_with_potential_sla(sf_connection: Salesforce, max_allowed_sla: int = 60, min_allowed_sla: int = 0) -> list:
     if max_allowed_sla < 0:
         max_allowed_sla = 60
     if min_allowed_sla < 0:
         min_allowed_sla = 0
-    case_check_query = "SELECT id, " \
-                       "OwnerId, " \
-                       "Status, " \
-                       "CaseNumber, " \
-                       "Previous_Owner_Queue__c, " \
-                       "CreatedDate, " \
-                       "Subject, " \
-                       "AccountId, " \
-                       "Flag__c, " \
-                       "Product__c, " \
-                       "Manager_of_Case_Owner__c from case " \
+    case_check_query = "SELECT " + CASE_QUERY_FIELDS + " from case " \
                             "WHERE Time_to_Respond__c <= " + str(max_allowed_sla) + " and " \
                                   "Time_to_Respond__c > " + str(min_allowed_sla) + " and " \
                                   "status in ('New', 'Open') and " \
@@ -157,23 +343,114 @@ def find_cases_with_potential_sla(sf_connection: Salesforce, max_allowed_sla: in
     found_cases = sf_connection.query(query=case_check_query)
     found_cases_list = []
     for row in found_cases['records']:
-        case_info = {
-            'CaseNumber': row['CaseNumber'],
-            'Id': row['Id'],
-            'OwnerId': row['OwnerId'],
-            'Status': row['Status'],
-            'CreatedDate': row['CreatedDate'],
-            'Subject': row['Subject'],
-            'AccountId': row['AccountId'],
-            'Flag__c': row['Flag__c'],
-            'Previous_Owner__c': row['Previous_Owner_Queue__c'],
-            'Manager_of_Case_Owner__c': row['Manager_of_Case_Owner__c'],
-            'Product__c': row['Product__c']
-        }
-        found_cases_list.append(case_info)
+        found_cases_list.append(make_case_info(row))
     return found_cases_list
 
 
+def classify_case_sla_bands(time_to_respond, sla_bands: list) -> list:
+    # returns rule_start of every band the case falls into, bands are (rule_end, rule_start] and may overlap
+    if time_to_respond is None:
+        return []
+    return [band.rule_start for band in sla_bands if band.rule_end < time_to_respond <= band.rule_start]
+
+
+def find_cases_with_potential_sla_by_bands(sf_connection: Salesforce, sla_bands: list) -> dict:
+    # one SOQL round trip for all the bands, rows are sorted into the bands client-side
+    answer = {band.rule_start: [] for band in sla_bands}
+    if len(sla_bands) == 0:
+        return answer
+    max_allowed_sla = max(band.rule_start for band in sla_bands)
+    min_allowed_sla = min(band.rule_end for band in sla_bands)
+    found_cases_list = find_cases_with_potential_sla(sf_connection=sf_connection, max_allowed_sla=max_allowed_sla,
+                                                     min_allowed_sla=min_allowed_sla)
+    for case_info in found_cases_list:
+        for rule_start in classify_case_sla_bands(case_info['Time_to_Respond__c'], sla_bands):
+            answer[rule_start].append(case_info)
+    return answer
+
+
+class IncrementalCaseIngestor(object):
+    def __init__(self, max_allowed_sla: int, full_resync_interval: int = 600, watermark_overlap: int = 60):
+        # The view holds every open unanswered case that can reach max_allowed_sla before the next full resync.
+        # Time_to_Respond__c is a formula and doesn't touch SystemModstamp, so between resyncs it is extrapolated
+        # from the time it was fetched; a full resync reconciles the view with SF.
+        self.max_allowed_sla = max_allowed_sla
+        self.full_resync_interval = full_resync_interval
+        self.watermark_overlap = timedelta(seconds=watermark_overlap)
+        self.view_max_sla = max_allowed_sla + full_resync_interval / 60
+        self.watermark = None
+        self.last_full_resync = None
+        self.candidates = {}
+        self.logging_inst = logging.getLogger()
+
+    def poll(self, sf_connection: Salesforce, sla_bands: list) -> dict:
+        if self.last_full_resync is None or time.monotonic() - self.last_full_resync >= self.full_resync_interval:
+            self.full_resync(sf_connection)
+        else:
+            self.fetch_changes(sf_connection)
+        return self.cases_by_bands(sla_bands)
+
+    def full_resync(self, sf_connection: Salesforce):
+        started_at = datetime.utcnow()
+        case_check_query = "SELECT " + CASE_QUERY_FIELDS + ", SystemModstamp from case " \
+                           "WHERE Time_to_Respond__c <= " + str(self.view_max_sla) + " and " \
+                           "Time_to_Respond__c > 0 and " \
+                           "status in ('New', 'Open') and " \
+                           "FTR_Case_Owner__c = null"
+        found_cases = sf_connection.query_all(case_check_query)
+        fetched_at = time.monotonic()
+        self.candidates = {}
+        for row in found_cases['records']:
+            self.candidates[row['Id']] = (make_case_info(row), fetched_at)
+        self.watermark = started_at
+        self.last_full_resync = fetched_at
+        self.logging_inst.info('IncrementalCaseIngestor: full resync, ' + str(len(self.candidates)) + ' candidate case(s)')
+
+    def fetch_changes(self, sf_connection: Salesforce):
+        since = (self.watermark - self.watermark_overlap).strftime('%Y-%m-%dT%H:%M:%SZ')
+        case_check_query = "SELECT " + CASE_QUERY_FIELDS + ", SystemModstamp, FTR_Case_Owner__c from case " \
+                           "WHERE SystemModstamp >= " + since
+        found_cases = sf_connection.query_all(case_check_query)
+        fetched_at = time.monotonic()
+        for row in found_cases['records']:
+            row_modstamp = datetime.strptime(row['SystemModstamp'][:19], '%Y-%m-%dT%H:%M:%S')
+            if row_modstamp > self.watermark:
+                self.watermark = row_modstamp
+            time_to_respond = row['Time_to_Respond__c']
+            if row['Status'] in ('New', 'Open') and row['FTR_Case_Owner__c'] is None and \
+                    time_to_respond is not None and 0 < time_to_respond <= self.view_max_sla:
+                self.candidates[row['Id']] = (make_case_info(row), fetched_at)
+            else:
+                self.candidates.pop(row['Id'], None)
+        self.logging_inst.debug('IncrementalCaseIngestor: ' + str(len(found_cases['records'])) + ' changed case(s), ' +
+                                str(len(self.candidates)) + ' candidate case(s)')
+
+    def cases_by_bands(self, sla_bands: list) -> dict:
+        answer = {band.rule_start: [] for band in sla_bands}
+        now = time.monotonic()
+        for case_info, fetched_at in self.candidates.values():
+            estimated_sla = case_info['Time_to_Respond__c'] - (now - fetched_at) / 60
+            for rule_start in classify_case_sla_bands(estimated_sla, sla_bands):
+                answer[rule_start].append(case_info)
+        return answer
+
+
+def find_cases_by_ids(sf_connection: Salesforce, case_ids: list, chunk_size: int = 200) -> list:
+    # the current state of the given cases, FTR_Case_Owner__c is added to make_case_info
+    answer = []
+    case_ids = list(dict.fromkeys(case_id for case_id in case_ids if case_id is not None))
+    for chunk_start in range(0, len(case_ids), chunk_size):
+        chunk = case_ids[chunk_start:chunk_start + chunk_size]
+        case_check_query = "SELECT " + CASE_QUERY_FIELDS + ", FTR_Case_Owner__c from case " \
+                           "WHERE Id in (" + ", ".join("'" + str(case_id).replace("'", "\\'") + "'" for case_id in chunk) + ")"
+        found_cases = sf_connection.query_all(case_check_query)
+        for row in found_cases['records']:
+            case_info = make_case_info(row)
+            case_info['FTR_Case_Owner__c'] = row['FTR_Case_Owner__c']
+            answer.append(case_info)
+    return answer
+
+
 def get_current_case_sla(sf_connection: Salesforce, case_id: str):
     try:
         case_sla = sf_connection.CASE.get(case_id)
@@ -187,8 +464,43 @@ def get_current_case_sla(sf_connection: Salesforce, case_id: str):
         raise SFGetUserNameError('OtherException', {'case_id': case_id, 'exception': exc_tuple[1]})
 
 
+def get_current_cases_sla(sf_connection: Salesforce, case_ids: list, chunk_size: int = 200) -> dict:
+    # bulk form of get_current_case_sla, returns {case_id: Time_to_Respond__c} for every case found
+    answer = {}
+    case_ids = list(dict.fromkeys(case_id for case_id in case_ids if case_id is not None))
+    for chunk_start in range(0, len(case_ids), chunk_size):
+        chunk = case_ids[chunk_start:chunk_start + chunk_size]
+        case_sla_query = "SELECT Id, Time_to_Respond__c from case " \
+                         "WHERE Id in (" + ", ".join("'" + str(case_id).replace("'", "\\'") + "'" for case_id in chunk) + ")"
+        found_cases = sf_connection.query_all(case_sla_query)
+        for row in found_cases['records']:
+            answer[row['Id']] = row['Time_to_Respond__c']
+    return answer
+
+
+def refresh_current_sla_of_threats(sf_connection: Salesforce, threats: list):
+    # attaches an actual SLA to all pending CaseSLA threats with a single chunked query
+    case_threats = [threat for threat in threats if isinstance(threat, CaseSLA)]
+    if len(case_threats) == 0:
+        return
+    current_sla_dict = get_current_cases_sla(sf_connection=sf_connection,
+                                             case_ids=[threat.info_tuple[4] for threat in case_threats])
+    for threat in case_threats:
+        if threat.info_tuple[4] in current_sla_dict:
+            threat.current_SLA = current_sla_dict[threat.info_tuple[4]]
+            threat.current_SLA_loaded = True
+
+
+def is_missing_object_error(error: Exception) -> bool:
+    # SQLSTATE 42S02: "Invalid object name", the table does not exist
+    return len(error.args) > 0 and error.args[0] == '42S02'
+
+
 class SQLConnectorELISADB:
-    def __init__(self, sql_config: configuration.SQLConfigELISADB, use_test_instance: bool=False):
+    def __init__(self, sql_config: configuration.SQLConfigELISADB, use_test_instance: bool=False,
+                 durable_acknowledgements: bool=True, acknowledgement_flush_size: int=500,
+                 acknowledgement_flush_interval: float=30, persisted_keys_max_size: int=50000,
+                 persisted_keys_max_age: float=7200):
         if use_test_instance is False:
             self.connection = pyodbc.connect(
                 'DRIVER=' + sql_config.Driver + ';PORT=1433;SERVER=' + sql_config.Server + ';PORT=1443;DATABASE='
@@ -199,34 +511,116 @@ class SQLConnectorELISADB:
                 + sql_config.Database_test + ';UID=' + sql_config.Username + ';PWD=' + sql_config.Password)
         self.cursor = self.connection.cursor()
         self.logging_inst = logging.getLogger()
+        # durable_acknowledgements=True flushes after every send, otherwise delivered IDs are buffered
+        # and flushed by flush_acknowledgements or when a size/time threshold is reached
+        self.durable_acknowledgements = durable_acknowledgements
+        self.acknowledgement_flush_size = acknowledgement_flush_size
+        self.acknowledgement_flush_interval = acknowledgement_flush_interval
+        self.acknowledgement_buffer = {'[dbo].[Cases]': [], '[dbo].[Karma_events]': []}
+        self.acknowledgement_lock = threading.Lock()
+        self.last_acknowledgement_flush = time.monotonic()
+        # acknowledgements come from the dispatcher threads, the connection itself is not thread safe
+        self.lock = threading.RLock()
+        # keys of rows known to be in DB, only unseen rows are sent to the inserts; a forgotten key costs a duplicate
+        # key error on insert as before, so the sets only need to cover the time a row keeps being found by the rules
+        self.persisted_keys_max_age = persisted_keys_max_age
+        self.persisted_case_keys = TTLCache(ttl=persisted_keys_max_age, max_size=persisted_keys_max_size)
+        self.persisted_karma_event_keys = TTLCache(ttl=persisted_keys_max_age, max_size=persisted_keys_max_size)
+        # [dbo].[Karma_watermarks] is created by sql/Karma_watermarks.sql, a connector which finds it missing
+        # keeps the watermarks in memory
+        self.karma_watermarks_available = True
+
+    @staticmethod
+    def make_case_key(case_dict: dict, rule: str) -> tuple:
+        return case_dict['Id'], str(rule)
+
+    @staticmethod
+    def make_karma_event_key(event_dict: dict, event_type: str) -> tuple:
+        return event_type, event_dict['date'], event_dict['xwd_fullname'], event_dict.get('user_name')
+
+    def warm_persisted_keys(self) -> int:
+        # loads the keys of rows inserted during persisted_keys_max_age, returns the number of keys
+        answer = 0
+        with self.lock:
+            # the inserts into [dbo].[Cases] are positional and name no rule column: its name is read from the catalog
+            # at the position they write the rule to
+            self.cursor.execute("SELECT [COLUMN_NAME] FROM INFORMATION_SCHEMA.COLUMNS where [TABLE_SCHEMA] = 'dbo' "
+                                "and [TABLE_NAME] = 'Cases' and [ORDINAL_POSITION] = 16")
+            row = self.cursor.fetchone()
+            if row is None:
+                self.logging_inst.warning('[dbo].[Cases] has no rule column, its rows are not loaded')
+            else:
+                rule_column = '[' + row.COLUMN_NAME.replace(']', ']]') + ']'
+                self.cursor.execute("SELECT [CaseID], " + rule_column + " FROM [dbo].[Cases] "
+                                    "where [CreatedDate] >= DATEADD(SECOND, ?, GETDATE())", -int(self.persisted_keys_max_age))
+                for case_id, rule in self.cursor.fetchall():
+                    self.persisted_case_keys.set((case_id, str(rule)), True)
+                    answer += 1
+            self.cursor.execute("SELECT [Type], [CreatedDate], [xwd_fullname], [user_name] FROM [dbo].[Karma_events] "
+                                "where [CreatedDate] >= DATEADD(SECOND, ?, GETDATE())", -int(self.persisted_keys_max_age))
+            for row in self.cursor.fetchall():
+                self.persisted_karma_event_keys.set((row.Type, row.CreatedDate, row.xwd_fullname, row.user_name), True)
+                answer += 1
+        return answer
 
     def update_dbo_cases_after_notification_sent(self, row_id: str)->bool:
-        try:
-            self.cursor.execute("update [dbo].[Cases] set NotificationSent=1, NotificationSentDate=GETDATE() where ID=?", row_id)
-            self.logging_inst.debug('update of Threat with id ' + str(row_id) + ' was completed')
-            self.connection.commit()
-            return True
-        except Exception as error:
-            self.connection.rollback()
-            self.logging_inst.error(
-                'update of Threat with id ' + str(row_id) + ' has failed due to the following error \n' + str(error))
-            self.logging_inst.error('Query arguments: row_id:' + str(row_id))
-            return False
+        return self.acknowledge_notification_sent(table='[dbo].[Cases]', row_ids=[row_id])
 
     def update_dbo_karma_events_after_notification_sent(self, row_id: str)->bool:
-        try:
-            self.cursor.execute("update [dbo].[Karma_events] set NotificationSent=1, NotificationSentDate=GETDATE() where ID=?", row_id)
-            self.logging_inst.debug('update of Threat with id ' + str(row_id) + ' was completed')
-            self.connection.commit()
-            return True
-        except Exception as error:
-            self.connection.rollback()
-            self.logging_inst.error(
-                'update of Threat with id ' + str(row_id) + ' has failed due to the following error \n' + str(error))
-            self.logging_inst.error('Query arguments: row_id:' + str(row_id))
-            return False
+        return self.acknowledge_notification_sent(table='[dbo].[Karma_events]', row_ids=[row_id])
+
+    def update_dbo_cases_after_digest_sent(self, row_ids: list) -> bool:
+        # all rows of a digest card are acknowledged together
+        return self.acknowledge_notification_sent(table='[dbo].[Cases]', row_ids=row_ids)
+
+    def acknowledge_notification_sent(self, table: str, row_ids: list) -> bool:
+        if self.durable_acknowledgements is True:
+            return self.update_after_notification_sent(table=table, row_ids=row_ids)
+        with self.acknowledgement_lock:
+            self.acknowledgement_buffer[table].extend(row_ids)
+            buffered = sum(len(buffered_row_ids) for buffered_row_ids in self.acknowledgement_buffer.values())
+            flush_is_due = buffered >= self.acknowledgement_flush_size or \
+                time.monotonic() - self.last_acknowledgement_flush >= self.acknowledgement_flush_interval
+        self.logging_inst.debug('acknowledgement of Threat(s) with id(s) ' + ', '.join(str(row_id) for row_id in row_ids) +
+                                ' was buffered')
+        if flush_is_due is True:
+            return self.flush_acknowledgements()
+        return True
+
+    def flush_acknowledgements(self) -> bool:
+        with self.acknowledgement_lock:
+            pending = {table: row_ids for table, row_ids in self.acknowledgement_buffer.items() if len(row_ids) > 0}
+            for table in pending:
+                self.acknowledgement_buffer[table] = []
+            self.last_acknowledgement_flush = time.monotonic()
+        answer = True
+        for table, row_ids in pending.items():
+            if self.update_after_notification_sent(table=table, row_ids=row_ids) is not True:
+                # keeping them for the next flush
+                with self.acknowledgement_lock:
+                    self.acknowledgement_buffer[table] = row_ids + self.acknowledgement_buffer[table]
+                answer = False
+        return answer
 
-    def insert_into_dbo_cases(self, case_dict: dict, rule: str) -> bool:
+    def update_after_notification_sent(self, table: str, row_ids: list, chunk_size: int = 1000) -> bool:
+        with self.lock:
+            try:
+                for chunk_start in range(0, len(row_ids), chunk_size):
+                    chunk = row_ids[chunk_start:chunk_start + chunk_size]
+                    self.cursor.execute("update " + table + " set NotificationSent=1, NotificationSentDate=GETDATE() where ID in ("
+                                        + ",".join("?" * len(chunk)) + ")", *chunk)
+                self.connection.commit()
+                self.logging_inst.debug('update of Threat(s) with id(s) ' + ', '.join(str(row_id) for row_id in row_ids) + ' was completed')
+                return True
+            except Exception as error:
+                self.connection.rollback()
+                self.logging_inst.error(
+                    'update of Threat(s) in ' + table + ' has failed due to the following error \n' + str(error))
+                self.logging_inst.error('Query arguments: row_ids:' + str(row_ids))
+                return False
+
+    @staticmethod
+    def make_case_tuple(case_dict: dict, rule: str) -> tuple:
         CaseId = case_dict['Id']
         CaseNumber = case_dict['CaseNumber']
         OwnerId = case_dict['OwnerId']
@@ -244,16 +638,28 @@ class SQLConnectorELISADB:
         target_notification_channel = case_dict['target_notification_channel']
         case_tuple = (CaseNumber, OwnerId, CaseId, CreatedDate, target_notification_channel, Status, Subject, AccountId, Flag, Previous_Owner,
                       Manager_of_Case_Owner, rule, Product)
+        return case_tuple
+
+    def insert_into_dbo_cases(self, case_dict: dict, rule: str) -> bool:
+        case_key = self.make_case_key(case_dict=case_dict, rule=rule)
+        if self.persisted_case_keys.lookup(case_key)[0] is True:
+            self.logging_inst.debug('----Case ' + str(case_dict['CaseNumber']) + ' is already added, skipping')
+            return True
+        case_tuple = self.make_case_tuple(case_dict=case_dict, rule=rule)
+        CaseNumber = case_tuple[0]
+        Flag = case_tuple[8]
         try:
             self.cursor.execute(
                 "insert into [dbo].[Cases] values(NEWID(),?,?,?,?,GETDATE(), 0, Null, ?,?,?,?,?,?,?,?,?)",
                 *case_tuple[0:13])
             self.connection.commit()
+            self.persisted_case_keys.set(case_key, True)
             self.logging_inst.info(
                 '----insertion of case ' + case_dict['CaseNumber'] + ' was completed')
             return True
         except pyodbc.IntegrityError:
             self.connection.rollback()
+            self.persisted_case_keys.set(case_key, True)
             self.logging_inst.info(
                 '----Case ' + str(CaseNumber) + ' is already added, skipping')
             return True
@@ -264,7 +670,95 @@ class SQLConnectorELISADB:
             self.logging_inst.error('-------------Query arguments:\n' + str(case_dict) + '\nParsed flag: ' + str(Flag))
             return False
 
-    def insert_into_dbo_karma_events(self, event_dict: dict, event_type=str):
+    def insert_into_dbo_cases_batch(self, case_rows: list):
+        # case_rows: [(case_dict, rule), ...], returns (inserted, skipped) or None if the batch has failed
+        if len(case_rows) == 0:
+            return 0, 0
+        case_keys = [self.make_case_key(case_dict=case_dict, rule=rule) for case_dict, rule in case_rows]
+        new_case_rows = [case_row for case_row, case_key in zip(case_rows, case_keys)
+                         if self.persisted_case_keys.lookup(case_key)[0] is not True]
+        known = len(case_rows) - len(new_case_rows)
+        if len(new_case_rows) == 0:
+            self.logging_inst.info('----all ' + str(known) + ' case(s) are already added, skipping')
+            return 0, known
+        rows = [self.make_case_tuple(case_dict=case_dict, rule=rule) for case_dict, rule in new_case_rows]
+        staging_ddl = "CREATE TABLE #Cases_staging (" \
+                      "[RowNumber] int IDENTITY(1,1) PRIMARY KEY" \
+                      ",[CaseNumber] nvarchar(255)" \
+                      ",[OwnerId] nvarchar(255)" \
+                      ",[CaseID] nvarchar(255)" \
+                      ",[CaseCreatedDate] nvarchar(255)" \
+                      ",[TargetNotificationChannel] nvarchar(4000)" \
+                      ",[Status] nvarchar(255)" \
+                      ",[Subject] nvarchar(4000)" \
+                      ",[AccountId] nvarchar(255)" \
+                      ",[Flag] nvarchar(4000)" \
+                      ",[PreviousOwner] nvarchar(255)" \
+                      ",[ManagerCaseOwner] nvarchar(255)" \
+                      ",[Rule] nvarchar(255)" \
+                      ",[Product] nvarchar(255))"
+        staging_insert = "insert into #Cases_staging([CaseNumber], [OwnerId], [CaseID], [CaseCreatedDate], " \
+                         "[TargetNotificationChannel], [Status], [Subject], [AccountId], [Flag], [PreviousOwner], " \
+                         "[ManagerCaseOwner], [Rule], [Product]) values(?,?,?,?,?,?,?,?,?,?,?,?,?)"
+        # the same column order as in insert_into_dbo_cases
+        target_insert = "insert into [dbo].[Cases] select NEWID(), [CaseNumber], [OwnerId], [CaseID], [CaseCreatedDate], " \
+                        "GETDATE(), 0, Null, [TargetNotificationChannel], [Status], [Subject], [AccountId], [Flag], " \
+                        "[PreviousOwner], [ManagerCaseOwner], [Rule], [Product] from #Cases_staging"
+        result = self.insert_through_staging(staging_table='#Cases_staging', staging_ddl=staging_ddl,
+                                             staging_insert=staging_insert, target_insert=target_insert, rows=rows)
+        if result is not None:
+            for case_dict, rule in new_case_rows:
+                self.persisted_case_keys.set(self.make_case_key(case_dict=case_dict, rule=rule), True)
+            result = (result[0], result[1] + known)
+            self.logging_inst.info('----batch insertion of ' + str(len(case_rows)) + ' case(s) was completed, inserted: ' +
+                                   str(result[0]) + ', already added: ' + str(result[1]))
+        return result
+
+    def insert_through_staging(self, staging_table: str, staging_ddl: str, staging_insert: str, target_insert: str, rows: list):
+        # Rows are loaded into a temp table by a plain executemany and moved into the target by one set-based insert
+        # in one transaction. fast_executemany is not used: pyodbc 4.0.18 has no such flag, and newer versions are known
+        # to truncate or mistype parameters bound into #temp tables with it.
+        # If it hits a duplicate key, the same batch falls back to row by row inserts on the server,
+        # skipping duplicates like the IntegrityError handling of the single row inserts does.
+        batch = "SET NOCOUNT ON; " \
+                "DECLARE @inserted int = 0, @row int = 1, @rows int; " \
+                "SELECT @rows = COUNT(*) FROM " + staging_table + "; " \
+                "BEGIN TRY " + \
+                target_insert + "; " \
+                "SET @inserted = @@ROWCOUNT; " \
+                "END TRY " \
+                "BEGIN CATCH " \
+                "IF ERROR_NUMBER() NOT IN (2601, 2627) THROW; " \
+                "WHILE @row <= @rows " \
+                "BEGIN " \
+                "BEGIN TRY " + \
+                target_insert + " where [RowNumber] = @row; " \
+                "SET @inserted = @inserted + @@ROWCOUNT; " \
+                "END TRY " \
+                "BEGIN CATCH " \
+                "IF ERROR_NUMBER() NOT IN (2601, 2627) THROW; " \
+                "END CATCH; " \
+                "SET @row = @row + 1; " \
+                "END; " \
+                "END CATCH; " \
+                "SELECT @inserted as inserted, @rows - @inserted as skipped;"
+        try:
+            self.cursor.execute("IF OBJECT_ID('tempdb.." + staging_table + "') IS NOT NULL DROP TABLE " + staging_table)
+            self.cursor.execute(staging_ddl)
+            self.cursor.executemany(staging_insert, rows)
+            self.cursor.execute(batch)
+            raw = self.cursor.fetchone()
+            self.cursor.execute("DROP TABLE " + staging_table)
+            self.connection.commit()
+            return raw.inserted, raw.skipped
+        except Exception as error:
+            self.connection.rollback()
+            self.logging_inst.error(
+                '----batch insertion through ' + staging_table + ' has failed due to the following error \n' + str(error))
+            return None
+
+    @staticmethod
+    def make_karma_event_tuple(event_dict: dict, event_type: str) -> tuple:
         if 'direction' not in event_dict:
             event_dict['direction'] = None
             event_dict['user_name'] = None
@@ -276,6 +770,14 @@ class SQLConnectorELISADB:
         event_tuple = (event_type, event_dict['date'], event_dict['target_notification_channel'], event_dict['link'], event_dict['xwd_fullname'], event_dict['user_name'], event_dict['direction'], event_dict['full']
                        , event_dict['is_bug'],
                        event_dict['fix_link'], event_dict['fix_link_updated'])
+        return event_tuple
+
+    def insert_into_dbo_karma_events(self, event_dict: dict, event_type=str):
+        event_key = self.make_karma_event_key(event_dict=event_dict, event_type=event_type)
+        if self.persisted_karma_event_keys.lookup(event_key)[0] is True:
+            self.logging_inst.debug('----Event for xwd ' + str(event_dict['xwd_fullname']) + ' is already added, skipping')
+            return True
+        event_tuple = self.make_karma_event_tuple(event_dict=event_dict, event_type=event_type)
         try:
             self.cursor.execute(
                 "insert into [dbo].[Karma_events]([ID]"
@@ -294,12 +796,14 @@ class SQLConnectorELISADB:
                     " ,[fix_link_updated]) values(NEWID(),?,?, ?,?,?,0,NULL,?,?,?,?,?,?)",
                 *event_tuple[0:11])
             self.connection.commit()
+            self.persisted_karma_event_keys.set(event_key, True)
             self.logging_inst.debug('insert_into_dbo_karma_events: ' + str(event_type) + ' ' + str(event_dict))
             self.logging_inst.info(
                 '----Insertion of event with xwd ' + event_dict['xwd_fullname'] + ' was completed')
             return True
         except pyodbc.IntegrityError:
             self.connection.rollback()
+            self.persisted_karma_event_keys.set(event_key, True)
             self.logging_inst.info(
                 '----Event for xwd ' + event_dict['xwd_fullname'] + ' is already added, skipping')
             return True
@@ -310,6 +814,50 @@ class SQLConnectorELISADB:
             self.logging_inst.error('-------------Query arguments:\n' + str(event_dict))
             return False
 
+    def insert_into_dbo_karma_events_batch(self, events: list):
+        # events: [event_dict, ...] as returned by find_all_karma_events, returns (inserted, skipped) or None
+        if len(events) == 0:
+            return 0, 0
+        new_events = [event_dict for event_dict in events
+                      if self.persisted_karma_event_keys.lookup(
+                          self.make_karma_event_key(event_dict=event_dict, event_type=event_dict['type']))[0] is not True]
+        known = len(events) - len(new_events)
+        if len(new_events) == 0:
+            self.logging_inst.info('----all ' + str(known) + ' event(s) are already added, skipping')
+            return 0, known
+        rows = [self.make_karma_event_tuple(event_dict=event_dict, event_type=event_dict['type']) for event_dict in new_events]
+        staging_ddl = "CREATE TABLE #Karma_events_staging (" \
+                      "[RowNumber] int IDENTITY(1,1) PRIMARY KEY" \
+                      ",[Type] nvarchar(255)" \
+                      ",[CreatedDate] datetime2" \
+                      ",[TargetNotificationChannel] nvarchar(4000)" \
+                      ",[link] nvarchar(4000)" \
+                      ",[xwd_fullname] nvarchar(4000)" \
+                      ",[user_name] nvarchar(255)" \
+                      ",[direction] int" \
+                      ",[full] bit" \
+                      ",[is_bug] bit" \
+                      ",[fix_link] nvarchar(4000)" \
+                      ",[fix_link_updated] bit)"
+        staging_insert = "insert into #Karma_events_staging([Type], [CreatedDate], [TargetNotificationChannel], [link], " \
+                         "[xwd_fullname], [user_name], [direction], [full], [is_bug], [fix_link], [fix_link_updated]) " \
+                         "values(?,?,?,?,?,?,?,?,?,?,?)"
+        target_insert = "insert into [dbo].[Karma_events]([ID], [Type], [CreatedDate], [TargetNotificationChannel], [link], " \
+                        "[xwd_fullname], [NotificationSent], [NotificationSentDate], [user_name], [direction], [full], " \
+                        "[is_bug], [fix_link], [fix_link_updated]) " \
+                        "select NEWID(), [Type], [CreatedDate], [TargetNotificationChannel], [link], [xwd_fullname], 0, NULL, " \
+                        "[user_name], [direction], [full], [is_bug], [fix_link], [fix_link_updated] from #Karma_events_staging"
+        result = self.insert_through_staging(staging_table='#Karma_events_staging', staging_ddl=staging_ddl,
+                                             staging_insert=staging_insert, target_insert=target_insert, rows=rows)
+        if result is not None:
+            for event_dict in new_events:
+                self.persisted_karma_event_keys.set(
+                    self.make_karma_event_key(event_dict=event_dict, event_type=event_dict['type']), True)
+            result = (result[0], result[1] + known)
+            self.logging_inst.info('----batch insertion of ' + str(len(events)) + ' event(s) was completed, inserted: ' +
+                                   str(result[0]) + ', already added: ' + str(result[1]))
+        return result
+
     def select_all_unanswered_threats_from_cases(self) -> list:
         query = "SELECT [TargetNotificationChannel]" \
                 ",[ID]"\
@@ -377,12 +925,350 @@ class SQLConnectorELISADB:
         else:
             return None
 
+    def select_covered_reindex_threats(self, threats: list, chunk_size: int = 500):
+        # batch form of select_existence_id_from_karma_events: returns the threats which have a sent event
+        # of the same page and type by the same DATEDIFF(HH) rule, or None if the check has failed;
+        # 4 parameters per threat, chunk_size=500 stays below the 2100 parameters limit of SQL Server
+        answer = set()
+        with self.lock:
+            try:
+                for chunk_start in range(0, len(threats), chunk_size):
+                    chunk = threats[chunk_start:chunk_start + chunk_size]
+                    parameters = []
+                    for row_number, threat in enumerate(chunk):
+                        parameters += [row_number, threat.info_tuple[5], threat.info_tuple[2], threat.info_tuple[3]]
+                    self.cursor.execute(
+                        "SELECT DISTINCT v.[RowNumber] "
+                        "FROM (VALUES " + ",".join(["(?,?,?,?)"] * len(chunk)) + ") "
+                        "AS v([RowNumber], [xwd_fullname], [Type], [CreatedDate]) "
+                        "JOIN [dbo].[Karma_events] k ON k.[xwd_fullname] = v.[xwd_fullname] and k.[Type] = v.[Type] "
+                        "where DATEDIFF(HH, k.[CreatedDate], v.[CreatedDate]) <= 1 and k.[NotificationSent] = 1",
+                        *parameters)
+                    for row in self.cursor.fetchall():
+                        answer.add(chunk[row.RowNumber])
+            except Exception as error:
+                self.connection.rollback()
+                self.logging_inst.error('Batch check of sent reindex events has failed due to the following error \n' +
+                                        str(error))
+                return None
+        return answer
+
+    def select_karma_watermarks(self) -> dict:
+        # returns {event_type: [date] of the newest Karma event seen}
+        if self.karma_watermarks_available is not True:
+            return {}
+        with self.lock:
+            try:
+                self.cursor.execute("SELECT [source], [watermark] FROM [dbo].[Karma_watermarks]")
+                rows = self.cursor.fetchall()
+            except pyodbc.ProgrammingError as error:
+                self.connection.rollback()
+                if is_missing_object_error(error):
+                    self.disable_karma_watermarks(error)
+                else:
+                    self.logging_inst.error('Failed to load Karma watermarks due to the following error \n' + str(error))
+                return {}
+        return {row.source: row.watermark for row in rows}
+
+    def update_karma_watermarks(self, watermarks: dict) -> bool:
+        if self.karma_watermarks_available is not True:
+            return False
+        rows = [(source, watermark) for source, watermark in watermarks.items() if watermark is not None]
+        if len(rows) == 0:
+            return True
+        with self.lock:
+            try:
+                self.cursor.executemany(
+                    "MERGE [dbo].[Karma_watermarks] as target "
+                    "USING (select ? as [source], ? as [watermark]) as source "
+                    "ON target.[source] = source.[source] "
+                    "WHEN MATCHED THEN UPDATE SET [watermark] = source.[watermark], [updated] = GETDATE() "
+                    "WHEN NOT MATCHED THEN INSERT ([source], [watermark], [updated]) "
+                    "VALUES (source.[source], source.[watermark], GETDATE());", rows)
+                self.connection.commit()
+                return True
+            except pyodbc.ProgrammingError as error:
+                self.connection.rollback()
+                if is_missing_object_error(error):
+                    self.disable_karma_watermarks(error)
+                else:
+                    self.logging_inst.error('Failed to store Karma watermarks due to the following error \n' + str(error))
+                return False
+            except Exception as error:
+                self.connection.rollback()
+                self.logging_inst.error('Failed to store Karma watermarks due to the following error \n' + str(error))
+                return False
+
+    def disable_karma_watermarks(self, error):
+        # the watermark table is optional, without it watermarks live in memory and the last hour is read after a restart
+        self.karma_watermarks_available = False
+        self.logging_inst.warning('[dbo].[Karma_watermarks] is not available, Karma watermarks are kept in memory: ' +
+                                  str(error))
+
+
+class WebhookRateLimiter(object):
+    def __init__(self, rate: float = 1.0, burst: int = 4, base_backoff: float = 2, max_backoff: float = 300):
+        # a token bucket per webhook url, refilled by rate tokens per second up to burst;
+        # a throttled url is blocked for Retry-After seconds or for a jittered exponential backoff
+        self.rate = rate
+        self.burst = burst
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.buckets = {}
+        self.blocked_until = {}
+        self.failures = {}
+        self.deferred_sends = {}
+        self.lock = threading.Lock()
+
+    def reserve(self, web_hook_url: str) -> float:
+        # takes a token and returns 0 if a send is allowed now, otherwise returns the seconds to wait
+        with self.lock:
+            now = time.monotonic()
+            blocked_for = self.blocked_until.get(web_hook_url, 0) - now
+            if blocked_for > 0:
+                return blocked_for
+            tokens, updated_at = self.buckets.get(web_hook_url, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+            if tokens >= 1:
+                self.buckets[web_hook_url] = (tokens - 1, now)
+                return 0
+            self.buckets[web_hook_url] = (tokens, now)
+            return (1 - tokens) / self.rate
+
+    def report_success(self, web_hook_url: str):
+        with self.lock:
+            self.failures[web_hook_url] = 0
+
+    def report_throttled(self, web_hook_url: str, retry_after: float = None) -> float:
+        with self.lock:
+            failures = self.failures.get(web_hook_url, 0) + 1
+            self.failures[web_hook_url] = failures
+            if retry_after is not None:
+                delay = retry_after + random.uniform(0, 1)
+            else:
+                delay = min(self.max_backoff, self.base_backoff * 2 ** (failures - 1))
+                delay = random.uniform(delay / 2, delay)
+            now = time.monotonic()
+            self.blocked_until[web_hook_url] = max(self.blocked_until.get(web_hook_url, 0), now + delay)
+            self.buckets[web_hook_url] = (0, now + delay)
+            return delay
+
+    def defer(self, web_hook_url: str):
+        with self.lock:
+            self.deferred_sends[web_hook_url] = self.deferred_sends.get(web_hook_url, 0) + 1
+
+    def take_deferred_sends(self) -> dict:
+        # the sends deferred since the previous call
+        with self.lock:
+            answer = self.deferred_sends
+            self.deferred_sends = {}
+            return answer
 
-def send_notification_to_web_hook(web_hook_url: str, threat: Threat):
+
+class TeamsWebhookTransport(object):
+    def __init__(self, connect_timeout: float = 5, read_timeout: float = 30, pool_connections: int = 2, pool_maxsize: int = 8,
+                 rate_limiter: WebhookRateLimiter = None, max_attempts: int = 3, max_wait: float = 30,
+                 valid_web_hook_urls=frozenset()):
+        # keep-alive connections are pooled per host, all Teams channels share outlook.office.com;
+        # a send waiting longer than max_wait for its channel is deferred, the row stays unanswered for the next cycle;
+        # the POST is not idempotent, so it is retried only if Teams has surely not posted the card:
+        # the connection was not established, or the channel has answered that it throttles;
+        # any other failure is not retried, but the channel is still backed off and the send counted as deferred
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({'Content-Type': 'application/json'})
+        self.timeout = (connect_timeout, read_timeout)
+        self.rate_limiter = rate_limiter if rate_limiter is not None else WebhookRateLimiter()
+        self.max_attempts = max_attempts
+        self.max_wait = max_wait
+        # urls validated at startup are not matched against the regex on every send
+        self.valid_web_hook_urls = frozenset(valid_web_hook_urls)
+        self.logging_inst = logging.getLogger()
+
+    def is_valid_web_hook_url(self, web_hook_url: str) -> bool:
+        return is_valid_web_hook_url(web_hook_url, valid_web_hook_urls=self.valid_web_hook_urls)
+
+    @staticmethod
+    def serialize(payload: dict) -> bytes:
+        return json.dumps(payload).encode('utf-8')
+
+    def send_card(self, card: pymsteams.connectorcard) -> bool:
+        return self.post(web_hook_url=card.hookurl, body=self.serialize(card.payload))
+
+    def post(self, web_hook_url: str, body: bytes) -> bool:
+        for attempt in range(self.max_attempts):
+            if self.wait_for_slot(web_hook_url) is not True:
+                self.rate_limiter.defer(web_hook_url)
+                self.logging_inst.warning('Webhook ' + str(web_hook_url) + ' is throttled, the send is deferred')
+                return False
+            try:
+                response = self.session.post(web_hook_url, data=body, timeout=self.timeout)
+            except requests.exceptions.RequestException as error:
+                if self.is_connect_error(error) is not True:
+                    # e.g. a read timeout: the card may be posted already, the send is reported as failed
+                    self.rate_limiter.report_throttled(web_hook_url)
+                    self.rate_limiter.defer(web_hook_url)
+                    self.logging_inst.error('Webhook ' + str(web_hook_url) + ' has failed after the request was sent: ' +
+                                            str(error))
+                    return False
+                delay = self.rate_limiter.report_throttled(web_hook_url)
+                self.logging_inst.error('Webhook ' + str(web_hook_url) + ' is unreachable, retrying in ' +
+                                        str(round(delay, 1)) + 's: ' + str(error))
+                continue
+            # the legacy connectors answer 200 with the error text when they throttle
+            throttled = response.status_code == 429 or \
+                (response.status_code == requests.codes.ok and 'HTTP error 429' in str(response.text))
+            if response.status_code == requests.codes.ok and throttled is not True:
+                self.rate_limiter.report_success(web_hook_url)
+                return True
+            if throttled is True:
+                delay = self.rate_limiter.report_throttled(web_hook_url, retry_after=self.parse_retry_after(response))
+                self.logging_inst.warning('Webhook ' + str(web_hook_url) + ' has answered ' + str(response.status_code) +
+                                          ', retrying in ' + str(round(delay, 1)) + 's')
+                continue
+            # e.g. a 5xx: the card may be posted already, the channel is backed off for its Retry-After if any
+            delay = self.rate_limiter.report_throttled(web_hook_url, retry_after=self.parse_retry_after(response))
+            self.rate_limiter.defer(web_hook_url)
+            self.logging_inst.error('Webhook ' + str(web_hook_url) + ' has answered ' + str(response.status_code) +
+                                    ', backing off for ' + str(round(delay, 1)) + 's: ' + str(response.text)[:500])
+            return False
+        self.rate_limiter.defer(web_hook_url)
+        self.logging_inst.error('Webhook ' + str(web_hook_url) + ' has failed ' + str(self.max_attempts) +
+                                ' time(s), the send is deferred')
+        return False
+
+    @staticmethod
+    def is_connect_error(error: requests.exceptions.RequestException) -> bool:
+        # True if the request has not reached the server
+        if isinstance(error, requests.exceptions.ConnectTimeout):
+            return True
+        if isinstance(error, requests.exceptions.ConnectionError) and len(error.args) > 0:
+            return isinstance(getattr(error.args[0], 'reason', error.args[0]), NewConnectionError)
+        return False
+
+    def wait_for_slot(self, web_hook_url: str) -> bool:
+        while True:
+            delay = self.rate_limiter.reserve(web_hook_url)
+            if delay <= 0:
+                return True
+            if delay > self.max_wait:
+                return False
+            time.sleep(delay)
+
+    @staticmethod
+    def parse_retry_after(response):
+        retry_after = response.headers.get('Retry-After')
+        if retry_after is None:
+            return None
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass
+        try:
+            retry_at = parsedate_to_datetime(retry_after)
+            return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            return None
+
+
+webhook_transport = TeamsWebhookTransport()
+
+
+Delivery = namedtuple('Delivery', ['channel', 'threat', 'acknowledge'])
+DigestDelivery = namedtuple('DigestDelivery', ['channel', 'threats'])
+
+
+class NotificationDispatcher(object):
+    def __init__(self, max_workers: int = 4, digest_threshold: int = None, digest_max_rows: int = 50):
+        # different channels are notified in parallel, every channel gets its notifications in the enqueue order;
+        # if a channel has more than digest_threshold case notifications, they are collapsed into digest cards
+        self.max_workers = max_workers
+        self.digest_threshold = digest_threshold
+        self.digest_max_rows = digest_max_rows
+        self.channel_queues = OrderedDict()
+        self.logging_inst = logging.getLogger()
+
+    def enqueue(self, channel: str, threat: Threat, acknowledge: bool = True):
+        self.channel_queues.setdefault(channel, []).append(Delivery(channel=channel, threat=threat, acknowledge=acknowledge))
+
+    def pending(self) -> int:
+        return sum(len(deliveries) for deliveries in self.channel_queues.values())
+
+    def take_pending(self) -> list:
+        # hands the queued notifications over to another sender, e.g. the outbox, in the per-channel order
+        channel_queues = self.channel_queues
+        self.channel_queues = OrderedDict()
+        return [delivery for deliveries in channel_queues.values() for delivery in deliveries]
+
+    def dispatch(self, deliver, deliver_digest=None) -> list:
+        # deliver(channel, threat, acknowledge) sends one notification and acknowledges it,
+        # deliver_digest(channel, threats) sends a digest and acknowledges all its threats, both return True on success
+        channel_queues = self.channel_queues
+        self.channel_queues = OrderedDict()
+        if len(channel_queues) == 0:
+            return []
+        answer = []
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(channel_queues)))) as executor:
+            futures = [executor.submit(self.drain_channel, self.plan_channel(deliveries, deliver_digest is not None),
+                                       deliver, deliver_digest)
+                       for deliveries in channel_queues.values()]
+            for future in futures:
+                answer += future.result()
+        return answer
+
+    def plan_channel(self, deliveries: list, use_digest: bool) -> list:
+        case_deliveries = [delivery for delivery in deliveries
+                           if delivery.acknowledge is True and isinstance(delivery.threat, CaseSLA)]
+        if use_digest is not True or self.digest_threshold is None or len(case_deliveries) <= self.digest_threshold:
+            return deliveries
+        self.logging_inst.info('Collapsing ' + str(len(case_deliveries)) + ' case notification(s) for ' +
+                               str(deliveries[0].channel) + ' into a digest')
+        first_case_delivery = case_deliveries[0]
+        case_deliveries = sorted(case_deliveries, key=lambda delivery: (delivery.threat.current_SLA is None,
+                                                                       delivery.threat.current_SLA or 0))
+        digests = []
+        for chunk_start in range(0, len(case_deliveries), self.digest_max_rows):
+            chunk = case_deliveries[chunk_start:chunk_start + self.digest_max_rows]
+            digests.append(DigestDelivery(channel=deliveries[0].channel, threats=[delivery.threat for delivery in chunk]))
+        # digests take the place of the first collapsed notification
+        answer = []
+        for delivery in deliveries:
+            if delivery is first_case_delivery:
+                answer += digests
+            elif not (delivery.acknowledge is True and isinstance(delivery.threat, CaseSLA)):
+                answer.append(delivery)
+        return answer
+
+    def drain_channel(self, deliveries: list, deliver, deliver_digest=None) -> list:
+        answer = []
+        for delivery in deliveries:
+            try:
+                if isinstance(delivery, DigestDelivery):
+                    result = deliver_digest(delivery.channel, delivery.threats)
+                else:
+                    result = deliver(delivery.channel, delivery.threat, delivery.acknowledge)
+            except Exception as error:
+                self.logging_inst.error('Failed to send notification to ' + str(delivery.channel) +
+                                        ' due to the following error \n' + str(error))
+                result = False
+            answer.append((delivery, result))
+        return answer
+
+
+def datediff_hours(start_date: datetime, end_date: datetime) -> int:
+    # DATEDIFF(HH, start_date, end_date) of T-SQL: the number of hour boundaries crossed
+    start_hour = start_date.replace(minute=0, second=0, microsecond=0)
+    end_hour = end_date.replace(minute=0, second=0, microsecond=0)
+    return int((end_hour - start_hour).total_seconds() // 3600)
+
+
+def send_notification_to_web_hook(web_hook_url: str, threat: Threat, xwiki_config: configuration.xWikiConfig = None):
     logger_inst = logging.getLogger()
     logger_inst.debug('web_hook_url: ' + str(web_hook_url))
     logger_inst.debug('threat: ' + str(threat))
-    if uri_validator(web_hook_url) is not True:
+    if webhook_transport.is_valid_web_hook_url(web_hook_url) is not True:
         logger_inst.error('Malformed url: ' + str(web_hook_url))
         return False
     team_connection = pymsteams.connectorcard(web_hook_url)
@@ -391,95 +1277,157 @@ def send_notification_to_web_hook(web_hook_url: str, threat: Threat):
         team_connection.addLinkButton("Open case", "https://veeam.my.salesforce.com/" + str(threat.info_tuple[4]))
         #team_connection.entities(type='mention', id='ba07baab-431b-49ed-add7-cbc3542f5140', name='Test channel')
         team_connection.color('red')
-        result = team_connection.send()
+        result = webhook_transport.send_card(team_connection)
         return result
     if isinstance(threat, KarmaEvent):
-        sql_config_instance_karma_db = configuration.SQLConfigKARMADB()
-        sql_connector_instance_karma_db = SQLConnectorKARMADB(sql_config_instance_karma_db)
-        if threat.event_type == 'delete':
-            text = 'Page was **deleted** from xWiki, former page id: **"' + str(threat.info_tuple[5]) + '"**'
+        # a pooled connection is held only to load the page and its contributors, not during the POST and its waits
+        prefetch_karma_threats_page_stats([threat], xwiki_config=xwiki_config)
+        return send_karma_event_notification(team_connection=team_connection, threat=threat, xwiki_config=xwiki_config)
+    else:
+        logger_inst.error('Threat type' + str(type(threat)) + ' is not supported')
+        return False
+
+
+def send_digest_notification_to_web_hook(web_hook_url: str, threats: list):
+    # one card for many CaseSLA threats of the same channel, the closest to the target response time go first
+    logger_inst = logging.getLogger()
+    logger_inst.debug('web_hook_url: ' + str(web_hook_url))
+    if webhook_transport.is_valid_web_hook_url(web_hook_url) is not True:
+        logger_inst.error('Malformed url: ' + str(web_hook_url))
+        return False
+    team_connection = pymsteams.connectorcard(web_hook_url)
+    threats_sorted = sorted(threats, key=lambda threat: (threat.current_SLA is None, threat.current_SLA or 0))
+    text = '**' + str(len(threats)) + ' cases** are close to the target response time\n\n'
+    for threat in threats_sorted:
+        text += '[**Case 0' + str(threat.info_tuple[2]) + '**](https://veeam.my.salesforce.com/' + str(threat.info_tuple[4]) + \
+                ') has **<' + str(threat.current_SLA) + '** minutes left\n\n'
+    team_connection.text(text)
+    team_connection.color('red')
+    result = webhook_transport.send_card(team_connection)
+    return result
+
+
+def send_karma_event_notification(team_connection: pymsteams.connectorcard, threat: KarmaEvent, sql_connector_instance_karma_db=None,
+                                  xwiki_config: configuration.xWikiConfig = None):
+    logger_inst = logging.getLogger()
+    if threat.event_type == 'delete':
+        text = 'Page was **deleted** from xWiki, former page id: **"' + str(threat.info_tuple[5]) + '"**'
+        team_connection.text(text)
+        team_connection.color('EB984E')
+        result = webhook_transport.send_card(team_connection)
+        return result
+    elif threat.event_type == 'vote':
+        page_name, page_stats = load_karma_threat_page_stats(threat, sql_connector_instance_karma_db)
+        logger_inst.debug('page_name: ' + str(page_name))
+        if page_stats is not None:
+            logger_inst.debug('page_stats: ' + str(page_stats))
+            pretty_name = threat.info_tuple[6][:1].capitalize() + '. ' + threat.info_tuple[6][1:2].capitalize() + threat.info_tuple[6][2:]
+            if threat.info_tuple[7] == 1:
+                text = '**Voted UP** **"' + page_name + '"** by ' + pretty_name + '\n\n'
+            else:
+                text = '**Voted DOWN** **"' + page_name + '"** by ' + pretty_name + '\n\n'
+            text += make_top_contributors_text(page_stats=page_stats, sql_connector_instance_karma_db=sql_connector_instance_karma_db,
+                                               xwiki_config=xwiki_config)
+            team_connection.color('5DADE2')
+            logger_inst.debug('text: ' + str(text))
             team_connection.text(text)
-            team_connection.color('EB984E')
-            result = team_connection.send()
+            team_connection.addLinkButton("Go to the article", str(threat.info_tuple[4]))
+            result = webhook_transport.send_card(team_connection)
             return result
-        elif threat.event_type == 'vote':
-            page_name = sql_connector_instance_karma_db.select_page_title_by_page_id(str(threat.info_tuple[5]))
-            logger_inst.debug('page_name: ' + str(page_name))
-            page_stats = sql_connector_instance_karma_db.select_page_stats(xwd_id=str(threat.info_tuple[5]))
+        else:
+            logger_inst.info(
+                'Page has less than 100 characters, no need to notify about it, page_id:' + str(
+                    threat.info_tuple[5]))
+            return True
+    elif threat.event_type == 'reindex':
+        page_name, page_stats = load_karma_threat_page_stats(threat, sql_connector_instance_karma_db)
+        if page_name is not None:
             if page_stats is not None:
-                logger_inst.debug('page_stats: ' + str(page_stats))
-                pretty_name = threat.info_tuple[6][:1].capitalize() + '. ' + threat.info_tuple[6][1:2].capitalize() + threat.info_tuple[6][2:]
-                if threat.info_tuple[7] == 1:
-                    text = '**Voted UP** **"' + page_name + '"** by ' + pretty_name + '\n\n'
+                if threat.info_tuple[8] is False:
+                    # it's an increment
+                    text = ''
+                    # first, we need to get if it's a bug and we have to use a special logic
+                    if threat.info_tuple[9] is True:
+                        # it's a bug, was fix_link_updated?
+                        text = '**Updated** version of \n**"' + page_name + '"**\nis available on xWiki now\n\n'
+                        if threat.info_tuple[11] is True:
+                            text += 'New fix was added, [click here for download]('+str(threat.info_tuple[10])+')\n\n'
+                            pass
+                    else:
+                        text = '**Updated** version of \n**"' + page_name + '"**\nis available on xWiki now\n\n'
+                    text += make_top_contributors_text(page_stats=page_stats, sql_connector_instance_karma_db=sql_connector_instance_karma_db,
+                                               xwiki_config=xwiki_config)
+                    team_connection.color('F4D03F')
                 else:
-                    text = '**Voted DOWN** **"' + page_name + '"** by ' + pretty_name + '\n\n'
-                text += make_top_contributors_text(page_stats=page_stats)
-                team_connection.color('5DADE2')
-                logger_inst.debug('text: ' + str(text))
+                    # it's a full
+                    if str(threat.info_tuple[5]).startswith('Main'):
+                        xwiki_part = 'Main'
+                    elif str(threat.info_tuple[5]).startswith('Staging'):
+                        xwiki_part = 'Staging'
+                    else:
+                        xwiki_part = 'Administrative'
+                    text = 'A **new** article **"' + page_name + '"** was added into the **' + xwiki_part + '** part of the xWiki!\n\n'
+                    if threat.info_tuple[9] is True:
+                        # it's a bug, was fix_link_added?
+                        if threat.info_tuple[10] is not None:
+                            text += 'Fix is already available, [click here for download](' + str(
+                                threat.info_tuple[10]) + ')\n\n'
+                        else:
+                            text += 'Fix is currently unavailable\n\n'
+                    text += make_top_contributors_text(page_stats=page_stats, sql_connector_instance_karma_db=sql_connector_instance_karma_db,
+                                               xwiki_config=xwiki_config)
+                    team_connection.color('C39BD3')
                 team_connection.text(text)
                 team_connection.addLinkButton("Go to the article", str(threat.info_tuple[4]))
-                result = team_connection.send()
+                result = webhook_transport.send_card(team_connection)
                 return result
             else:
                 logger_inst.info(
-                    'Page has less than 100 characters, no need to notify about it, page_id:' + str(
-                        threat.info_tuple[5]))
+                    'Page has less than 100 characters, no need to notify about it, page_id:' + str(threat.info_tuple[5]))
                 return True
-        elif threat.event_type == 'reindex':
-            page_name = sql_connector_instance_karma_db.select_page_title_by_page_id(str(threat.info_tuple[5]))
-            if page_name is not None:
-                page_stats = sql_connector_instance_karma_db.select_page_stats(xwd_id=str(threat.info_tuple[5]))
-                if page_stats is not None:
-                    if threat.info_tuple[8] is False:
-                        # it's an increment
-                        text = ''
-                        # first, we need to get if it's a bug and we have to use a special logic
-                        if threat.info_tuple[9] is True:
-                            # it's a bug, was fix_link_updated?
-                            text = '**Updated** version of \n**"' + page_name + '"**\nis available on xWiki now\n\n'
-                            if threat.info_tuple[11] is True:
-                                text += 'New fix was added, [click here for download]('+str(threat.info_tuple[10])+')\n\n'
-                                pass
-                        else:
-                            text = '**Updated** version of \n**"' + page_name + '"**\nis available on xWiki now\n\n'
-                        text += make_top_contributors_text(page_stats=page_stats)
-                        team_connection.color('F4D03F')
-                    else:
-                        # it's a full
-                        if str(threat.info_tuple[5]).startswith('Main'):
-                            xwiki_part = 'Main'
-                        elif str(threat.info_tuple[5]).startswith('Staging'):
-                            xwiki_part = 'Staging'
-                        else:
-                            xwiki_part = 'Administrative'
-                        text = 'A **new** article **"' + page_name + '"** was added into the **' + xwiki_part + '** part of the xWiki!\n\n'
-                        if threat.info_tuple[9] is True:
-                            # it's a bug, was fix_link_added?
-                            if threat.info_tuple[10] is not None:
-                                text += 'Fix is already available, [click here for download](' + str(
-                                    threat.info_tuple[10]) + ')\n\n'
-                            else:
-                                text += 'Fix is currently unavailable\n\n'
-                        text += make_top_contributors_text(page_stats=page_stats)
-                        team_connection.color('C39BD3')
-                    team_connection.text(text)
-                    team_connection.addLinkButton("Go to the article", str(threat.info_tuple[4]))
-                    result = team_connection.send()
-                    return result
-                else:
-                    logger_inst.info(
-                        'Page has less than 100 characters, no need to notify about it, page_id:' + str(threat.info_tuple[5]))
-                    return True
-            else:
-                logger_inst.critical('Unable to get page_title by the provided page_id:' + str(threat.info_tuple[5]))
-                logger_inst.critical('Aborting message send operation for '+str(threat.info_tuple[1]))
-                return False
-    else:
-        logger_inst.error('Threat type' + str(type(threat)) + ' is not supported')
-        return False
+        else:
+            logger_inst.critical('Unable to get page_title by the provided page_id:' + str(threat.info_tuple[5]))
+            logger_inst.critical('Aborting message send operation for '+str(threat.info_tuple[1]))
+            return False
 
 
-def make_top_contributors_text(page_stats: dict):
+def load_karma_threat_page_stats(threat: KarmaEvent, sql_connector_instance_karma_db) -> tuple:
+    # returns (page_title, page_stats) of the threat page, one metadata lookup per page instead of separate ones
+    if threat.page_stats_loaded is not True:
+        threat.page_metadata = sql_connector_instance_karma_db.select_page_metadata(page_id=str(threat.info_tuple[5]))
+        threat.page_stats = sql_connector_instance_karma_db.select_page_stats(xwd_id=str(threat.info_tuple[5]),
+                                                                              page_metadata=threat.page_metadata)
+        threat.page_stats_loaded = True
+    if threat.page_metadata is None:
+        return None, None
+    return threat.page_metadata.page_title, threat.page_stats
+
+
+def prefetch_karma_threats_page_stats(threats: list, xwiki_config: configuration.xWikiConfig = None):
+    # loads page stats of all vote/reindex threats of a cycle through one pooled connection
+    # and resolves all their contributors by one resolve_user_pretty_names call
+    karma_threats = [threat for threat in threats if isinstance(threat, KarmaEvent) and
+                     threat.event_type in ('vote', 'reindex')]
+    if len(karma_threats) == 0:
+        return
+    page_stats_by_page = {}
+    with get_karma_db_pool().connector() as sql_connector_instance_karma_db:
+        contributors = []
+        for threat in karma_threats:
+            page_id = str(threat.info_tuple[5])
+            if page_id in page_stats_by_page:
+                threat.page_metadata, threat.page_stats = page_stats_by_page[page_id]
+                threat.page_stats_loaded = True
+                continue
+            load_karma_threat_page_stats(threat, sql_connector_instance_karma_db)
+            page_stats_by_page[page_id] = (threat.page_metadata, threat.page_stats)
+            if threat.page_stats is not None:
+                contributors += [key for key in threat.page_stats['contributors_percents'] if key != 'XWiki.bot']
+        resolve_user_pretty_names(contributors, sql_connector_instance_karma_db=sql_connector_instance_karma_db,
+                                  xwiki_config=xwiki_config)
+
+
+def make_top_contributors_text(page_stats: dict, sql_connector_instance_karma_db=None, xwiki_config: configuration.xWikiConfig = None):
     text = ''
     logger_inst = logging.getLogger()
     logger_inst.debug('Starting make_top_contributors_text generation')
@@ -488,11 +1436,14 @@ def make_top_contributors_text(page_stats: dict):
         return text
     else:
         text += 'Top contributor(s):'
+        pretty_names = resolve_user_pretty_names([key for key in page_stats['contributors_percents'] if key != 'XWiki.bot'],
+                                                 sql_connector_instance_karma_db=sql_connector_instance_karma_db,
+                                                 xwiki_config=xwiki_config)
         for key, value in page_stats['contributors_percents'].items():
             # if key == 'XWiki.bot':
             #    continue
             if key != 'XWiki.bot':
-                pretty_name = find_and_store_a_user_pretty_name(key)
+                pretty_name = pretty_names.get(key)
                 logger_inst.debug('make_top_contributors_text generation works on' + str(key))
                 if pretty_name is None:
                     logger_inst.debug('pretty_name is None, failover to legacy procedure')
@@ -508,30 +1459,47 @@ def make_top_contributors_text(page_stats: dict):
         return text
 
 
-def find_and_store_a_user_pretty_name(user_name: str):
+user_pretty_name_cache = TTLCache(ttl=86400, negative_ttl=3600, max_size=5000)
+xwiki_http_session = requests.Session()
+xwiki_http_session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=8))
+xwiki_http_session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=8))
+
+
+def fetch_user_pretty_name_from_xwiki(user_name: str, xwiki_config: configuration.xWikiConfig = None):
+    # returns None if the profile has no pretty name, raises on connection errors;
+    # the main loop passes xwiki_config of its configuration snapshot, otherwise the configuration is loaded
+    xwiki_config_instance = xwiki_config if xwiki_config is not None else configuration.xWikiConfig()
+    response = xwiki_http_session.get(xwiki_config_instance.URI+'/bin/view/XWiki/'+user_name.replace('XWiki.', ''),
+                                      timeout=30)
+    tree = fromstring(response.content)
+    page_title = tree.findtext('.//title')
+    if page_title is not None:
+        regex = r"Profile of (.*) \("
+        matches = re.search(regex, page_title, re.IGNORECASE)
+        if matches:
+            return matches.group(1)
+    return None
+
+
+def find_and_store_a_user_pretty_name(user_name: str, sql_connector_instance_karma_db=None,
+                                      xwiki_config: configuration.xWikiConfig = None):
     logger_inst = logging.getLogger()
     if not user_name.startswith('XWiki.'):
         logger_inst.debug('find_and_store_a_user_pretty_name for a non-xWiki user, request stopped')
         return None
-    sql_config_instance_karma_db = configuration.SQLConfigKARMADB()
-    sql_connector_instance_karma_db = SQLConnectorKARMADB(sql_config_instance_karma_db)
+    hit, user_pretty_name = user_pretty_name_cache.lookup(user_name)
+    if hit is True:
+        return user_pretty_name
+    if sql_connector_instance_karma_db is None:
+        with get_karma_db_pool().connector() as sql_connector_instance_karma_db:
+            return find_and_store_a_user_pretty_name(user_name, sql_connector_instance_karma_db=sql_connector_instance_karma_db,
+                                                     xwiki_config=xwiki_config)
     user_pretty_name = sql_connector_instance_karma_db.select_user_pretty_name(user_name=user_name)
     if user_pretty_name is None:
         logger_inst.info('find_and_store_a_user_pretty_name: Pretty User wasn\'t added to a DB yet, resolving...')
-        xwiki_config_instance = configuration.xWikiConfig()
         try:
-            response = requests.get(xwiki_config_instance.URI+'/bin/view/XWiki/'+user_name.replace('XWiki.', ''))
-            tree = fromstring(response.content)
-            page_title = tree.findtext('.//title')
-            if page_title is not None:
-                regex = r"Profile of (.*) \("
-                matches = re.search(regex, page_title, re.IGNORECASE)
-                if matches:
-                    user_pretty_name = matches.group(1)
-                else:
-                    user_pretty_name = None
-            else:
-                user_pretty_name = None
+            user_pretty_name = fetch_user_pretty_name_from_xwiki(user_name, xwiki_config=xwiki_config)
+            user_pretty_name_cache.set(user_name, user_pretty_name)
             if user_pretty_name is None:
                 logger_inst.info('find_and_store_a_user_pretty_name: Unable to resolve a username of '+ str(user_name))
                 return None
@@ -546,21 +1514,82 @@ def find_and_store_a_user_pretty_name(user_name: str):
         except Exception as error:
             return None
     else:
+        user_pretty_name_cache.set(user_name, user_pretty_name)
         return user_pretty_name
 
 
+def resolve_user_pretty_names(user_names: list, sql_connector_instance_karma_db=None, max_workers: int = 8,
+                              xwiki_config: configuration.xWikiConfig = None) -> dict:
+    # batch form of find_and_store_a_user_pretty_name: one DB lookup for all the names unknown to the cache,
+    # parallel xWiki requests for the names unknown to the DB, one transaction to store the resolved ones
+    logger_inst = logging.getLogger()
+    answer = {}
+    unknown_user_names = []
+    for user_name in dict.fromkeys(user_names):
+        if not str(user_name).startswith('XWiki.'):
+            answer[user_name] = None
+            continue
+        hit, user_pretty_name = user_pretty_name_cache.lookup(user_name)
+        if hit is True:
+            answer[user_name] = user_pretty_name
+        else:
+            unknown_user_names.append(user_name)
+    if len(unknown_user_names) == 0:
+        return answer
+    if sql_connector_instance_karma_db is None:
+        with get_karma_db_pool().connector() as sql_connector_instance_karma_db:
+            answer.update(resolve_user_pretty_names(unknown_user_names,
+                                                    sql_connector_instance_karma_db=sql_connector_instance_karma_db,
+                                                    max_workers=max_workers, xwiki_config=xwiki_config))
+        return answer
+    stored_pretty_names = sql_connector_instance_karma_db.select_user_pretty_names(user_names=unknown_user_names)
+    unresolved_user_names = []
+    for user_name in unknown_user_names:
+        if stored_pretty_names.get(user_name) is not None:
+            user_pretty_name_cache.set(user_name, stored_pretty_names[user_name])
+            answer[user_name] = stored_pretty_names[user_name]
+        else:
+            unresolved_user_names.append(user_name)
+    if len(unresolved_user_names) == 0:
+        return answer
+    logger_inst.info('resolve_user_pretty_names: resolving ' + str(len(unresolved_user_names)) + ' user(s) by xWiki')
+    resolved_pretty_names = {}
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(unresolved_user_names))) as executor:
+        futures = {executor.submit(fetch_user_pretty_name_from_xwiki, user_name, xwiki_config): user_name for user_name in unresolved_user_names}
+        for future in as_completed(futures):
+            user_name = futures[future]
+            try:
+                user_pretty_name = future.result()
+            except Exception as error:
+                # not cached, the next card will try again
+                logger_inst.info('resolve_user_pretty_names: Unable to reach a profile of ' + str(user_name) + ': ' + str(error))
+                answer[user_name] = None
+                continue
+            user_pretty_name_cache.set(user_name, user_pretty_name)
+            answer[user_name] = user_pretty_name
+            if user_pretty_name is not None:
+                resolved_pretty_names[user_name] = user_pretty_name
+            else:
+                logger_inst.info('resolve_user_pretty_names: Unable to resolve a username of ' + str(user_name))
+    if len(resolved_pretty_names) > 0:
+        if sql_connector_instance_karma_db.update_user_pretty_names(resolved_pretty_names) is not True:
+            logger_inst.error('resolve_user_pretty_names: usernames were resolved, but were not stored in DB')
+    return answer
+
+
+URI_REGEX = re.compile(
+    r'^(?:http|ftp)s?://'  # http:// or https://
+    r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+(?:[A-Z]{2,6}\.?|[A-Z0-9-]{2,}\.?)|'  # domain...
+    r'localhost|'  # localhost...
+    r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}|'  # ...or ipv4
+    r'\[?[A-F0-9]*:[A-F0-9:]+\]?)'  # ...or ipv6
+    r'(?::\d+)?'  # optional port
+    r'(?:/?|[/?]\S+)$', re.IGNORECASE)
+
 
 def uri_validator(ulr)->bool:
-    regex = re.compile(
-        r'^(?:http|ftp)s?://'  # http:// or https://
-        r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+(?:[A-Z]{2,6}\.?|[A-Z0-9-]{2,}\.?)|'  # domain...
-        r'localhost|'  # localhost...
-        r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}|'  # ...or ipv4
-        r'\[?[A-F0-9]*:[A-F0-9:]+\]?)'  # ...or ipv6
-        r'(?::\d+)?'  # optional port
-        r'(?:/?|[/?]\S+)$', re.IGNORECASE)
     try:
-        result = regex.match(ulr)
+        result = URI_REGEX.match(ulr)
         if result is not None:
             return True
         else:
@@ -569,6 +1598,52 @@ def uri_validator(ulr)->bool:
         return False
 
 
+def is_valid_web_hook_url(web_hook_url: str, valid_web_hook_urls=frozenset()) -> bool:
+    # valid_web_hook_urls were validated already, e.g. the webhooks of the configuration snapshot
+    if web_hook_url in valid_web_hook_urls:
+        return True
+    return uri_validator(web_hook_url)
+
+
+class ConfigurationSnapshot(object):
+    def __init__(self, sf_config: configuration.SFConfig, sql_config_elisa_db: configuration.SQLConfigELISADB,
+                 sql_config_karma_db: configuration.SQLConfigKARMADB, sf_queues: configuration.SFQueues,
+                 teams_channels: configuration.TeamsChannels, xwiki_config: configuration.xWikiConfig):
+        # configuration loaded and validated once at startup and passed to the connectors, the routing and the transport;
+        # the immutability is shallow: the attributes cannot be rebound and webhooks_dict is read-only, but sf_config,
+        # sf_queues and the other objects of configuration.py are shared as they are and must not be changed
+        logger_inst = logging.getLogger()
+        self.sf_config = sf_config
+        self.sql_config_elisa_db = sql_config_elisa_db
+        self.sql_config_karma_db = sql_config_karma_db
+        self.sf_queues = sf_queues
+        self.teams_channels = teams_channels
+        self.xwiki_config = xwiki_config
+        self.webhooks_dict = MappingProxyType(dict(teams_channels.webhooks_dict))
+        valid_web_hook_urls = set()
+        for channel_name, web_hook_url in self.webhooks_dict.items():
+            if uri_validator(web_hook_url) is True:
+                valid_web_hook_urls.add(web_hook_url)
+            else:
+                logger_inst.error('Malformed url of ' + str(channel_name) + ' channel: ' + str(web_hook_url))
+        self.valid_web_hook_urls = frozenset(valid_web_hook_urls)
+        self.routing_index = routing.RoutingIndex(sf_queues, self)
+        self.frozen = True
+
+    def __setattr__(self, key, value):
+        if getattr(self, 'frozen', False) is True:
+            raise AttributeError('ConfigurationSnapshot is immutable')
+        object.__setattr__(self, key, value)
+
+    @classmethod
+    def load(cls, use_test_channels: bool = False):
+        return cls(sf_config=configuration.SFConfig(), sql_config_elisa_db=configuration.SQLConfigELISADB(),
+                   sql_config_karma_db=configuration.SQLConfigKARMADB(), sf_queues=configuration.SFQueues(),
+                   teams_channels=configuration.TeamsChannels(use_test_channels=use_test_channels),
+                   xwiki_config=configuration.xWikiConfig())
+
+
+
 class BotExpectedError(Exception):
     def __init__(self, message, arguments):
         """Base class for more or less expected exceptions"""
@@ -588,6 +1663,142 @@ class SFGetUserNameError(BotExpectedError):
     pass
 
 
+class SQLConnectorPoolTimeout(BotExpectedError):
+    """Raised when no pooled connection became available before checkout_timeout"""
+    pass
+
+
+class SQLConnectorPool(object):
+    def __init__(self, connector_factory, max_size: int = 4, checkout_timeout: float = 30, health_check_interval: float = 60):
+        # connector_factory returns a new connector with .connection and .cursor, e.g. SQLConnectorKARMADB
+        self.connector_factory = connector_factory
+        self.max_size = max_size
+        self.checkout_timeout = checkout_timeout
+        self.health_check_interval = health_check_interval
+        self.idle_connectors = []
+        self.size = 0
+        self.condition = threading.Condition()
+        self.metrics = {'checkouts': 0, 'waits': 0, 'wait_seconds': 0.0, 'reconnects': 0, 'connections_created': 0,
+                        'connections_discarded': 0}
+        self.logging_inst = logging.getLogger()
+
+    @contextmanager
+    def connector(self):
+        connector = self.checkout()
+        try:
+            yield connector
+        except pyodbc.Error:
+            # the state of the connection is unknown, it's not returned to the pool
+            self.checkin(connector, discard=True)
+            raise
+        except BaseException:
+            self.checkin(connector)
+            raise
+        else:
+            self.checkin(connector)
+
+    def checkout(self):
+        with self.condition:
+            self.metrics['checkouts'] += 1
+            if len(self.idle_connectors) == 0 and self.size >= self.max_size:
+                self.metrics['waits'] += 1
+                wait_started = time.monotonic()
+                while len(self.idle_connectors) == 0 and self.size >= self.max_size:
+                    remaining = self.checkout_timeout - (time.monotonic() - wait_started)
+                    if remaining <= 0:
+                        raise SQLConnectorPoolTimeout('No connection became available in time',
+                                                      {'max_size': self.max_size, 'checkout_timeout': self.checkout_timeout})
+                    self.condition.wait(remaining)
+                self.metrics['wait_seconds'] += time.monotonic() - wait_started
+            if len(self.idle_connectors) > 0:
+                connector, returned_at = self.idle_connectors.pop()
+            else:
+                connector, returned_at = None, None
+                self.size += 1
+        if connector is None:
+            return self.create_connector()
+        if time.monotonic() - returned_at >= self.health_check_interval and self.is_healthy(connector) is not True:
+            self.logging_inst.info('SQLConnectorPool: idle connection has failed a health check, reconnecting')
+            self.close_connector(connector)
+            with self.condition:
+                self.metrics['reconnects'] += 1
+            return self.create_connector()
+        return connector
+
+    def checkin(self, connector, discard: bool = False):
+        if discard is True:
+            self.close_connector(connector)
+        with self.condition:
+            if discard is True:
+                self.size -= 1
+                self.metrics['connections_discarded'] += 1
+            else:
+                self.idle_connectors.append((connector, time.monotonic()))
+            self.condition.notify()
+
+    def create_connector(self):
+        # the slot is already reserved by checkout
+        try:
+            connector = self.connector_factory()
+        except BaseException:
+            with self.condition:
+                self.size -= 1
+                self.condition.notify()
+            raise
+        with self.condition:
+            self.metrics['connections_created'] += 1
+        return connector
+
+    @staticmethod
+    def is_healthy(connector) -> bool:
+        try:
+            connector.cursor.execute('SELECT 1')
+            connector.cursor.fetchone()
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def close_connector(connector):
+        try:
+            connector.connection.close()
+        except Exception:
+            pass
+
+    def get_metrics(self) -> dict:
+        with self.condition:
+            metrics = dict(self.metrics)
+            metrics['size'] = self.size
+            metrics['idle'] = len(self.idle_connectors)
+        return metrics
+
+
+CONTRIBUTION_SUMMARY_SIZE = 10
+PageMetadata = namedtuple('PageMetadata', ['id', 'page_title', 'characters_total'])
+page_contributors_cache = TTLCache(ttl=86400, max_size=2000)
+
+karma_db_pool = None
+karma_db_pool_lock = threading.Lock()
+
+
+def configure_karma_db_pool(sql_config_karma_db: configuration.SQLConfigKARMADB, max_size: int = 4) -> SQLConnectorPool:
+    # called by main at startup with the configuration snapshot, before the pool is used
+    global karma_db_pool
+    with karma_db_pool_lock:
+        karma_db_pool = SQLConnectorPool(connector_factory=lambda: SQLConnectorKARMADB(sql_config_karma_db), max_size=max_size)
+        return karma_db_pool
+
+
+def get_karma_db_pool() -> SQLConnectorPool:
+    # process-wide pool of KarmaDB connections used by the notification layer
+    global karma_db_pool
+    with karma_db_pool_lock:
+        if karma_db_pool is None:
+            sql_config_karma_db = configuration.SQLConfigKARMADB()
+            karma_db_pool = SQLConnectorPool(connector_factory=lambda: SQLConnectorKARMADB(sql_config_karma_db))
+        return karma_db_pool
+
+
 class SQLConnectorKARMADB:
     def __init__(self, sql_config: configuration.SQLConfigKARMADB):
         self.connection = pyodbc.connect(
@@ -595,6 +1806,9 @@ class SQLConnectorKARMADB:
             + sql_config.Database + ';UID=' + sql_config.Username + ';PWD=' + sql_config.Password)
         self.cursor = self.connection.cursor()
         self.logging_inst = logging.getLogger()
+        # [dbo].[KnownPages_contribution_summary] is created by sql/KnownPages_contribution_summary.sql,
+        # a connector which finds it missing uses the pickled datagram only
+        self.contribution_summary_available = True
 
     def select_page_title_by_page_id(self, page_id: str) -> str:
         self.cursor.execute(
@@ -614,6 +1828,32 @@ class SQLConnectorKARMADB:
             return raw.user_pretty_name
         return None
 
+    def select_user_pretty_names(self, user_names: list, chunk_size: int = 1000) -> dict:
+        answer = {}
+        for chunk_start in range(0, len(user_names), chunk_size):
+            chunk = user_names[chunk_start:chunk_start + chunk_size]
+            self.cursor.execute(
+                "SELECT [user_name], [user_pretty_name] FROM [dbo].[KnownPages_Users] where [user_name] in ("
+                + ",".join("?" * len(chunk)) + ")", *chunk)
+            for raw in self.cursor.fetchall():
+                answer[raw.user_name] = raw.user_pretty_name
+        self.logging_inst.debug('select_user_pretty_names: ' + str(answer))
+        return answer
+
+    def update_user_pretty_names(self, user_pretty_names: dict) -> bool:
+        try:
+            self.cursor.executemany(
+                "update [dbo].[KnownPages_Users] set [user_pretty_name] = ? where [user_name] = ?",
+                [(user_pretty_name, user_name) for user_name, user_pretty_name in user_pretty_names.items()])
+            self.logging_inst.debug('update of USERS ' + ', '.join(user_pretty_names) + ' was completed')
+            self.connection.commit()
+            return True
+        except Exception as error:
+            self.connection.rollback()
+            self.logging_inst.error(
+                'update of USERS ' + ', '.join(user_pretty_names) + ' has failed due to the following error \n' + str(error))
+            return False
+
     def update_user_pretty_name(self, user_name: str, user_pretty_name: str) -> bool:
         try:
             self.cursor.execute(
@@ -628,12 +1868,23 @@ class SQLConnectorKARMADB:
             self.logging_inst.error('Query arguments: user_pretty_name:' + str(user_pretty_name))
             return False
 
-    def select_page_stats(self, xwd_id):
-        result = self.select_id_characters_total_from_dbo_knownpages(platform='xwiki', page_id=xwd_id)
-        if result is None:
+    def select_page_metadata(self, page_id: str):
+        # [id], [page_title] and [characters_total] of an xWiki page by one query
+        self.cursor.execute(
+            "select [id], [page_title], [characters_total] FROM [dbo].[KnownPages] where [page_id] = ? and [platform] LIKE LOWER(?)",
+            'xwiki:' + page_id, 'xwiki')
+        raw = self.cursor.fetchone()
+        if raw:
+            return PageMetadata(id=raw.id, page_title=raw.page_title, characters_total=raw.characters_total)
+        return None
+
+    def select_page_stats(self, xwd_id, page_metadata=None):
+        if page_metadata is None:
+            page_metadata = self.select_page_metadata(page_id=xwd_id)
+        if page_metadata is None:
             return None
-        page_sql_id = result[0]
-        total_characters_of_requested_page = int(result[1])
+        page_sql_id = page_metadata.id
+        total_characters_of_requested_page = int(page_metadata.characters_total)
         if total_characters_of_requested_page < 100:
             return None
         self.cursor.execute(
@@ -649,19 +1900,93 @@ class SQLConnectorKARMADB:
                 'page_karma_score': karma_score,
                 'contributors_percents': {}
             }
-            total_contribute_of_requested_page = pickle.loads(
-                self.select_datagram_contribution_from_dbo_knownpages_contribution(
-                    sql_id=page_sql_id))
-            for Contributor, Value in total_contribute_of_requested_page.items():
-                percent = round(((Value / total_characters_of_requested_page) * 100), 2)
-                answer['contributors_percents'].update({Contributor: percent})
-            contributors_percents_sorted = sorted(answer['contributors_percents'].items(),
-                                                  key=operator.itemgetter(1), reverse=True)
-            answer['contributors_percents'] = {}
-            for unit in contributors_percents_sorted[:3]:
-                answer['contributors_percents'].update({unit[0]: unit[1]})
+            # contribution only changes together with the page, so [characters_total] versions the cache entry
+            cache_key = (page_sql_id, total_characters_of_requested_page)
+            hit, contributors_percents = page_contributors_cache.lookup(cache_key)
+            if hit is not True:
+                contributors_percents = self.select_top_contributors_percents(
+                    page_sql_id=page_sql_id, total_characters_of_requested_page=total_characters_of_requested_page)
+                page_contributors_cache.set(cache_key, contributors_percents)
+            answer['contributors_percents'] = dict(contributors_percents)
             return answer
 
+    def select_top_contributors_percents(self, page_sql_id, total_characters_of_requested_page: int, top: int = 3) -> dict:
+        top_contributors = self.select_contribution_summary(page_sql_id=page_sql_id,
+                                                            characters_total=total_characters_of_requested_page)
+        if top_contributors is None:
+            # no summary for this version of the page yet, migrating it from the pickled datagram
+            top_contributors = self.make_contribution_summary(page_sql_id=page_sql_id)
+            self.update_contribution_summary(page_sql_id=page_sql_id, characters_total=total_characters_of_requested_page,
+                                             top_contributors=top_contributors)
+        contributors_percents = {}
+        for Contributor, Value in top_contributors[:top]:
+            percent = round(((Value / total_characters_of_requested_page) * 100), 2)
+            contributors_percents.update({Contributor: percent})
+        return contributors_percents
+
+    def make_contribution_summary(self, page_sql_id) -> list:
+        # [[contributor, characters], ...] of the CONTRIBUTION_SUMMARY_SIZE biggest contributors
+        total_contribute_of_requested_page = pickle.loads(
+            self.select_datagram_contribution_from_dbo_knownpages_contribution(
+                sql_id=page_sql_id))
+        contributors_sorted = sorted(total_contribute_of_requested_page.items(),
+                                     key=operator.itemgetter(1), reverse=True)
+        return [[contributor, value] for contributor, value in contributors_sorted[:CONTRIBUTION_SUMMARY_SIZE]]
+
+    def select_contribution_summary(self, page_sql_id, characters_total: int):
+        if self.contribution_summary_available is not True:
+            return None
+        try:
+            self.cursor.execute(
+                "select [characters_total], [summary] from [dbo].[KnownPages_contribution_summary] where [KnownPageID] = ?",
+                page_sql_id)
+            raw = self.cursor.fetchone()
+        except pyodbc.ProgrammingError as error:
+            self.connection.rollback()
+            if is_missing_object_error(error):
+                self.disable_contribution_summary(error)
+            else:
+                self.logging_inst.error('select of contribution summary of page ' + str(page_sql_id) +
+                                        ' has failed due to the following error \n' + str(error))
+            return None
+        if raw and int(raw.characters_total) == characters_total:
+            return json.loads(raw.summary)
+        return None
+
+    def update_contribution_summary(self, page_sql_id, characters_total: int, top_contributors: list) -> bool:
+        if self.contribution_summary_available is not True:
+            return False
+        try:
+            self.cursor.execute(
+                "MERGE [dbo].[KnownPages_contribution_summary] as target "
+                "USING (select ? as [KnownPageID], ? as [characters_total], ? as [summary]) as source "
+                "ON target.[KnownPageID] = source.[KnownPageID] "
+                "WHEN MATCHED THEN UPDATE SET [characters_total] = source.[characters_total], [summary] = source.[summary] "
+                "WHEN NOT MATCHED THEN INSERT ([KnownPageID], [characters_total], [summary]) "
+                "VALUES (source.[KnownPageID], source.[characters_total], source.[summary]);",
+                page_sql_id, characters_total, json.dumps(top_contributors))
+            self.connection.commit()
+            return True
+        except pyodbc.ProgrammingError as error:
+            self.connection.rollback()
+            if is_missing_object_error(error):
+                self.disable_contribution_summary(error)
+                return False
+            self.logging_inst.error(
+                'update of contribution summary of page ' + str(page_sql_id) + ' has failed due to the following error \n' + str(error))
+            return False
+        except Exception as error:
+            self.connection.rollback()
+            self.logging_inst.error(
+                'update of contribution summary of page ' + str(page_sql_id) + ' has failed due to the following error \n' + str(error))
+            return False
+
+    def disable_contribution_summary(self, error):
+        # the summary table is optional, without it the pickled datagram is used every time
+        self.contribution_summary_available = False
+        self.logging_inst.warning('[dbo].[KnownPages_contribution_summary] is not available, '
+                                  'using [dbo].[KnownPages_contribution] only: ' + str(error))
+
     def select_id_characters_total_from_dbo_knownpages(self, platform: str, page_id: str=None, page_title: str=None):
         logger = logging.getLogger()
         if page_id is not None:
@@ -707,14 +2032,15 @@ class SQLConnectorKARMADB:
             return raw.datagram_contribution
         return None
 
-    def find_karma_events(self, event_type: str) -> list:
+    def find_karma_events(self, event_type: str, watermark: datetime = None, watermark_overlap: int = 120) -> list:
+        date_filter, date_parameters = make_karma_event_date_filter(watermark, watermark_overlap)
         if event_type == 'delete':
             query = "SELECT [ID]"\
                     ",[date]"\
                     ",[link]"\
                     ",[xwd_fullname] "\
                     "FROM [dbo].[WebRequests_delete_page_by_XWD_FULLNAME] "\
-                    "where [committed]=1 and [result]=1 and datediff(HH,[date],GETDATE()) <= 1"
+                    "where [committed]=1 and [result]=1 and " + date_filter
         elif event_type == 'reindex':
             query = "SELECT [ID]"\
                     ",[date]"\
@@ -724,8 +2050,8 @@ class SQLConnectorKARMADB:
                     ",[is_bug]" \
                     ",[fix_link]" \
                     ",[fix_link_updated]" \
-                    "FROM [dbo].[WebRequests_reindex_page_by_XWD_FULLNAME]"\
-                    "where [committed]=1 and [result]=1 and datediff(HH,[date],GETDATE()) <= 1 "
+                    "FROM [dbo].[WebRequests_reindex_page_by_XWD_FULLNAME] "\
+                    "where [committed]=1 and [result]=1 and " + date_filter
         elif event_type == 'vote':
             query = "SELECT [ID]"\
                     ",[date]"\
@@ -734,33 +2060,116 @@ class SQLConnectorKARMADB:
                     ",[user_name] " \
                     ",[direction] " \
                     "FROM [dbo].[WebRequests_vote_for_page_as_user] "\
-                    "where [committed]=1 and [result]=1 and datediff(HH,[date],GETDATE()) <= 1"
+                    "where [committed]=1 and [result]=1 and " + date_filter
         else:
             self.logging_inst.critical('Requested Event type is not supported: ' + event_type)
             return []
-        self.cursor.execute(query)
+        self.cursor.execute(query, *date_parameters)
         rows = self.cursor.fetchall()
         found_events_list = []
         if rows:
             for row in rows:
-                    event_info = {
-                        'type': event_type,
-                        'Id': row.ID,
-                        'date': row.date,
-                        'link': row.link,
-                        'xwd_fullname': row.xwd_fullname,
-                    }
-                    if event_type == 'vote':
-                        event_info.update({'direction': row.direction})
-                        event_info.update({'user_name': row.user_name})
-                    if event_type == 'reindex':
-                        event_info.update({'full':row.full})
-                        event_info.update({'is_bug': row.is_bug})
-                        event_info.update({'fix_link': row.fix_link})
-                        event_info.update({'fix_link_updated': row.fix_link_updated})
-                    found_events_list.append(event_info)
+                found_events_list.append(make_karma_event_info(row, event_type))
         return found_events_list
 
+    def find_all_karma_events(self, event_types: tuple = ('delete', 'reindex', 'vote'), watermarks: dict = None,
+                              watermark_overlap: int = 120) -> list:
+        # the same as find_karma_events for every type, but in one UNION ALL round trip;
+        # watermarks: {event_type: [date] of the newest event seen}
+        if watermarks is None:
+            watermarks = {}
+        selects = []
+        parameters = []
+        for event_type in event_types:
+            if event_type not in KARMA_EVENT_SOURCES:
+                self.logging_inst.critical('Requested Event type is not supported: ' + event_type)
+                continue
+            date_filter, date_parameters = make_karma_event_date_filter(watermarks.get(event_type), watermark_overlap)
+            columns = []
+            for column, null_value in KARMA_EVENT_OPTIONAL_COLUMNS.items():
+                if column in KARMA_EVENT_TYPE_COLUMNS.get(event_type, ()):
+                    columns.append("[" + column + "]")
+                else:
+                    columns.append(null_value + " as [" + column + "]")
+            selects.append("SELECT '" + event_type + "' as [type]"
+                           ",[ID]"
+                           ",[date]"
+                           ",[link]"
+                           ",[xwd_fullname]"
+                           "," + ",".join(columns) + " "
+                           "FROM " + KARMA_EVENT_SOURCES[event_type] + " "
+                           "where [committed]=1 and [result]=1 and " + date_filter)
+            parameters += date_parameters
+        if len(selects) == 0:
+            return []
+        self.cursor.execute(" UNION ALL ".join(selects), *parameters)
+        rows = self.cursor.fetchall()
+        found_events_list = []
+        if rows:
+            for row in rows:
+                found_events_list.append(make_karma_event_info(row, row.type))
+        return found_events_list
+
+
+KARMA_EVENT_SOURCES = OrderedDict([
+    ('delete', '[dbo].[WebRequests_delete_page_by_XWD_FULLNAME]'),
+    ('reindex', '[dbo].[WebRequests_reindex_page_by_XWD_FULLNAME]'),
+    ('vote', '[dbo].[WebRequests_vote_for_page_as_user]'),
+])
+KARMA_EVENT_TYPE_COLUMNS = {
+    'reindex': ('full', 'is_bug', 'fix_link', 'fix_link_updated'),
+    'vote': ('user_name', 'direction'),
+}
+# typed NULLs, an untyped NULL is an int and would turn the bit columns of the other branches into int
+KARMA_EVENT_OPTIONAL_COLUMNS = OrderedDict([
+    ('full', 'CAST(NULL AS bit)'),
+    ('is_bug', 'CAST(NULL AS bit)'),
+    ('fix_link', 'CAST(NULL AS nvarchar(4000))'),
+    ('fix_link_updated', 'CAST(NULL AS bit)'),
+    ('user_name', 'CAST(NULL AS nvarchar(255))'),
+    ('direction', 'CAST(NULL AS int)'),
+])
+
+
+def make_karma_event_date_filter(watermark: datetime = None, watermark_overlap: int = 120):
+    # a range on [date] can seek an index, datediff(HH,[date],GETDATE()) can't;
+    # the short overlap catches rows committed shortly after newer rows were read,
+    # repeated rows are skipped before the insert by the persisted keys of SQLConnectorELISADB
+    # the same rows as datediff(HH,[date],GETDATE()) <= 1: from the start of the previous hour
+    previous_hour_filter = "[date] >= DATEADD(HH, DATEDIFF(HH, 0, GETDATE()) - 1, 0)"
+    if watermark is None:
+        return previous_hour_filter, []
+    # never older than the previous hour, so an old watermark after a downtime doesn't bring stale events back
+    return "[date] >= DATEADD(SECOND, ?, ?) and " + previous_hour_filter, [-watermark_overlap, watermark]
+
+
+def advance_karma_watermarks(watermarks: dict, events: list) -> dict:
+    # the newest [date] per event type, a type without new events keeps its watermark
+    answer = dict(watermarks)
+    for event_dict in events:
+        if answer.get(event_dict['type']) is None or event_dict['date'] > answer[event_dict['type']]:
+            answer[event_dict['type']] = event_dict['date']
+    return answer
+
+
+def make_karma_event_info(row, event_type: str) -> dict:
+    event_info = {
+        'type': event_type,
+        'Id': row.ID,
+        'date': row.date,
+        'link': row.link,
+        'xwd_fullname': row.xwd_fullname,
+    }
+    if event_type == 'vote':
+        event_info.update({'direction': row.direction})
+        event_info.update({'user_name': row.user_name})
+    if event_type == 'reindex':
+        event_info.update({'full': row.full})
+        event_info.update({'is_bug': row.is_bug})
+        event_info.update({'fix_link': row.fix_link})
+        event_info.update({'fix_link_updated': row.fix_link_updated})
+    return event_info
+
 '''
 
 def entities(self, type, id, name):
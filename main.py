@@ -1,18 +1,54 @@
 from simple_salesforce import Salesforce
 import simple_salesforce
-from configuration import SFConfig, SFQueues, SQLConfigELISADB, TeamsChannels, Integration, SQLConfigKARMADB
+from configuration import SFConfig, TeamsChannels, Integration
 import logging
 from datetime import datetime
 import custom_logic
 import sys
-import time as other_time
+import scheduler
+import streaming
 from logger_init import logging_config
+import outbox
+import routing
 
 ##############################################################
 #                        variables                           #
 MaxAllowedSLA = 61
 Query_Delay = 60
+#   per job schedule, seconds: jobs run on a fixed grid, a run overlapping the previous one is skipped
+A_RULES_INTERVAL = Query_Delay
+A_RULES_JITTER = 5
+KARMA_EVENT_RULES_INTERVAL = Query_Delay
+KARMA_EVENT_RULES_JITTER = 5
+BACKLOG_RULE_TEAMS = []  # teams checked by the backlog rule, the job is disabled while empty
+BACKLOG_RULE_INTERVAL = 600
+BACKLOG_RULE_JITTER = 30
+DISPATCH_INTERVAL = Query_Delay
+DISPATCH_JITTER = 0
+# dispatch is planned after the ingestion of the same cycle has started: it must exceed the jitter of the ingestion jobs,
+# then a long ingestion run delays the dispatch of its cycle instead of being dispatched one cycle later
+DISPATCH_FIRST_RUN_DELAY = 15
 #
+USE_INCREMENTAL_CASE_POLLING = False  # fetch only cases changed since the last SystemModstamp seen
+CASE_FULL_RESYNC_INTERVAL = 600  # seconds between full resyncs in the incremental mode
+KARMA_WATERMARK_OVERLAP = 120  # seconds before the newest Karma event seen which are read again
+USE_CASE_STREAMING = False  # insert cases changed in SF through the Streaming API, A rules run as a reconciliation
+CASE_STREAMING_CHANNEL = streaming.PUSH_TOPIC_CHANNEL  # or streaming.CHANGE_DATA_CAPTURE_CHANNEL
+CASE_STREAMING_LOCAL = False  # use the in-process CometD stand-in instead of SF, for offline testing
+CASE_STREAMING_INTERVAL = 5  # seconds between inserts of streamed cases
+CASE_RECONCILIATION_INTERVAL = 300  # seconds between A rules runs in the streaming mode
+DISPATCHER_WORKERS = 4  # channels notified in parallel
+DIGEST_THRESHOLD = 5  # more case notifications per channel per cycle are sent as one digest card, None disables
+WEBHOOK_CONNECT_TIMEOUT = 5  # seconds
+WEBHOOK_READ_TIMEOUT = 30  # seconds
+WEBHOOK_RATE = 1.0  # sends per second per webhook
+WEBHOOK_BURST = 4  # sends allowed at once before WEBHOOK_RATE applies
+DURABLE_ACKNOWLEDGEMENTS = True  # True: mark rows as sent after every notification, as before; False: once per cycle,
+# fewer UPDATEs, but a crash in the middle of a cycle sends again every card delivered since the previous flush
+USE_NOTIFICATION_OUTBOX = False  # routed notifications are stored locally and sent by a background worker
+NOTIFICATION_OUTBOX_PATH = 'elisa_outbox.sqlite3'
+NOTIFICATION_OUTBOX_RETENTION = 86400  # seconds sent notifications are kept to suppress repeated sends
+NOTIFICATION_OUTBOX_MAX_ATTEMPTS = 10  # failed sends of a notification before it is given up
 
 USE_TEST_VARS = False
 PROCEED_WITH_SLA_RULES = True
@@ -43,54 +79,118 @@ else:
 def initialize(sf_config_ins_func: SFConfig):
     logger_inst = logging.getLogger()
     try:
-        sf_connection = Salesforce(username=sf_config_ins_func.user, password=sf_config_ins_func.password,
-                                   security_token=sf_config_ins_func.token)
+        sf_connection = custom_logic.SFSessionManager(sf_config=sf_config_ins_func)
     except simple_salesforce.exceptions.SalesforceAuthenticationFailed as error:
         logger_inst.error('Failed to connect to SalesForce due to the following error:\n' + str(error))
         sf_connection = None
     return sf_connection
 
 
-sf_config_instance = SFConfig()
-sf_queues_instance = SFQueues()
-sql_config_instance_elisa_db = SQLConfigELISADB()
-sql_config_instance_karma_db = SQLConfigKARMADB()
-teams_channels_inst = TeamsChannels(use_test_channels=USE_TEST_VARS)
-sql_connector_instance_elisa_db = custom_logic.SQLConnectorELISADB(sql_config_instance_elisa_db, use_test_instance=USE_TEST_VARS)
+# the configuration is loaded and validated once, it is passed to everything which needs it
+configuration_snapshot = custom_logic.ConfigurationSnapshot.load(use_test_channels=USE_TEST_VARS)
+sf_config_instance = configuration_snapshot.sf_config
+sql_config_instance_elisa_db = configuration_snapshot.sql_config_elisa_db
+sql_config_instance_karma_db = configuration_snapshot.sql_config_karma_db
+# webhooks_dict of the snapshot is read-only and its urls are validated
+teams_channels_inst = configuration_snapshot
+routing_index = configuration_snapshot.routing_index
+sql_connector_instance_elisa_db = custom_logic.SQLConnectorELISADB(sql_config_instance_elisa_db, use_test_instance=USE_TEST_VARS,
+                                                                   durable_acknowledgements=DURABLE_ACKNOWLEDGEMENTS)
 sql_connector_instance_karma_db = custom_logic.SQLConnectorKARMADB(sql_config_instance_karma_db)
+custom_logic.configure_karma_db_pool(sql_config_instance_karma_db)
+try:
+    MainLogger.info('Rows already in ELISA DB: ' + str(sql_connector_instance_elisa_db.warm_persisted_keys()))
+except Exception as error:
+    # without warm keys the first inserts find duplicates in DB as before
+    MainLogger.error('Failed to load rows already in ELISA DB: ' + str(error))
+custom_logic.webhook_transport = custom_logic.TeamsWebhookTransport(connect_timeout=WEBHOOK_CONNECT_TIMEOUT,
+                                                                    read_timeout=WEBHOOK_READ_TIMEOUT,
+                                                                    pool_maxsize=DISPATCHER_WORKERS,
+                                                                    rate_limiter=custom_logic.WebhookRateLimiter(
+                                                                        rate=WEBHOOK_RATE, burst=WEBHOOK_BURST),
+                                                                    valid_web_hook_urls=configuration_snapshot.valid_web_hook_urls)
 SF_connection = initialize(sf_config_ins_func=sf_config_instance)
+if SF_connection is None:
+    MainLogger.critical('Unable to start without a SalesForce session')
+    exit(1)
+if USE_INCREMENTAL_CASE_POLLING is True:
+    incremental_case_ingestor = custom_logic.IncrementalCaseIngestor(max_allowed_sla=MaxAllowedSLA,
+                                                                     full_resync_interval=CASE_FULL_RESYNC_INTERVAL)
+else:
+    incremental_case_ingestor = None
+if USE_CASE_STREAMING is True:
+    if CASE_STREAMING_LOCAL is True:
+        case_streaming_transport = streaming.LocalBayeuxTransport()
+    else:
+        if CASE_STREAMING_CHANNEL == streaming.PUSH_TOPIC_CHANNEL:
+            streaming.ensure_push_topic(SF_connection)
+        case_streaming_transport = streaming.HTTPBayeuxTransport(sf_session_manager=SF_connection)
+    streaming_case_listener = streaming.StreamingCaseListener(
+        streaming.CometDClient(transport=case_streaming_transport, channel=CASE_STREAMING_CHANNEL))
+    # streamed cases are inserted from the scheduler thread like the A rules, through the same connection and keys
+    streaming_case_ingestor = streaming.StreamingCaseIngestor(listener=streaming_case_listener,
+                                                              sql_connector_instance_elisa_db=sql_connector_instance_elisa_db,
+                                                              teams_channels_inst=teams_channels_inst,
+                                                              routing_index=routing_index,
+                                                              reconciliation_interval=CASE_RECONCILIATION_INTERVAL)
+    A_RULES_INTERVAL = CASE_RECONCILIATION_INTERVAL
+else:
+    streaming_case_listener = None
+    streaming_case_ingestor = None
+karma_watermarks = None  # {event_type: [date] of the newest Karma event stored}, loaded from ELISA DB on the first run
+if USE_NOTIFICATION_OUTBOX is True:
+    notification_outbox = outbox.NotificationOutbox(path=NOTIFICATION_OUTBOX_PATH,
+                                                    sent_retention=NOTIFICATION_OUTBOX_RETENTION,
+                                                    max_attempts=NOTIFICATION_OUTBOX_MAX_ATTEMPTS)
+    # the delivery worker runs in its own thread, so it gets its own ELISA DB connection
+    sql_connector_instance_elisa_db_outbox = custom_logic.SQLConnectorELISADB(
+        sql_config_instance_elisa_db, use_test_instance=USE_TEST_VARS, durable_acknowledgements=DURABLE_ACKNOWLEDGEMENTS)
+else:
+    notification_outbox = None
+    sql_connector_instance_elisa_db_outbox = None
 MainLogger.info('Main process has been initialized')
 
 
 ##############################################################
 
 
-def a_rule(rule_start: int, rule_end: int, sf_connection: Salesforce, teams_channels_inst: TeamsChannels):
-    #   loads SF Cases by various filters
+def a_rules(sla_bands: list, sf_connection: Salesforce, teams_channels_inst: TeamsChannels):
+    #   loads SF Cases for all the enabled rule bands by a single query
     main_logger = logging.getLogger()
-    main_logger.info(
-        'A1: Searching for new potential SLA violations by Rule:' + str(rule_end) + '<SLA<' + str(rule_start))
-    found_cases_list = custom_logic.find_cases_with_potential_sla(sf_connection=sf_connection,
-                                                                  max_allowed_sla=rule_start, min_allowed_sla=rule_end)
-
-    if len(found_cases_list) == 0:
-        main_logger.info('Done, no threats were found')
+    main_logger.info('A: Searching for new potential SLA violations by Rules: ' + ', '.join(
+        str(band.rule_end) + '<SLA<' + str(band.rule_start) for band in sla_bands))
+    if streaming_case_ingestor is not None:
+        # the same query seeds the cases watched by the streaming mode
+        found_cases_by_band = streaming_case_ingestor.reconcile(sf_connection=sf_connection, sla_bands=sla_bands)
+    elif incremental_case_ingestor is not None:
+        found_cases_by_band = incremental_case_ingestor.poll(sf_connection=sf_connection, sla_bands=sla_bands)
     else:
-        main_logger.info('Done, found ' + str(len(found_cases_list)) + ' case(s)')
-
-    for case_dict in found_cases_list:
-        case_dict['target_notification_channel'] = custom_logic.find_target_teams_channel_for_case_sla(case_dict['OwnerId'],
-                                                                                                       case_dict[
-                                                                                              'Previous_Owner__c'],
-                                                                                                       case_dict['Product__c'], teams_channels_inst)
-        result = sql_connector_instance_elisa_db.insert_into_dbo_cases(case_dict=case_dict, rule=str(rule_start))
-        if result is not False:
-            pass
+        found_cases_by_band = custom_logic.find_cases_with_potential_sla_by_bands(sf_connection=sf_connection,
+                                                                               sla_bands=sla_bands)
+    case_rows = []
+    for band in sla_bands:
+        found_cases_list = found_cases_by_band[band.rule_start]
+        if len(found_cases_list) == 0:
+            main_logger.info('Rule ' + str(band.rule_start) + ': done, no threats were found')
         else:
-            main_logger.error('Some error has occurred, braking execution and notifying an admin')
-            if isinstance(main_logger.root.handlers[0], logging.FileHandler):
-                main_logger.error('Log name: ' + main_logger.root.handlers[0].baseFilename)
-                exit(1)
+            main_logger.info('Rule ' + str(band.rule_start) + ': done, found ' + str(len(found_cases_list)) + ' case(s)')
+
+        for case_dict in found_cases_list:
+            if 'target_notification_channel' not in case_dict:
+                case_dict['target_notification_channel'] = custom_logic.find_target_teams_channel_for_case_sla(case_dict['OwnerId'],
+                                                                                                               case_dict[
+                                                                                                      'Previous_Owner__c'],
+                                                                                                               case_dict['Product__c'], teams_channels_inst,
+                                                                                                               routing_index=routing_index)
+            case_rows.append((case_dict, str(band.rule_start)))
+    result = sql_connector_instance_elisa_db.insert_into_dbo_cases_batch(case_rows=case_rows)
+    if result is not None:
+        pass
+    else:
+        main_logger.error('Some error has occurred, braking execution and notifying an admin')
+        if isinstance(main_logger.root.handlers[0], logging.FileHandler):
+            main_logger.error('Log name: ' + main_logger.root.handlers[0].baseFilename)
+            exit(1)
 
 
 def a_backlog_rule(sf_connection: Salesforce, teams_channels_inst: TeamsChannels, team: str):
@@ -99,97 +199,93 @@ def a_backlog_rule(sf_connection: Salesforce, teams_channels_inst: TeamsChannels
         'A backlog: Checking if there is any backlog for team: ' + str(team))
 
 
-def a_karma_event_rule(sql_connector_instance_karma_db_func: custom_logic.SQLConnectorKARMADB, event_type: str):
-    #   loads Karma events
+def a_karma_event_rules(sql_connector_instance_karma_db_func: custom_logic.SQLConnectorKARMADB):
+    #   loads Karma events of all types by a single query
     main_logger = logging.getLogger()
-    main_logger.info('Ax: Searching for new Karma Events by type: ' + event_type)
-    found_events_list = sql_connector_instance_karma_db_func.find_karma_events(event_type)
+    global karma_watermarks
+    main_logger.info('Ax: Searching for new Karma Events')
+    if karma_watermarks is None:
+        karma_watermarks = sql_connector_instance_elisa_db.select_karma_watermarks()
+    found_events_list = sql_connector_instance_karma_db_func.find_all_karma_events(
+        watermarks=karma_watermarks, watermark_overlap=KARMA_WATERMARK_OVERLAP)
     if len(found_events_list) == 0:
-        main_logger.info('Done, no Karma ' + event_type + ' events were found')
+        main_logger.info('Done, no Karma events were found')
     else:
         main_logger.info('Done, found ' + str(len(found_events_list)) + ' event(s)')
     for event_dict in found_events_list:
-        event_dict['target_notification_channel'] = custom_logic.find_target_teams_channel_for_karma_event(event_type, teams_channels_inst, event_dict)
-        result = sql_connector_instance_elisa_db.insert_into_dbo_karma_events(event_dict=event_dict, event_type=event_type)
-        if result is not False:
-            pass
-        else:
-            main_logger.error('Some error has occurred, braking execution and notifying admin')
-            if isinstance(main_logger.root.handlers[0], logging.FileHandler):
-                main_logger.error('Log name: ' + main_logger.root.handlers[0].baseFilename)
-                exit(1)
+        event_dict['target_notification_channel'] = custom_logic.find_target_teams_channel_for_karma_event(event_dict['type'], teams_channels_inst, event_dict)
+    result = sql_connector_instance_elisa_db.insert_into_dbo_karma_events_batch(events=found_events_list)
+    if result is not None:
+        # the next run starts from the newest stored event
+        new_karma_watermarks = custom_logic.advance_karma_watermarks(karma_watermarks, found_events_list)
+        if new_karma_watermarks != karma_watermarks:
+            sql_connector_instance_elisa_db.update_karma_watermarks(new_karma_watermarks)
+            karma_watermarks = new_karma_watermarks
+    else:
+        main_logger.error('Some error has occurred, braking execution and notifying admin')
+        if isinstance(main_logger.root.handlers[0], logging.FileHandler):
+            main_logger.error('Log name: ' + main_logger.root.handlers[0].baseFilename)
+            exit(1)
 
 
-def main_execution(sql_connector_instance_func, teams_channels_inst_func):
-    c_rule_logic_style = None
-    if PROCEED_WITH_SLA_RULES is True:
-        current_day_of_week = datetime.utcnow().date().weekday()
-        if current_day_of_week in (5, 6):  # weekend shifts
-            utc_current_date = datetime.utcnow().date()
-            utc_11_march = datetime.utcnow().date().replace(month=3, day=11)
-            utc_04_november = datetime.utcnow().date().replace(month=11, day=4)
-            utc_current_time = datetime.utcnow()
-            if utc_04_november <= utc_current_date < utc_11_march:
-                MainLogger.debug('Checking time, now is after 04.11 and before 11.03, dls = winter')
-                weekend_emea_shift_start = utc_current_time.replace(hour=4, minute=30)
-                weekend_emea_shift_end = utc_current_time.replace(hour=16, minute=30)
-            elif utc_11_march <= utc_current_date < utc_04_november:
-                MainLogger.debug('Checking time, now is after 11.03 and before 04.11, dls = summer')
-                weekend_emea_shift_start = utc_current_time.replace(hour=5, minute=00)
-                weekend_emea_shift_end = utc_current_time.replace(hour=17, minute=00)
-            else:
-                #  just in case...
-                weekend_emea_shift_start = utc_current_time.replace(hour=5, minute=00)
-                weekend_emea_shift_end = utc_current_time.replace(hour=17, minute=00)
-            if weekend_emea_shift_start <= utc_current_time < weekend_emea_shift_end:
-                c_rule_logic_style = 'Weekend EMEA'
-            else:
-                c_rule_logic_style = 'Weekend US'
-        else:
-            utc_current_time_hour = datetime.utcnow().hour
-            if 5 <= utc_current_time_hour < 7:  # t0,  APJ + EMEA
-                c_rule_logic_style = 'APJ + EMEA'
-            elif 7 <= utc_current_time_hour < 12:  # t1,  EMEA
-                c_rule_logic_style = 'EMEA'
-            elif 12 <= utc_current_time_hour < 17:  # t2,  EMEA + US
-                c_rule_logic_style = 'EMEA + US'
-            elif 17 <= utc_current_time_hour < 23:  # t3,  US
-                c_rule_logic_style = 'US'
-            elif 23 <= utc_current_time_hour:  # t4,  US + APJ
-                c_rule_logic_style = 'US + APJ'
-            elif 0 <= utc_current_time_hour < 5:  # t5,  APJ
-                c_rule_logic_style = 'APJ'
-            else:
-                c_rule_logic_style = None
-                MainLogger.critical('c_rule_logic_style cannot be None, what time is it?')
-                exit(1)
-    sf_config_inst_2 = SFConfig()
-    s_f_connection = Salesforce(username=sf_config_inst_2.user, password=sf_config_inst_2.password,
-                                security_token=sf_config_inst_2.token)
-    # Block A: loading source threats and uploading them to DB
-    #   A1: Loading SLA cases from all Tier 1 Queues with potentially broken SLA: RULE 60
+# Block A: loading source threats and uploading them to DB
+#   A1: Loading SLA cases from all Tier 1 Queues with potentially broken SLA: RULE 60
+#   A2: Loading SLA cases from all Tier 1 Queues with potentially broken SLA: RULE 30
+#   A3: Loading SLA cases from all Tier 1 Queues with potentially broken SLA: RULE 10
+rule_a1 = MaxAllowedSLA
+rule_a1_end = 30
+rule_a2 = 31
+rule_a2_end = 10
+rule_a3 = 10
+rule_a3_end = 0
+
+
+def get_sla_bands() -> list:
+    sla_bands = []
     if proceed_with_a1_rule is True:
-        rule_a1 = MaxAllowedSLA
-        rule_a1_end = 30
-        a_rule(rule_a1, rule_a1_end, s_f_connection, teams_channels_inst_func)
-    #   A2: Loading SLA cases from all Tier 1 Queues with potentially broken SLA: RULE 30
+        sla_bands.append(custom_logic.SLABand(rule_start=rule_a1, rule_end=rule_a1_end))
     if proceed_with_a2_rule is True:
-        rule_a2 = 31
-        rule_a2_end = 10
-        a_rule(rule_a2, rule_a2_end, s_f_connection, teams_channels_inst_func)
-    #   A3: Loading SLA cases from all Tier 1 Queues with potentially broken SLA: RULE 10
+        sla_bands.append(custom_logic.SLABand(rule_start=rule_a2, rule_end=rule_a2_end))
     if proceed_with_a3_rule is True:
-        rule_a3 = 10
-        rule_a3_end = 0
-        a_rule(rule_a3, rule_a3_end, s_f_connection, teams_channels_inst_func)
+        sla_bands.append(custom_logic.SLABand(rule_start=rule_a3, rule_end=rule_a3_end))
+    return sla_bands
+
+
+def a_rules_stage(teams_channels_inst_func):
+    s_f_connection = SF_connection
+    sla_bands = get_sla_bands()
+    if len(sla_bands) > 0:
+        a_rules(sla_bands, s_f_connection, teams_channels_inst_func)
+
+
+def case_streaming_stage():
+    # cases changed in SF are inserted as soon as they enter a rule band, A rules reconcile what streaming has missed
+    sla_bands = get_sla_bands()
+    if len(sla_bands) > 0:
+        inserted = streaming_case_ingestor.process(sf_connection=SF_connection, sla_bands=sla_bands)
+        if inserted > 0:
+            MainLogger.info('Streaming: ' + str(inserted) + ' case(s) inserted')
+
+
+def karma_event_rules_stage():
     #   Ax_karma_event_rule
     if PROCEED_WITH_KARMA_EVENTS_RULES is True:
-        #   WebRequests_delete_page_by_XWD_FULLNAME
-        a_karma_event_rule(sql_connector_instance_karma_db, 'delete')
-        #   WebRequests_reindex_page_by_XWD_FULLNAME
-        a_karma_event_rule(sql_connector_instance_karma_db, 'reindex')
+        #   WebRequests_delete_page_by_XWD_FULLNAME, WebRequests_reindex_page_by_XWD_FULLNAME,
         #   WebRequests_vote_for_page_as_user
-        a_karma_event_rule(sql_connector_instance_karma_db, 'vote')
+        a_karma_event_rules(sql_connector_instance_karma_db)
+
+
+def backlog_rule_stage(teams_channels_inst_func):
+    for team in BACKLOG_RULE_TEAMS:
+        a_backlog_rule(SF_connection, teams_channels_inst_func, team)
+
+
+def dispatch_stage(sql_connector_instance_func, teams_channels_inst_func):
+    c_rule_logic_style = None
+    utc_current_time = datetime.utcnow()
+    if PROCEED_WITH_SLA_RULES is True:
+        c_rule_logic_style = routing.get_rule_logic_style(utc_current_time)
+    s_f_connection = SF_connection
     # Block B: loading threats
     MainLogger.info('Loading threats')
     threats = []
@@ -209,10 +305,40 @@ def main_execution(sql_connector_instance_func, teams_channels_inst_func):
 
     if len(threats) > 0:
         MainLogger.info('threats loaded, processing')
+        pending_case_threats = [threat for threat in threats if isinstance(threat, custom_logic.CaseSLA) and
+                                str(threat.target_notification_channel).startswith('https://outlook.office.com/webhook/')]
+        if len(pending_case_threats) > 0:
+            MainLogger.info('Refreshing SLA of ' + str(len(pending_case_threats)) + ' case(s)')
+            custom_logic.refresh_current_sla_of_threats(sf_connection=s_f_connection, threats=pending_case_threats)
+        MainLogger.debug('Loading page stats of Karma events')
+        try:
+            custom_logic.prefetch_karma_threats_page_stats(threats, xwiki_config=configuration_snapshot.xwiki_config)
+        except Exception as error:
+            MainLogger.error('Failed to prefetch page stats, they will be loaded per card: ' + str(error))
+        case_threats = [threat for threat in threats if isinstance(threat, custom_logic.CaseSLA)]
+        if len(case_threats) > 0:
+            # only CO is resolved by name below, pCOQ is a queue name
+            MainLogger.debug('Resolving CO of ' + str(len(case_threats)) + ' case(s)')
+            custom_logic.sf_resolve_owner_names(sf_connection=s_f_connection,
+                                                owner_ids=[threat.info_tuple[3] for threat in case_threats])
     else:
         MainLogger.debug('no threats found, skipping')
 
     # Block C: reacting on threats
+    notification_dispatcher = custom_logic.NotificationDispatcher(max_workers=DISPATCHER_WORKERS,
+                                                                  digest_threshold=DIGEST_THRESHOLD)
+    # {(xwd_fullname, type): [CreatedDate, ...]} of reindex events routed in this cycle
+    routed_reindex_events = {}
+    # reindex threats whose page was already notified about, checked by one query for the whole cycle
+    reindex_threats = [threat for threat in threats
+                       if isinstance(threat, custom_logic.KarmaEvent) and threat.event_type == 'reindex']
+    if len(reindex_threats) > 0:
+        covered_reindex_threats = sql_connector_instance_func.select_covered_reindex_threats(reindex_threats)
+    else:
+        covered_reindex_threats = set()
+    # the rule table is resolved once per cycle for the current style and case shift
+    case_router = routing.CaseRouter(routing_index.webhooks_dict, c_rule_logic_style, utc_current_time,
+                                     rule_a2=rule_a2, rule_a3=rule_a3)
     for Threat in threats:
         if not isinstance(Threat, custom_logic.CaseSLA) and not isinstance(Threat, custom_logic.KarmaEvent):
             MainLogger.info('Unsupported threat type, skipping: ' + str(type(Threat)) + ' ' + str(Threat.info_tuple[2]))
@@ -245,8 +371,10 @@ def main_execution(sql_connector_instance_func, teams_channels_inst_func):
                     sql_connector_instance_func.update_dbo_cases_after_notification_sent(row_id=Threat.info_tuple[1])
                 elif Threat.target_notification_channel.startswith('https://outlook.office.com/webhook/'):
                     MainLogger.info('Reacting on threat: case ' + str(Threat.info_tuple[2]))
-                    Threat.current_SLA = custom_logic.get_current_case_sla(sf_connection=s_f_connection,
-                                                                           case_id=Threat.info_tuple[4])
+                    if Threat.current_SLA_loaded is False:
+                        # the case wasn't returned by the bulk refresh, asking for it directly
+                        Threat.current_SLA = custom_logic.get_current_case_sla(sf_connection=s_f_connection,
+                                                                               case_id=Threat.info_tuple[4])
                     # Step 1: looking for an appropriate A rule:
                     # A rule is already broken
                     if Threat.current_SLA is None:
@@ -270,483 +398,37 @@ def main_execution(sql_connector_instance_func, teams_channels_inst_func):
 
                     MainLogger.info('Looking for an appropriate A rule, current case SLA:' + str(Threat.current_SLA) + ', c_rule_logic_style: ' + str(c_rule_logic_style))
                     Threat.current_SLA = int(Threat.current_SLA)
-                    if Threat.current_SLA > rule_a2 and Threat.info_tuple[1]:  # A1
-                        if c_rule_logic_style == 'APJ + EMEA':
-                            # Adding a special forwarding rule to notify in a frontier case
-                            # APJ
-                            notify_APJ = False
-                            if PCOQ is not None:
-                                if PCOQ not in ['Tier 1 - Europe',
-                                            'Tier Russian',
-                                            'Tier 2 - EM:Europe',
-                                            'Tier 3 - EM: EMEA']:
-                                    notify_APJ = True
-                            elif co not in ['Tier 1 - Europe',
-                                        'Tier Russian',
-                                        'Tier 2 - EM:Europe',
-                                        'Tier 3 - EM: EMEA']:
-                                notify_APJ = True
-                            # EMEA: NOTE: Threat.target_notification_channel also contains cloud and agent logic
-                            notify_EMEA = False
-                            if PCOQ is not None:
-                                if PCOQ not in ['Tier 1 - APAC',
-                                            'Tier Chinese',
-                                            'Tier Japanese']:
-                                    notify_EMEA = True
-                            elif co not in ['Tier 1 - APAC',
-                                            'Tier Chinese',
-                                            'Tier Japanese']:
-                                notify_EMEA = True
-                            if notify_APJ is True:
-                                MainLogger.debug('Sending notification to: Support.Worldwide / APAC - Cases and Calls')
-                                channel_notification_sequence(teams_channels_inst_func.webhooks_dict['Support.Worldwide / APAC - Cases and Calls'],
-                                                              sql_connector_instance_func, Threat)
-                            if notify_EMEA is True:
-                                USE_A1_SHIFT = False
-                                if PCOQ is not None:
-                                    if PCOQ in ['Tier 1 - Europe',
-                                                'Tier Russian',
-                                                'Tier Portuguese',
-                                                'Tier 1 - APAC',
-                                                'Tier 1 - North America',
-                                                'Tier 1 - South America',
-                                                'Tier 1 - US Federal',
-                                                'Tier Chinese',
-                                                'Tier Dutch',
-                                                'Tier Japanese']:
-                                        USE_A1_SHIFT = True
-                                elif co in ['Tier 1 - Europe',
-                                            'Tier Russian',
-                                            'Tier Portuguese',
-                                            'Tier 1 - APAC',
-                                            'Tier 1 - North America',
-                                            'Tier 1 - South America',
-                                            'Tier 1 - US Federal',
-                                            'Tier Chinese',
-                                            'Tier Dutch',
-                                            'Tier Japanese']:
-                                    USE_A1_SHIFT = True
-                                if USE_A1_SHIFT is True:
-                                    MainLogger.debug(
-                                        'Sending notification to: Case shift 1')
-                                    channel_notification_sequence(
-                                        teams_channels_inst_func.webhooks_dict['Case shift 1'],
-                                        sql_connector_instance_func, Threat)
-                                else:
-                                    MainLogger.debug(
-                                        'Sending notification to: default channel')
-                                    channel_notification_sequence(Threat.target_notification_channel,
-                                                                  sql_connector_instance_func, Threat)
-                        elif c_rule_logic_style == 'EMEA':
-                            # Adding a special forwarding rule A1_1-4 for the list mentioned below
-                            # Testing CO and PCOQ
-                            USE_A1_SHIFT = False
-                            if PCOQ is not None:
-                                if PCOQ in ['Tier 1 - Europe',
-                                            'Tier Russian',
-                                            'Tier Portuguese',
-                                            'Tier 1 - APAC',
-                                            'Tier 1 - North America',
-                                            'Tier 1 - South America',
-                                            'Tier 1 - US Federal',
-                                            'Tier Chinese',
-                                            'Tier Dutch',
-                                            'Tier Japanese']:
-                                    USE_A1_SHIFT = True
-                            elif co in ['Tier 1 - Europe',
-                                        'Tier Russian',
-                                        'Tier Portuguese',
-                                        'Tier 1 - APAC',
-                                        'Tier 1 - North America',
-                                        'Tier 1 - South America',
-                                        'Tier 1 - US Federal',
-                                        'Tier Chinese',
-                                        'Tier Dutch',
-                                        'Tier Japanese']:
-                                USE_A1_SHIFT = True
-                            if USE_A1_SHIFT is True:
-                                # Testing time:
-                                current_time_hour_utc = datetime.utcnow()
-                                today_shift1_start = current_time_hour_utc.replace(hour=4, minute=30, second=0,
-                                                                                   microsecond=0)
-                                today_shift1_end = today_shift1_start.replace(hour=8, minute=30)
-                                today_shift2_start = today_shift1_start.replace(hour=8, minute=30)
-                                today_shift2_end = today_shift1_start.replace(hour=10, minute=30)
-                                today_shift3_start = today_shift1_start.replace(hour=10, minute=30)
-                                today_shift3_end = today_shift1_start.replace(hour=12, minute=30)
-                                today_shift4_start = today_shift1_start.replace(hour=12, minute=30)
-                                today_shift4_end = today_shift1_start.replace(hour=16, minute=30)
-
-                                if today_shift1_start <= current_time_hour_utc < today_shift1_end:
-                                    # 7:30 - 11:30 am GMT+3, 4:30 - 8:30 UTC
-                                    RuleA1_notification_target_channel = teams_channels_inst_func.webhooks_dict[
-                                        'Case shift 1']
-                                    MainLogger.debug(
-                                        'Sending notification to: Case shift 1')
-                                elif today_shift2_start <= current_time_hour_utc < today_shift2_end:
-                                    # 11:30am - 1:30pm GMT+3, 8:30 - 10:30 UTC
-                                    RuleA1_notification_target_channel = teams_channels_inst_func.webhooks_dict[
-                                        'Case shift 2']
-                                    MainLogger.debug(
-                                        'Sending notification to: Case shift 2')
-                                elif today_shift3_start <= current_time_hour_utc < today_shift3_end:
-                                    # 1:30pm - 3:30pm GMT+3, 10:30 - 12:30 UTC
-                                    RuleA1_notification_target_channel = teams_channels_inst_func.webhooks_dict[
-                                        'Case shift 3']
-                                    MainLogger.debug(
-                                        'Sending notification to: Case shift 3')
-                                elif today_shift4_start <= current_time_hour_utc < today_shift4_end:
-                                    # 3:30pm - 7:30pm GMT+3, 12:30 - 16:30 UTC
-                                    RuleA1_notification_target_channel = teams_channels_inst_func.webhooks_dict[
-                                        'Case shift 4']
-                                    MainLogger.debug(
-                                        'Sending notification to: Case shift 4')
-                                else:
-                                    MainLogger.info(
-                                        'A1_n rule by source is ok, but now is not a right time, notifying a default channel by type: ' + str(
-                                            Threat.target_notification_channel))
-                                    RuleA1_notification_target_channel = Threat.target_notification_channel
-                                channel_notification_sequence(RuleA1_notification_target_channel,
-                                                              sql_connector_instance_func, Threat)
-                            else:
-                                # it means that it's a special or language channel and a default target_notification_channel should be used
-                                MainLogger.debug(
-                                    'Sending notification to: default channel')
-                                channel_notification_sequence(Threat.target_notification_channel,
-                                                              sql_connector_instance_func, Threat)
-                        elif c_rule_logic_style == 'EMEA + US':
-                            # EMEA:
-                            notify_EMEA = False
-                            if PCOQ is not None:
-                                if PCOQ not in ['Tier 1 - North America',
-                                                'Tier 1 - South America',
-                                                'Tier 1 - US Federal',
-                                                'Tier 2 - EM:Americas',
-                                                'Tier 3 - EM:Americas']:
-                                    notify_EMEA = True
-                            elif co not in ['Tier 1 - North America',
-                                                'Tier 1 - South America',
-                                                'Tier 1 - US Federal',
-                                                'Tier 2 - EM:Americas',
-                                                'Tier 3 - EM:Americas']:
-                                notify_EMEA = True
-                            # US
-                            notify_US = False
-                            if PCOQ is not None:
-                                if PCOQ not in ['Tier 1 - Europe',
-                                                'Tier Russian',
-                                                'Tier 2 - EM:Europe',
-                                                'Tier 3 - EM: EMEA']:
-                                    notify_US = True
-                            elif co not in ['Tier 1 - Europe',
-                                            'Tier Russian',
-                                            'Tier 2 - EM:Europe',
-                                            'Tier 3 - EM: EMEA']:
-                                notify_US = True
-                            if notify_US is True:
-                                MainLogger.debug(
-                                    'Sending notification to: Support.Worldwide / NA - Cases')
-                                channel_notification_sequence(teams_channels_inst_func.webhooks_dict[
-                                                                  'Support.Worldwide / NA - Cases'],
-                                                              sql_connector_instance_func, Threat)
-                            if notify_EMEA is True:
-                                USE_A1_SHIFT = False
-                                if PCOQ is not None:
-                                    if PCOQ in ['Tier 1 - Europe',
-                                                'Tier Russian',
-                                                'Tier Portuguese',
-                                                'Tier 1 - APAC',
-                                                'Tier 1 - North America',
-                                                'Tier 1 - South America',
-                                                'Tier 1 - US Federal',
-                                                'Tier Chinese',
-                                                'Tier Dutch',
-                                                'Tier Japanese']:
-                                        USE_A1_SHIFT = True
-                                elif co in ['Tier 1 - Europe',
-                                            'Tier Russian',
-                                            'Tier Portuguese',
-                                            'Tier 1 - APAC',
-                                            'Tier 1 - North America',
-                                            'Tier 1 - South America',
-                                            'Tier 1 - US Federal',
-                                            'Tier Chinese',
-                                            'Tier Dutch',
-                                            'Tier Japanese']:
-                                    USE_A1_SHIFT = True
-                                if USE_A1_SHIFT is True:
-                                    # Testing time:
-                                    current_time_hour_utc = datetime.utcnow()
-                                    today_shift1_start = current_time_hour_utc.replace(hour=4, minute=30, second=0,
-                                                                                       microsecond=0)
-                                    today_shift1_end = today_shift1_start.replace(hour=8, minute=30)
-                                    today_shift2_start = today_shift1_start.replace(hour=8, minute=30)
-                                    today_shift2_end = today_shift1_start.replace(hour=10, minute=30)
-                                    today_shift3_start = today_shift1_start.replace(hour=10, minute=30)
-                                    today_shift3_end = today_shift1_start.replace(hour=12, minute=30)
-                                    today_shift4_start = today_shift1_start.replace(hour=12, minute=30)
-                                    today_shift4_end = today_shift1_start.replace(hour=16, minute=30)
-                                    if today_shift1_start <= current_time_hour_utc < today_shift1_end:
-                                        # 7:30 - 11:30 am GMT+3, 4:30 - 8:30 UTC
-                                        RuleA1_notification_target_channel = teams_channels_inst_func.webhooks_dict[
-                                            'Case shift 1']
-                                        MainLogger.debug(
-                                            'Sending notification to: Case shift 1')
-                                    elif today_shift2_start <= current_time_hour_utc < today_shift2_end:
-                                        # 11:30am - 1:30pm GMT+3, 8:30 - 10:30 UTC
-                                        RuleA1_notification_target_channel = teams_channels_inst_func.webhooks_dict[
-                                            'Case shift 2']
-                                        MainLogger.debug(
-                                            'Sending notification to: Case shift 2')
-                                    elif today_shift3_start <= current_time_hour_utc < today_shift3_end:
-                                        # 1:30pm - 3:30pm GMT+3, 10:30 - 12:30 UTC
-                                        RuleA1_notification_target_channel = teams_channels_inst_func.webhooks_dict[
-                                            'Case shift 3']
-                                        MainLogger.debug(
-                                            'Sending notification to: Case shift 3')
-                                    elif today_shift4_start <= current_time_hour_utc < today_shift4_end:
-                                        # 3:30pm - 7:30pm GMT+3, 12:30 - 16:30 UTC
-                                        RuleA1_notification_target_channel = teams_channels_inst_func.webhooks_dict[
-                                            'Case shift 4']
-                                        MainLogger.debug(
-                                            'Sending notification to: Case shift 4')
-                                    else:
-                                        MainLogger.info(
-                                            'A1_n rule by source is ok, but now is not a right time, notifying a default channel by type: ' + str(
-                                                Threat.target_notification_channel))
-                                        RuleA1_notification_target_channel = Threat.target_notification_channel
-                                    channel_notification_sequence(RuleA1_notification_target_channel,
-                                                                  sql_connector_instance_func, Threat)
-                                else:
-                                    # it means that it's a special or language channel and a default target_notification_channel should be used
-                                    MainLogger.debug(
-                                        'Sending notification to: default channel')
-                                    channel_notification_sequence(Threat.target_notification_channel,
-                                                                  sql_connector_instance_func, Threat)
-                        elif c_rule_logic_style == 'US':
-                            MainLogger.debug(
-                                'Sending notification to: Support.Worldwide / NA - Cases')
-                            channel_notification_sequence(teams_channels_inst_func.webhooks_dict['Support.Worldwide / NA - Cases'],
-                                                          sql_connector_instance_func, Threat)
-                        elif c_rule_logic_style == 'US + APJ':
-                            # Adding a special forwarding rule to notify in a frontier case
-                            notify_US = False
-                            if PCOQ is not None:
-                                if PCOQ not in ['Tier 1 - APAC',
-                                                'Tier Chinese',
-                                                'Tier Japanese']:
-                                    notify_US = True
-                            elif co not in ['Tier 1 - APAC',
-                                                'Tier Chinese',
-                                                'Tier Japanese']:
-                                notify_US = True
-                            notify_APJ = False
-                            if PCOQ is not None:
-                                if PCOQ not in ['Tier 1 - North America',
-                                                'Tier 1 - South America',
-                                                'Tier 1 - US Federal',
-                                                'Tier 2 - EM:Americas',
-                                                'Tier 3 - EM:Americas']:
-                                    notify_APJ = True
-                            elif co not in ['Tier 1 - North America',
-                                                'Tier 1 - South America',
-                                                'Tier 1 - US Federal',
-                                                'Tier 2 - EM:Americas',
-                                                'Tier 3 - EM:Americas']:
-                                notify_APJ = True
-                            if notify_US is True:
-                                MainLogger.debug(
-                                    'Sending notification to: Support.Worldwide / NA - Cases')
-                                channel_notification_sequence(teams_channels_inst_func.webhooks_dict[
-                                                                  'Support.Worldwide / NA - Cases'],
-                                                              sql_connector_instance_func, Threat)
-                            if notify_APJ is True:
-                                MainLogger.debug(
-                                    'Sending notification to: Support.Worldwide / APAC - Cases and Calls')
-                                channel_notification_sequence(teams_channels_inst_func.webhooks_dict[
-                                                                  'Support.Worldwide / APAC - Cases and Calls'],
-                                                              sql_connector_instance_func, Threat)
-                        elif c_rule_logic_style == 'APJ':
-                            MainLogger.debug(
-                                'Sending notification to: Support.Worldwide / APAC - Cases and Calls')
-                            channel_notification_sequence(teams_channels_inst_func.webhooks_dict['Support.Worldwide / APAC - Cases and Calls'],
-                                                          sql_connector_instance_func, Threat)
-                        elif c_rule_logic_style == 'Weekend EMEA':
-                            MainLogger.debug(
-                                'Sending notification to: Tier1 EMEA / Weekend channel')
-                            channel_notification_sequence(
-                                teams_channels_inst_func.webhooks_dict['Tier1 EMEA / Weekend channel'],
-                                sql_connector_instance_func, Threat)
-                        elif c_rule_logic_style == 'Weekend US':
-                            MainLogger.debug(
-                                'Sending notification to: Support.Worldwide / NA - Cases')
-                            channel_notification_sequence(
-                                teams_channels_inst_func.webhooks_dict['Support.Worldwide / NA - Cases'],
-                                sql_connector_instance_func, Threat)
-                        else:
-                            MainLogger.critial(
-                                'Failed to locate an appropriate channel to notify about A1 rule event, using "Test channel"')
-                            RuleA1_notification_target_channel = teams_channels_inst_func.webhooks_dict['Test channel']
-                            channel_notification_sequence(RuleA1_notification_target_channel,
-                                                          sql_connector_instance_func, Threat)
-                    elif rule_a2 >= Threat.current_SLA > rule_a3:  # A2
-                        if c_rule_logic_style == 'APJ + EMEA':
-                            # Adding a special forwarding rule to notify in a frontier case
-                            # APJ
-                            notify_APJ = False
-                            if PCOQ is not None:
-                                if PCOQ not in ['Tier 1 - Europe',
-                                                'Tier Russian',
-                                                'Tier 2 - EM:Europe',
-                                                'Tier 3 - EM: EMEA']:
-                                    notify_APJ = True
-                            elif co not in ['Tier 1 - Europe',
-                                            'Tier Russian',
-                                            'Tier 2 - EM:Europe',
-                                            'Tier 3 - EM: EMEA']:
-                                notify_APJ = True
-                            # EMEA: NOTE: Threat.target_notification_channel also contains cloud and agent logic
-                            notify_EMEA = False
-                            if PCOQ is not None:
-                                if PCOQ not in ['Tier 1 - APAC',
-                                                'Tier Chinese',
-                                                'Tier Portuguese',
-                                                'Tier Japanese']:
-                                    notify_EMEA = True
-                            elif co not in ['Tier 1 - APAC',
-                                            'Tier Chinese',
-                                            'Tier Portuguese',
-                                            'Tier Japanese']:
-                                notify_EMEA = True
-                            if notify_APJ is True:
-                                MainLogger.debug(
-                                    'Sending notification to: Support.Worldwide / APAC - Cases and Calls')
-                                channel_notification_sequence(teams_channels_inst_func.webhooks_dict[
-                                                                  'Support.Worldwide / APAC - Cases and Calls'],
-                                                              sql_connector_instance_func, Threat)
-                            if notify_EMEA is True:
-                                MainLogger.debug(
-                                    'Sending notification to: Tier 1 EMEA / Administrative')
-                                channel_notification_sequence(teams_channels_inst_func.webhooks_dict[
-                                                                  'Tier 1 EMEA / Administrative'],
-                                                              sql_connector_instance_func, Threat)
-                        elif c_rule_logic_style == 'EMEA':
-                            MainLogger.debug(
-                                'Sending notification to: Tier 1 EMEA / Administrative')
-                            channel_notification_sequence(teams_channels_inst_func.webhooks_dict[
-                                                              'Tier 1 EMEA / Administrative'],
-                                                          sql_connector_instance_func, Threat)
-                        elif c_rule_logic_style == 'EMEA + US':
-                            # US
-                            notify_US = False
-                            if PCOQ is not None:
-                                if PCOQ not in ['Tier 1 - Europe',
-                                                'Tier Russian',
-                                                'Tier 2 - EM:Europe',
-                                                'Tier 3 - EM: EMEA']:
-                                    notify_US = True
-                            elif co not in ['Tier 1 - Europe',
-                                            'Tier Russian',
-                                            'Tier 2 - EM:Europe',
-                                            'Tier 3 - EM: EMEA']:
-                                notify_US = True
-                            # EMEA:
-                            notify_EMEA = False
-                            if PCOQ is not None:
-                                if PCOQ not in ['Tier 1 - APAC',
-                                                'Tier Chinese',
-                                                'Tier Japanese']:
-                                    notify_EMEA = True
-                            elif co not in ['Tier 1 - APAC',
-                                            'Tier Chinese',
-                                            'Tier Portuguese',
-                                            'Tier Japanese']:
-                                notify_EMEA = True
-                            if notify_US is True:
-                                MainLogger.debug(
-                                    'Sending notification to: Support.Worldwide / NA - Cases')
-                                channel_notification_sequence(teams_channels_inst_func.webhooks_dict[
-                                                                  'Support.Worldwide / NA - Cases'],
-                                                              sql_connector_instance_func, Threat)
-                            if notify_EMEA is True:
-                                MainLogger.debug(
-                                    'Sending notification to: Tier 1 EMEA / Administrative')
-                                channel_notification_sequence(teams_channels_inst_func.webhooks_dict[
-                                                                  'Tier 1 EMEA / Administrative'],
-                                                              sql_connector_instance_func, Threat)
-                        elif c_rule_logic_style == 'US':
-                            MainLogger.debug(
-                                'Sending notification to: Support.Worldwide / NA - Cases')
-                            channel_notification_sequence(teams_channels_inst_func.webhooks_dict[
-                                                              'Support.Worldwide / NA - Cases'],
-                                                          sql_connector_instance_func, Threat)
-                        elif c_rule_logic_style == 'US + APJ':
-                            notify_US = False
-                            if PCOQ is not None:
-                                if PCOQ not in ['Tier 1 - APAC',
-                                                'Tier Chinese',
-                                                'Tier Japanese']:
-                                    notify_US = True
-                            elif co not in ['Tier 1 - APAC',
-                                            'Tier Chinese',
-                                            'Tier Japanese']:
-                                notify_US = True
-                            notify_APJ = False
-                            if PCOQ is not None:
-                                if PCOQ not in ['Tier 1 - North America',
-                                                'Tier 1 - South America',
-                                                'Tier 1 - US Federal',
-                                                'Tier 2 - EM:Americas',
-                                                'Tier 3 - EM:Americas']:
-                                    notify_APJ = True
-                            elif co not in ['Tier 1 - North America',
-                                            'Tier 1 - South America',
-                                            'Tier 1 - US Federal',
-                                            'Tier 2 - EM:Americas',
-                                            'Tier 3 - EM:Americas']:
-                                notify_APJ = True
-                            if notify_US is True:
-                                MainLogger.debug(
-                                    'Sending notification to: Support.Worldwide / NA - Cases')
-                                channel_notification_sequence(teams_channels_inst_func.webhooks_dict[
-                                                                  'Support.Worldwide / NA - Cases'],
-                                                              sql_connector_instance_func, Threat)
-                            if notify_APJ is True:
-                                MainLogger.debug(
-                                    'Sending notification to: Support.Worldwide / APAC - Cases and Calls')
-                                channel_notification_sequence(teams_channels_inst_func.webhooks_dict[
-                                                                  'Support.Worldwide / APAC - Cases and Calls'],
-                                                              sql_connector_instance_func, Threat)
-                        elif c_rule_logic_style == 'APJ':
-                            channel_notification_sequence(teams_channels_inst_func.webhooks_dict[
-                                                              'Support.Worldwide / APAC - Cases and Calls'],
-                                                          sql_connector_instance_func, Threat)
-                        elif c_rule_logic_style == 'Weekend EMEA' or c_rule_logic_style == 'Weekend US':
-                            MainLogger.debug(
-                                'Sending notification to: Support.Worldwide / Weekend Cases')
-                            channel_notification_sequence(
-                                teams_channels_inst_func.webhooks_dict['Support.Worldwide / Weekend Cases'],
-                                sql_connector_instance_func, Threat)
-                        else:
-                            MainLogger.critial(
-                                'Failed to locate an appropriate channel to notify about A2 rule event, using "Test channel"')
-                            channel_notification_sequence(teams_channels_inst_func.webhooks_dict[
-                                                              'Test channel'],
-                                                          sql_connector_instance_func, Threat)
-                    elif Threat.current_SLA <= rule_a3:
-                        MainLogger.debug(
-                            'Sending notification to: Management.Worldwide / General')
-                        channel_notification_sequence(teams_channels_inst_func.webhooks_dict['Management.Worldwide / General'], sql_connector_instance_func, Threat)
-                    else:
-                        MainLogger.critial(
+                    rule_band = case_router.get_rule_band(Threat.current_SLA, Threat.info_tuple[1])
+                    if rule_band is None:
+                        MainLogger.critical(
                             'Cannot apply any A rule for the case, skipping')
                         continue
+                    for channel_name in case_router.route(rule_band, co, PCOQ):
+                        if channel_name == routing.FALLBACK_CHANNEL:
+                            MainLogger.critical('Failed to locate an appropriate channel to notify about ' + rule_band +
+                                                ' rule event, using "' + routing.FALLBACK_CHANNEL + '"')
+                        MainLogger.debug('Sending notification to: ' + channel_name)
+                        notification_dispatcher.enqueue(
+                            case_router.get_webhook(channel_name, Threat.target_notification_channel), Threat)
                 else:
                     pass
             if isinstance(Threat, custom_logic.KarmaEvent):
                 # was this page already proceed during last hour with the same reason?
                 if Threat.event_type == 'reindex':
-                    existence = sql_connector_instance_elisa_db.select_existence_id_from_karma_events(xwd_fullname=Threat.info_tuple[5], event_type=Threat.info_tuple[2], created_date=Threat.info_tuple[3])
+                    if covered_reindex_threats is not None:
+                        existence = Threat in covered_reindex_threats
+                    else:
+                        # the batch check has failed, asking for every threat
+                        existence = sql_connector_instance_func.select_existence_id_from_karma_events(xwd_fullname=Threat.info_tuple[5], event_type=Threat.info_tuple[2], created_date=Threat.info_tuple[3])
+                    routed_event_key = (Threat.info_tuple[5], Threat.info_tuple[2])
+                    if existence is False:
+                        # notifications of this cycle are not sent yet, so they are not in DB
+                        for routed_created_date in routed_reindex_events.get(routed_event_key, ()):
+                            if custom_logic.datediff_hours(routed_created_date, Threat.info_tuple[3]) <= 1:
+                                existence = True
+                                break
+                    if existence is False:
+                        routed_reindex_events.setdefault(routed_event_key, []).append(Threat.info_tuple[3])
                 else:
                     existence = False
                 if existence is False:
@@ -758,13 +440,9 @@ def main_execution(sql_connector_instance_func, teams_channels_inst_func):
                             bug_components_array = sql_connector_instance_karma_db.select_bug_components_from_dbo_knownbugs(page_id=karma_page_id)
                             if 'CloudConnect' in bug_components_array:
                                 MainLogger.debug('It\'s a VCC bug, notifying an extra channel')
-                                result = custom_logic.send_notification_to_web_hook(
-                                    web_hook_url=teams_channels_inst_func.webhooks_dict['WWW VCC'],
-                                    threat=Threat)
-                                if result is not True:
-                                    MainLogger.error(
-                                        'Failed to send notification to ' + str(Threat.target_notification_channel))
-                    channel_notification_sequence(Threat.target_notification_channel, sql_connector_instance_func, Threat)
+                                notification_dispatcher.enqueue(teams_channels_inst_func.webhooks_dict['WWW VCC'], Threat,
+                                                                acknowledge=False)
+                    notification_dispatcher.enqueue(Threat.target_notification_channel, Threat)
                 else:
                     # The same event was already fired, no need to repeat
                     result = sql_connector_instance_func.update_dbo_karma_events_after_notification_sent(
@@ -776,14 +454,42 @@ def main_execution(sql_connector_instance_func, teams_channels_inst_func):
         except Exception as error:
             MainLogger.error('Some unknown error has occurred: \n' + str(error))
             exit()
-    other_time.sleep(Query_Delay)
+    #   C2: sending, channels are notified in parallel, every channel in the routing order
+    if notification_outbox is not None:
+        outbox_notification_sequence(notification_outbox, sql_connector_instance_func, notification_dispatcher)
+    elif notification_dispatcher.pending() > 0:
+        MainLogger.info('Sending ' + str(notification_dispatcher.pending()) + ' notification(s)')
+        notification_dispatcher.dispatch(
+            lambda channel, threat, acknowledge: deliver_notification(channel, sql_connector_instance_func, threat, acknowledge),
+            lambda channel, threats: digest_notification_sequence(channel, sql_connector_instance_func, threats))
+    if sql_connector_instance_func.flush_acknowledgements() is not True:
+        MainLogger.critical('Failed to mark sent threats in DB, they will be retried on the next flush')
+    MainLogger.debug('KarmaDB pool metrics: ' + str(custom_logic.get_karma_db_pool().get_metrics()))
+    deferred_sends = custom_logic.webhook_transport.rate_limiter.take_deferred_sends()
+    if len(deferred_sends) > 0:
+        channel_names = {web_hook_url: name for name, web_hook_url in teams_channels_inst_func.webhooks_dict.items()}
+        MainLogger.info('Deferred sends by channel since the previous dispatch: ' + ', '.join(
+            str(channel_names.get(web_hook_url, web_hook_url)) + ': ' + str(count) for web_hook_url, count in deferred_sends.items()))
+    MainLogger.debug('Scheduler metrics: ' + str(job_scheduler.get_metrics()))
+
+
+def deliver_notification(target_notification_channel, sql_connector_instance_func, threat, acknowledge: bool=True):
+    if acknowledge is True:
+        return channel_notification_sequence(target_notification_channel, sql_connector_instance_func, threat)
+    logger_inst = logging.getLogger()
+    result = custom_logic.send_notification_to_web_hook(web_hook_url=target_notification_channel, threat=threat,
+                                                        xwiki_config=configuration_snapshot.xwiki_config)
+    if result is not True:
+        logger_inst.error('Failed to send notification to ' + str(target_notification_channel))
+    return result
 
 
 def channel_notification_sequence(target_notification_channel, sql_connector_instance_func, threat):
     logger_inst = logging.getLogger()
     result = custom_logic.send_notification_to_web_hook(
         web_hook_url=target_notification_channel,
-        threat=threat)
+        threat=threat,
+        xwiki_config=configuration_snapshot.xwiki_config)
     if result is not True:
         logger_inst.error(
             'Failed to send notification to ' + str(target_notification_channel))
@@ -803,13 +509,90 @@ def channel_notification_sequence(target_notification_channel, sql_connector_ins
             return True
 
 
-try:
-    while True:
-        main_execution(sql_connector_instance_func=sql_connector_instance_elisa_db, teams_channels_inst_func=teams_channels_inst)
+def outbox_notification_sequence(notification_outbox_func: outbox.NotificationOutbox, sql_connector_instance_func,
+                                 notification_dispatcher: custom_logic.NotificationDispatcher):
+    logger_inst = logging.getLogger()
+    inserted = 0
+    deliveries = notification_dispatcher.take_pending()
+    # every threat routed in this cycle replaces its pending entries for the channels it is no longer routed to
+    routed_channels = {}
+    for delivery in deliveries:
+        routed_channels.setdefault(id(delivery.threat), set()).add(delivery.channel)
+    for delivery in deliveries:
+        state = notification_outbox_func.put(delivery.channel, delivery.threat, acknowledge=delivery.acknowledge,
+                                             routed_channels=routed_channels[id(delivery.threat)])
+        if state == 'inserted':
+            inserted += 1
+        elif state == 'sent' and delivery.acknowledge is True:
+            # it was sent already, but the row was not marked before a restart
+            if isinstance(delivery.threat, custom_logic.CaseSLA):
+                result = sql_connector_instance_func.update_dbo_cases_after_notification_sent(
+                    row_id=delivery.threat.info_tuple[1])
+            else:
+                result = sql_connector_instance_func.update_dbo_karma_events_after_notification_sent(
+                    row_id=delivery.threat.info_tuple[1])
+            if result is not True:
+                logger_inst.critical('Failed to update DB around row:' + str(delivery.threat.info_tuple[1]))
+    if inserted > 0:
+        logger_inst.info('Stored ' + str(inserted) + ' notification(s) in the outbox')
 
-except simple_salesforce.exceptions.SalesforceExpiredSession:
-    sf_config_inst = SFConfig()
-    SF_connection = Salesforce(username=sf_config_inst.user, password=sf_config_inst.password,
-                               security_token=sf_config_inst.token)
 
+def digest_notification_sequence(target_notification_channel, sql_connector_instance_func, threats: list):
+    logger_inst = logging.getLogger()
+    result = custom_logic.send_digest_notification_to_web_hook(web_hook_url=target_notification_channel, threats=threats)
+    if result is not True:
+        logger_inst.error(
+            'Failed to send digest of ' + str(len(threats)) + ' threat(s) to ' + str(target_notification_channel))
+        return False
+    row_ids = [threat.info_tuple[1] for threat in threats]
+    result = sql_connector_instance_func.update_dbo_cases_after_digest_sent(row_ids=row_ids)
+    if result is not True:
+        logger_inst.critical('Failed to update DB around rows:' + ', '.join(str(row_id) for row_id in row_ids))
+        return False
+    logger_inst.info('Digest of ' + str(len(threats)) + ' threat(s) processed, ' + str(target_notification_channel) +
+                     ' was notified')
+    return True
 
+
+if notification_outbox is not None:
+    outbox_delivery_worker = outbox.OutboxDeliveryWorker(
+        notification_outbox=notification_outbox,
+        dispatcher_factory=lambda: custom_logic.NotificationDispatcher(max_workers=DISPATCHER_WORKERS,
+                                                                       digest_threshold=DIGEST_THRESHOLD),
+        deliver=lambda channel, threat, acknowledge: deliver_notification(
+            channel, sql_connector_instance_elisa_db_outbox, threat, acknowledge),
+        deliver_digest=lambda channel, threats: digest_notification_sequence(
+            channel, sql_connector_instance_elisa_db_outbox, threats),
+        after_batch=sql_connector_instance_elisa_db_outbox.flush_acknowledgements,
+        refresh_case_threats=lambda threats: custom_logic.refresh_current_sla_of_threats(sf_connection=SF_connection,
+                                                                                         threats=threats))
+    outbox_delivery_worker.start()
+else:
+    outbox_delivery_worker = None
+# every source has its own cadence, a run is planned from the previous planned run and not from its end
+job_scheduler = scheduler.Scheduler()
+if PROCEED_WITH_SLA_RULES is True:
+    job_scheduler.add_job('A rules', lambda: a_rules_stage(teams_channels_inst_func=teams_channels_inst),
+                          interval=A_RULES_INTERVAL, jitter=A_RULES_JITTER)
+if PROCEED_WITH_SLA_RULES is True and streaming_case_ingestor is not None:
+    streaming_case_listener.start()
+    job_scheduler.add_job('Case streaming', case_streaming_stage, interval=CASE_STREAMING_INTERVAL)
+if PROCEED_WITH_KARMA_EVENTS_RULES is True:
+    job_scheduler.add_job('Karma event rules', karma_event_rules_stage,
+                          interval=KARMA_EVENT_RULES_INTERVAL, jitter=KARMA_EVENT_RULES_JITTER)
+if len(BACKLOG_RULE_TEAMS) > 0:
+    job_scheduler.add_job('Backlog rule', lambda: backlog_rule_stage(teams_channels_inst_func=teams_channels_inst),
+                          interval=BACKLOG_RULE_INTERVAL, jitter=BACKLOG_RULE_JITTER)
+job_scheduler.add_job('Dispatch', lambda: dispatch_stage(sql_connector_instance_func=sql_connector_instance_elisa_db,
+                                                         teams_channels_inst_func=teams_channels_inst),
+                      interval=DISPATCH_INTERVAL, jitter=DISPATCH_JITTER, first_run_delay=DISPATCH_FIRST_RUN_DELAY)
+try:
+    job_scheduler.run_forever()
+finally:
+    if streaming_case_listener is not None and streaming_case_listener.is_alive():
+        streaming_case_listener.stop(timeout=5)
+    if outbox_delivery_worker is not None:
+        outbox_delivery_worker.stop(timeout=60)
+        sql_connector_instance_elisa_db_outbox.flush_acknowledgements()
+    # notifications which were already delivered must not be sent again after a restart
+    sql_connector_instance_elisa_db.flush_acknowledgements()
@@ -0,0 +1,283 @@
+import sqlite3
+import pickle
+import threading
+import logging
+import time
+from collections import namedtuple
+import custom_logic
+
+
+OutboxEntry = namedtuple('OutboxEntry', ['id', 'channel', 'kind', 'row_id', 'acknowledge', 'threat', 'attempts'])
+
+OUTBOX_SCHEMA_VERSION = 1
+OUTBOX_COLUMNS = 'id, channel, kind, row_id, acknowledge, threat, state, attempts, available_at, created_at, updated_at'
+
+
+class NotificationOutbox(object):
+    def __init__(self, path: str, sent_retention: float = 86400, retry_delay: float = 5, max_retry_delay: float = 300,
+                 max_attempts: int = 10):
+        # routing decisions are stored here before they are sent, so pending notifications survive a restart;
+        # (channel, kind, row_id) is unique, a threat routed again while it waits or after it was sent is not sent twice;
+        # states: pending -> sent, or broken after max_attempts failures, or superseded/expired without a send
+        self.path = path
+        self.sent_retention = sent_retention
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.new_entries = threading.Event()
+        self.logging_inst = logging.getLogger()
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        schema_version = self.connection.execute('PRAGMA user_version').fetchone()[0]
+        if schema_version < 1 and self.connection.execute(
+                'SELECT COUNT(*) FROM sqlite_master WHERE type = \'table\' AND name = \'outbox\'').fetchone()[0] > 0:
+            # version 0 has declared row_id as INTEGER, the GUIDs of ELISA DB are kept as they are
+            self.connection.execute('ALTER TABLE outbox RENAME TO outbox_v0')
+            self.connection.execute('DROP INDEX IF EXISTS outbox_state_available_at')
+            self.create_table()
+            self.connection.execute('INSERT INTO outbox (' + OUTBOX_COLUMNS + ') SELECT ' + OUTBOX_COLUMNS + ' FROM outbox_v0')
+            self.connection.execute('DROP TABLE outbox_v0')
+        else:
+            self.create_table()
+        self.connection.execute('PRAGMA user_version = ' + str(OUTBOX_SCHEMA_VERSION))
+        self.connection.commit()
+
+    def create_table(self):
+        self.connection.execute('CREATE TABLE IF NOT EXISTS outbox ('
+                                'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                                'channel TEXT NOT NULL, '
+                                'kind TEXT NOT NULL, '
+                                'row_id TEXT NOT NULL, '
+                                'acknowledge INTEGER NOT NULL, '
+                                'threat BLOB NOT NULL, '
+                                'state TEXT NOT NULL DEFAULT \'pending\', '
+                                'attempts INTEGER NOT NULL DEFAULT 0, '
+                                'available_at REAL NOT NULL, '
+                                'created_at REAL NOT NULL, '
+                                'updated_at REAL NOT NULL, '
+                                'UNIQUE (channel, kind, row_id))')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS outbox_state_available_at ON outbox (state, available_at)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS outbox_kind_row_id ON outbox (kind, row_id)')
+
+    @staticmethod
+    def get_kind(threat: custom_logic.Threat) -> str:
+        if isinstance(threat, custom_logic.CaseSLA):
+            return 'case'
+        if isinstance(threat, custom_logic.KarmaEvent):
+            return 'karma_event'
+        raise ValueError('Threat type ' + str(type(threat)) + ' is not supported')
+
+    def put(self, channel: str, threat: custom_logic.Threat, acknowledge: bool = True, routed_channels=None) -> str:
+        # returns 'inserted' for a new entry, otherwise the state of the entry stored earlier;
+        # routed_channels are all channels the threat is routed to now, its pending entries for other channels are
+        # superseded, e.g. a case which has moved to another rule band while it was waiting
+        kind = self.get_kind(threat)
+        row_id = str(threat.info_tuple[1])
+        threat_blob = pickle.dumps(threat, protocol=pickle.HIGHEST_PROTOCOL)
+        now = time.time()
+        with self.lock:
+            if routed_channels is not None:
+                routed_channels = list(routed_channels)
+                superseded = self.connection.execute(
+                    'UPDATE outbox SET state = \'superseded\', updated_at = ? '
+                    'WHERE kind = ? AND row_id = ? AND state = \'pending\' AND channel NOT IN (' +
+                    ', '.join('?' * len(routed_channels)) + ')', [now, kind, row_id] + routed_channels).rowcount
+                if superseded > 0:
+                    self.logging_inst.info('Outbox: ' + str(superseded) + ' pending notification(s) of ' + kind + ' ' +
+                                           row_id + ' superseded by a new routing')
+            cursor = self.connection.execute(
+                'INSERT OR IGNORE INTO outbox (channel, kind, row_id, acknowledge, threat, available_at, created_at, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (channel, kind, row_id, int(acknowledge), threat_blob, now, now, now))
+            if cursor.rowcount == 1:
+                answer = 'inserted'
+            else:
+                answer = self.connection.execute('SELECT state FROM outbox WHERE channel = ? AND kind = ? AND row_id = ?',
+                                                 (channel, kind, row_id)).fetchone()[0]
+                if answer in ('pending', 'superseded'):
+                    # the waiting entry gets the threat as it was routed now, a superseded one is routed here again
+                    self.connection.execute('UPDATE outbox SET state = \'pending\', acknowledge = ?, threat = ?, updated_at = ? '
+                                            'WHERE channel = ? AND kind = ? AND row_id = ?',
+                                            (int(acknowledge), threat_blob, now, channel, kind, row_id))
+                    if answer == 'superseded':
+                        answer = 'inserted'
+            self.connection.commit()
+        if answer == 'inserted':
+            self.new_entries.set()
+        return answer
+
+    def claim(self, limit: int = 500) -> list:
+        # the worker is the only consumer, pending entries are not locked between claim and mark_*
+        answer = []
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT id, channel, kind, row_id, acknowledge, threat, attempts FROM outbox '
+                'WHERE state = \'pending\' AND available_at <= ? ORDER BY id LIMIT ?', (time.time(), limit)).fetchall()
+        for row in rows:
+            try:
+                threat = pickle.loads(row[5])
+            except Exception as error:
+                self.logging_inst.error('Failed to load outbox entry ' + str(row[0]) + ', dropping it: ' + str(error))
+                self.mark_broken(row[0])
+                continue
+            answer.append(OutboxEntry(id=row[0], channel=row[1], kind=row[2], row_id=row[3], acknowledge=bool(row[4]),
+                                      threat=threat, attempts=row[6]))
+        return answer
+
+    def mark_sent(self, entry_ids: list):
+        if len(entry_ids) == 0:
+            return
+        now = time.time()
+        with self.lock:
+            self.connection.executemany('UPDATE outbox SET state = \'sent\', updated_at = ? WHERE id = ?',
+                                        [(now, entry_id) for entry_id in entry_ids])
+            self.connection.commit()
+
+    def mark_failed(self, entries: list):
+        # failed entries stay pending, the next attempt is delayed exponentially; after max_attempts they are broken
+        if len(entries) == 0:
+            return
+        now = time.time()
+        broken = [entry for entry in entries if entry.attempts + 1 >= self.max_attempts]
+        with self.lock:
+            self.connection.executemany(
+                'UPDATE outbox SET attempts = attempts + 1, available_at = ?, updated_at = ? WHERE id = ?',
+                [(now + min(self.max_retry_delay, self.retry_delay * 2 ** entry.attempts), now, entry.id) for entry in entries])
+            self.connection.executemany('UPDATE outbox SET state = \'broken\' WHERE id = ?', [(entry.id,) for entry in broken])
+            self.connection.commit()
+        for entry in broken:
+            self.logging_inst.error('Outbox: notification of ' + entry.kind + ' ' + str(entry.row_id) + ' to ' +
+                                    str(entry.channel) + ' has failed ' + str(entry.attempts + 1) + ' time(s), giving up')
+
+    def mark_broken(self, entry_id: int):
+        with self.lock:
+            self.connection.execute('UPDATE outbox SET state = \'broken\', updated_at = ? WHERE id = ?', (time.time(), entry_id))
+            self.connection.commit()
+
+    def mark_expired(self, entry_ids: list):
+        # the notification is outdated, it is dropped without a send
+        if len(entry_ids) == 0:
+            return
+        now = time.time()
+        with self.lock:
+            self.connection.executemany('UPDATE outbox SET state = \'expired\', updated_at = ? WHERE id = ?',
+                                        [(now, entry_id) for entry_id in entry_ids])
+            self.connection.commit()
+
+    def purge(self) -> int:
+        with self.lock:
+            cursor = self.connection.execute('DELETE FROM outbox WHERE state <> \'pending\' AND updated_at < ?',
+                                             (time.time() - self.sent_retention,))
+            self.connection.commit()
+        return cursor.rowcount
+
+    def pending(self) -> int:
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM outbox WHERE state = \'pending\'').fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class OutboxDeliveryWorker(threading.Thread):
+    def __init__(self, notification_outbox: NotificationOutbox, dispatcher_factory, deliver, deliver_digest=None,
+                 after_batch=None, refresh_case_threats=None, poll_interval: float = 5, batch_size: int = 500,
+                 purge_interval: float = 3600):
+        # drains the outbox continuously, every batch is sent through a NotificationDispatcher from dispatcher_factory;
+        # refresh_case_threats(threats) loads the current SLA of the stored cases before they are sent
+        threading.Thread.__init__(self, name='OutboxDeliveryWorker', daemon=True)
+        self.notification_outbox = notification_outbox
+        self.dispatcher_factory = dispatcher_factory
+        self.deliver = deliver
+        self.deliver_digest = deliver_digest
+        self.after_batch = after_batch
+        self.refresh_case_threats = refresh_case_threats
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.purge_interval = purge_interval
+        self.last_purge = 0
+        self.stopping = threading.Event()
+        self.logging_inst = logging.getLogger()
+
+    def stop(self, timeout: float = None):
+        self.stopping.set()
+        self.notification_outbox.new_entries.set()
+        self.join(timeout)
+
+    def run(self):
+        while self.stopping.is_set() is not True:
+            try:
+                delivered = self.deliver_batch()
+            except Exception as error:
+                self.logging_inst.error('Outbox delivery has failed due to the following error \n' + str(error))
+                delivered = 0
+            if time.monotonic() - self.last_purge >= self.purge_interval:
+                self.last_purge = time.monotonic()
+                try:
+                    purged = self.notification_outbox.purge()
+                    if purged > 0:
+                        self.logging_inst.debug('Purged ' + str(purged) + ' outbox entries')
+                except sqlite3.Error as error:
+                    self.logging_inst.error('Failed to purge the outbox: ' + str(error))
+            if delivered == 0:
+                self.notification_outbox.new_entries.wait(self.poll_interval)
+                self.notification_outbox.new_entries.clear()
+
+    def deliver_batch(self) -> int:
+        entries = self.notification_outbox.claim(limit=self.batch_size)
+        if len(entries) == 0:
+            return 0
+        claimed = len(entries)
+        entries = self.refresh_cases(entries)
+        if len(entries) == 0:
+            return claimed
+        self.logging_inst.info('Sending ' + str(len(entries)) + ' notification(s) from the outbox')
+        dispatcher = self.dispatcher_factory()
+        entries_by_delivery = {}
+        for entry in entries:
+            dispatcher.enqueue(entry.channel, entry.threat, acknowledge=entry.acknowledge)
+            entries_by_delivery[(entry.channel, id(entry.threat), entry.acknowledge)] = entry
+        sent_ids = []
+        failed = []
+        for delivery, result in dispatcher.dispatch(self.deliver, self.deliver_digest):
+            if isinstance(delivery, custom_logic.DigestDelivery):
+                delivery_entries = [entries_by_delivery[(delivery.channel, id(threat), True)] for threat in delivery.threats]
+            else:
+                delivery_entries = [entries_by_delivery[(delivery.channel, id(delivery.threat), delivery.acknowledge)]]
+            if result is True:
+                sent_ids += [entry.id for entry in delivery_entries]
+            else:
+                failed += delivery_entries
+        self.notification_outbox.mark_sent(sent_ids)
+        self.notification_outbox.mark_failed(failed)
+        if self.after_batch is not None:
+            self.after_batch()
+        return claimed
+
+    def refresh_cases(self, entries: list) -> list:
+        # the SLA stored with a case is the one it had when it was routed, cases are sent with the current one;
+        # returns the entries to send, the cases whose SLA window has passed are expired
+        case_entries = [entry for entry in entries if entry.kind == 'case']
+        if self.refresh_case_threats is None or len(case_entries) == 0:
+            return entries
+        for entry in case_entries:
+            entry.threat.current_SLA = None
+            entry.threat.current_SLA_loaded = False
+        try:
+            self.refresh_case_threats([entry.threat for entry in case_entries])
+        except Exception as error:
+            self.logging_inst.error('Failed to refresh SLA of ' + str(len(case_entries)) + ' outbox case(s), '
+                                    'they will be retried: ' + str(error))
+            self.notification_outbox.mark_failed(case_entries)
+            return [entry for entry in entries if entry.kind != 'case']
+        # a case which is not found or has no SLA left is too late, as in the dispatching of the main loop
+        expired = [entry for entry in case_entries
+                   if entry.threat.current_SLA_loaded is not True or entry.threat.current_SLA is None]
+        if len(expired) > 0:
+            self.logging_inst.info('Outbox: ' + str(len(expired)) + ' case notification(s) dropped, it\'s too late')
+            self.notification_outbox.mark_expired([entry.id for entry in expired])
+        expired_ids = set(entry.id for entry in expired)
+        return [entry for entry in entries if entry.id not in expired_ids]
@@ -0,0 +1,235 @@
+import logging
+import time
+from collections import namedtuple
+from datetime import datetime
+
+
+# queue groups of CO/pCOQ used by the A rules
+EMEA_QUEUES = frozenset(['Tier 1 - Europe',
+                         'Tier Russian',
+                         'Tier 2 - EM:Europe',
+                         'Tier 3 - EM: EMEA'])
+APJ_QUEUES = frozenset(['Tier 1 - APAC',
+                        'Tier Chinese',
+                        'Tier Japanese'])
+APJ_PORTUGUESE_QUEUES = APJ_QUEUES | frozenset(['Tier Portuguese'])
+US_QUEUES = frozenset(['Tier 1 - North America',
+                       'Tier 1 - South America',
+                       'Tier 1 - US Federal',
+                       'Tier 2 - EM:Americas',
+                       'Tier 3 - EM:Americas'])
+A1_SHIFT_QUEUES = frozenset(['Tier 1 - Europe',
+                             'Tier Russian',
+                             'Tier Portuguese',
+                             'Tier 1 - APAC',
+                             'Tier 1 - North America',
+                             'Tier 1 - South America',
+                             'Tier 1 - US Federal',
+                             'Tier Chinese',
+                             'Tier Dutch',
+                             'Tier Japanese'])
+
+# pCOQ is tested if the case has it, CO otherwise; a few rules use different queues for them
+OwnerGroup = namedtuple('OwnerGroup', ['pcoq_queues', 'co_queues'])
+# channel is a name from TeamsChannels.webhooks_dict, DEFAULT_CHANNEL or a ShiftChannel;
+# the route is skipped if the owner is in unless_owner_in
+Route = namedtuple('Route', ['channel', 'unless_owner_in'])
+# owners from owner_group go to the fixed channel or to the channel of the current shift, others to DEFAULT_CHANNEL
+ShiftChannel = namedtuple('ShiftChannel', ['owner_group', 'fixed_channel'])
+CompiledRoute = namedtuple('CompiledRoute', ['channel_name', 'shift_owner_group', 'unless_owner_in'])
+RoutingDecision = namedtuple('RoutingDecision', ['rule_band', 'rule_logic_style', 'co', 'pcoq', 'channel_names'])
+
+DEFAULT_CHANNEL = 'default channel'  # Threat.target_notification_channel, it contains cloud and agent logic
+FALLBACK_CHANNEL = 'Test channel'
+
+EMEA = OwnerGroup(EMEA_QUEUES, EMEA_QUEUES)
+APJ = OwnerGroup(APJ_QUEUES, APJ_QUEUES)
+APJ_PORTUGUESE = OwnerGroup(APJ_PORTUGUESE_QUEUES, APJ_PORTUGUESE_QUEUES)
+US = OwnerGroup(US_QUEUES, US_QUEUES)
+A1_SHIFT = OwnerGroup(A1_SHIFT_QUEUES, A1_SHIFT_QUEUES)
+
+# (rule band, rule logic style) -> routes in the notification order
+ROUTING_RULES = {
+    ('A1', 'APJ + EMEA'): (Route('Support.Worldwide / APAC - Cases and Calls', EMEA),
+                           Route(ShiftChannel(A1_SHIFT, 'Case shift 1'), APJ)),
+    ('A1', 'EMEA'): (Route(ShiftChannel(A1_SHIFT, None), None),),
+    ('A1', 'EMEA + US'): (Route('Support.Worldwide / NA - Cases', EMEA),
+                          Route(ShiftChannel(A1_SHIFT, None), US)),
+    ('A1', 'US'): (Route('Support.Worldwide / NA - Cases', None),),
+    ('A1', 'US + APJ'): (Route('Support.Worldwide / NA - Cases', APJ),
+                         Route('Support.Worldwide / APAC - Cases and Calls', US)),
+    ('A1', 'APJ'): (Route('Support.Worldwide / APAC - Cases and Calls', None),),
+    ('A1', 'Weekend EMEA'): (Route('Tier1 EMEA / Weekend channel', None),),
+    ('A1', 'Weekend US'): (Route('Support.Worldwide / NA - Cases', None),),
+    ('A2', 'APJ + EMEA'): (Route('Support.Worldwide / APAC - Cases and Calls', EMEA),
+                           Route('Tier 1 EMEA / Administrative', APJ_PORTUGUESE)),
+    ('A2', 'EMEA'): (Route('Tier 1 EMEA / Administrative', None),),
+    ('A2', 'EMEA + US'): (Route('Support.Worldwide / NA - Cases', EMEA),
+                          Route('Tier 1 EMEA / Administrative', OwnerGroup(APJ_QUEUES, APJ_PORTUGUESE_QUEUES))),
+    ('A2', 'US'): (Route('Support.Worldwide / NA - Cases', None),),
+    ('A2', 'US + APJ'): (Route('Support.Worldwide / NA - Cases', APJ),
+                         Route('Support.Worldwide / APAC - Cases and Calls', US)),
+    ('A2', 'APJ'): (Route('Support.Worldwide / APAC - Cases and Calls', None),),
+    ('A2', 'Weekend EMEA'): (Route('Support.Worldwide / Weekend Cases', None),),
+    ('A2', 'Weekend US'): (Route('Support.Worldwide / Weekend Cases', None),),
+}
+# A3 goes to the management regardless of the time
+A3_ROUTES = (Route('Management.Worldwide / General', None),)
+
+# (start, end, channel) in UTC, 7:30am - 7:30pm GMT+3
+CASE_SHIFTS = (((4, 30), (8, 30), 'Case shift 1'),
+               ((8, 30), (10, 30), 'Case shift 2'),
+               ((10, 30), (12, 30), 'Case shift 3'),
+               ((12, 30), (16, 30), 'Case shift 4'))
+
+
+class RoutingIndex(object):
+    def __init__(self, sf_queues_inst, teams_channels_inst):
+        # built once from SFQueues and TeamsChannels, shared by the ingestion and the dispatching of cases;
+        # if several queues share an OwnerId, the first one in queue_dict wins as it did in the linear search
+        self.queue_name_by_owner_id = {}
+        for queue_name, owner_id in sf_queues_inst.queue_dict.items():
+            self.queue_name_by_owner_id.setdefault(owner_id, queue_name)
+        # product -> (product kind, channel name), monitor products win over agent products
+        self.product_channels = {}
+        for product in sf_queues_inst.agent_products:
+            self.product_channels[product] = ('Agent', 'Tier 1 - Agents')
+        for product in sf_queues_inst.monitor_products:
+            self.product_channels[product] = ('Monitor', 'Tier 2 - EM:Europe')
+        self.webhooks_dict = teams_channels_inst.webhooks_dict
+
+    def get_queue_name(self, owner_id: str):
+        return self.queue_name_by_owner_id.get(owner_id)
+
+    def get_product_channel(self, product: str):
+        # (product kind, channel name) or None if the product has no dedicated channel
+        return self.product_channels.get(product)
+
+
+def get_rule_logic_style(utc_current_time: datetime) -> str:
+    logger_inst = logging.getLogger()
+    if utc_current_time.date().weekday() in (5, 6):  # weekend shifts
+        utc_current_date = utc_current_time.date()
+        utc_11_march = utc_current_date.replace(month=3, day=11)
+        utc_04_november = utc_current_date.replace(month=11, day=4)
+        if utc_04_november <= utc_current_date < utc_11_march:
+            logger_inst.debug('Checking time, now is after 04.11 and before 11.03, dls = winter')
+            weekend_emea_shift_start = utc_current_time.replace(hour=4, minute=30)
+            weekend_emea_shift_end = utc_current_time.replace(hour=16, minute=30)
+        elif utc_11_march <= utc_current_date < utc_04_november:
+            logger_inst.debug('Checking time, now is after 11.03 and before 04.11, dls = summer')
+            weekend_emea_shift_start = utc_current_time.replace(hour=5, minute=00)
+            weekend_emea_shift_end = utc_current_time.replace(hour=17, minute=00)
+        else:
+            #  just in case...
+            weekend_emea_shift_start = utc_current_time.replace(hour=5, minute=00)
+            weekend_emea_shift_end = utc_current_time.replace(hour=17, minute=00)
+        if weekend_emea_shift_start <= utc_current_time < weekend_emea_shift_end:
+            return 'Weekend EMEA'
+        return 'Weekend US'
+    utc_current_time_hour = utc_current_time.hour
+    if 5 <= utc_current_time_hour < 7:  # t0,  APJ + EMEA
+        return 'APJ + EMEA'
+    elif 7 <= utc_current_time_hour < 12:  # t1,  EMEA
+        return 'EMEA'
+    elif 12 <= utc_current_time_hour < 17:  # t2,  EMEA + US
+        return 'EMEA + US'
+    elif 17 <= utc_current_time_hour < 23:  # t3,  US
+        return 'US'
+    elif 23 <= utc_current_time_hour:  # t4,  US + APJ
+        return 'US + APJ'
+    return 'APJ'  # t5, 0 <= utc_current_time_hour < 5
+
+
+def get_case_shift_channel(utc_current_time: datetime):
+    # None outside of the case shifts
+    for (start_hour, start_minute), (end_hour, end_minute), channel_name in CASE_SHIFTS:
+        shift_start = utc_current_time.replace(hour=start_hour, minute=start_minute, second=0, microsecond=0)
+        shift_end = utc_current_time.replace(hour=end_hour, minute=end_minute, second=0, microsecond=0)
+        if shift_start <= utc_current_time < shift_end:
+            return channel_name
+    return None
+
+
+def is_owner_in(owner_group: OwnerGroup, co: str, pcoq: str) -> bool:
+    if pcoq is not None:
+        return pcoq in owner_group.pcoq_queues
+    return co in owner_group.co_queues
+
+
+class CaseRouter(object):
+    def __init__(self, webhooks_dict: dict, rule_logic_style: str, utc_current_time: datetime, rule_a2: int, rule_a3: int):
+        # the rule table is resolved for one cycle: the style and the case shift are fixed, routing a case is a dict lookup
+        self.webhooks_dict = webhooks_dict
+        self.rule_logic_style = rule_logic_style
+        self.rule_a2 = rule_a2
+        self.rule_a3 = rule_a3
+        self.case_shift_channel = get_case_shift_channel(utc_current_time)
+        self.routes_by_band = {'A3': self.compile_routes(A3_ROUTES)}
+        for rule_band in ('A1', 'A2'):
+            routes = ROUTING_RULES.get((rule_band, rule_logic_style))
+            if routes is not None:
+                self.routes_by_band[rule_band] = self.compile_routes(routes)
+
+    def compile_routes(self, routes: tuple) -> tuple:
+        answer = []
+        for route in routes:
+            if isinstance(route.channel, ShiftChannel):
+                if route.channel.fixed_channel is not None:
+                    channel_name = route.channel.fixed_channel
+                elif self.case_shift_channel is not None:
+                    channel_name = self.case_shift_channel
+                else:
+                    channel_name = DEFAULT_CHANNEL
+                answer.append(CompiledRoute(channel_name, route.channel.owner_group, route.unless_owner_in))
+            else:
+                answer.append(CompiledRoute(route.channel, None, route.unless_owner_in))
+        return tuple(answer)
+
+    def get_rule_band(self, current_sla: int, row_id) -> str:
+        if current_sla > self.rule_a2 and row_id:
+            return 'A1'
+        if self.rule_a2 >= current_sla > self.rule_a3:
+            return 'A2'
+        if current_sla <= self.rule_a3:
+            return 'A3'
+        return None
+
+    def route(self, rule_band: str, co: str, pcoq: str) -> list:
+        # returns channel names in the notification order, DEFAULT_CHANNEL stands for the target channel of the case;
+        # an unknown style falls back to FALLBACK_CHANNEL
+        routes = self.routes_by_band.get(rule_band)
+        if routes is None:
+            return [FALLBACK_CHANNEL]
+        answer = []
+        for route in routes:
+            if route.unless_owner_in is not None and is_owner_in(route.unless_owner_in, co, pcoq):
+                continue
+            if route.shift_owner_group is not None and not is_owner_in(route.shift_owner_group, co, pcoq):
+                answer.append(DEFAULT_CHANNEL)
+            else:
+                answer.append(route.channel_name)
+        return answer
+
+    def get_webhook(self, channel_name: str, default_channel: str) -> str:
+        if channel_name == DEFAULT_CHANNEL:
+            return default_channel
+        return self.webhooks_dict[channel_name]
+
+
+def benchmark_case_router(decisions: list, webhooks_dict: dict, utc_current_time: datetime, rule_a2: int = 31,
+                          rule_a3: int = 10, repeat: int = 1000) -> float:
+    # checks the router against recorded decisions and returns the mean time of routing one case in seconds
+    routers = {}
+    for decision in decisions:
+        if decision.rule_logic_style not in routers:
+            routers[decision.rule_logic_style] = CaseRouter(webhooks_dict, decision.rule_logic_style, utc_current_time,
+                                                            rule_a2, rule_a3)
+        channel_names = routers[decision.rule_logic_style].route(decision.rule_band, decision.co, decision.pcoq)
+        if channel_names != list(decision.channel_names):
+            raise ValueError('Routing has changed for ' + str(decision) + ': ' + str(channel_names))
+    started_at = time.perf_counter()
+    for _ in range(repeat):
+        for decision in decisions:
+            routers[decision.rule_logic_style].route(decision.rule_band, decision.co, decision.pcoq)
+    return (time.perf_counter() - started_at) / max(1, repeat * len(decisions))
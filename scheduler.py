@@ -0,0 +1,116 @@
+import logging
+import random
+import time
+
+
+class ScheduledJob(object):
+    def __init__(self, name: str, function, interval: float, jitter: float = 0, first_run_delay: float = 0):
+        self.name = name
+        self.function = function
+        self.interval = interval
+        self.jitter = jitter
+        self.first_run_delay = first_run_delay
+        # the grid time of the next run, jitter is added on top of it and never accumulates
+        self.scheduled_at = None
+        self.due_at = None
+        self.runs = 0
+        self.failures = 0
+        self.skipped_runs = 0
+        self.last_lateness = 0.0
+        self.max_lateness = 0.0
+        self.total_lateness = 0.0
+        self.last_duration = 0.0
+
+    def get_metrics(self) -> dict:
+        return {'runs': self.runs,
+                'failures': self.failures,
+                'skipped_runs': self.skipped_runs,
+                'last_lateness': round(self.last_lateness, 3),
+                'max_lateness': round(self.max_lateness, 3),
+                'mean_lateness': round(self.total_lateness / self.runs, 3) if self.runs > 0 else 0.0,
+                'last_duration': round(self.last_duration, 3)}
+
+
+class Scheduler(object):
+    def __init__(self, clock=time.monotonic, sleep=time.sleep):
+        # single-threaded: jobs run one at a time, a job that is still due after a long run of another job starts late;
+        # runs are planned on a fixed grid from the first run, so the period does not drift with the run time
+        self.clock = clock
+        self.sleep = sleep
+        self.jobs = []
+        self.running = False
+        self.logging_inst = logging.getLogger()
+
+    def add_job(self, name: str, function, interval: float, jitter: float = 0, first_run_delay: float = 0) -> ScheduledJob:
+        job = ScheduledJob(name=name, function=function, interval=interval, jitter=jitter, first_run_delay=first_run_delay)
+        self.jobs.append(job)
+        return job
+
+    def start(self):
+        now = self.clock()
+        for job in self.jobs:
+            if job.scheduled_at is None:
+                job.scheduled_at = now + job.first_run_delay
+                job.due_at = job.scheduled_at + random.uniform(0, job.jitter)
+
+    def get_next_job(self) -> ScheduledJob:
+        # the earliest due job, jobs due at the same time run in the order they were added
+        answer = None
+        for job in self.jobs:
+            if answer is None or job.due_at < answer.due_at:
+                answer = job
+        return answer
+
+    def run_pending(self) -> int:
+        # runs every job which is due now, returns the number of runs
+        self.start()
+        answer = 0
+        while True:
+            job = self.get_next_job()
+            if job is None or job.due_at > self.clock():
+                return answer
+            self.run_job(job)
+            answer += 1
+
+    def run_forever(self):
+        self.running = True
+        self.start()
+        while self.running is True:
+            job = self.get_next_job()
+            if job is None:
+                return
+            delay = job.due_at - self.clock()
+            if delay > 0:
+                self.sleep(delay)
+            self.run_job(job)
+
+    def stop(self):
+        self.running = False
+
+    def run_job(self, job: ScheduledJob):
+        started_at = self.clock()
+        job.last_lateness = max(0.0, started_at - job.due_at)
+        job.max_lateness = max(job.max_lateness, job.last_lateness)
+        job.total_lateness += job.last_lateness
+        job.runs += 1
+        if job.last_lateness > job.interval:
+            self.logging_inst.warning('Job ' + job.name + ' has started ' + str(round(job.last_lateness, 1)) + 's late')
+        try:
+            job.function()
+        except Exception as error:
+            job.failures += 1
+            self.logging_inst.error('Job ' + job.name + ' has failed due to the following error \n' + str(error))
+        finished_at = self.clock()
+        job.last_duration = finished_at - started_at
+        # the runs which overlapped with this one are skipped, not queued
+        next_scheduled_at = job.scheduled_at + job.interval
+        if next_scheduled_at < finished_at:
+            missed_runs = int((finished_at - next_scheduled_at) // job.interval) + 1
+            job.skipped_runs += missed_runs
+            next_scheduled_at += missed_runs * job.interval
+            self.logging_inst.debug('Job ' + job.name + ': ' + str(missed_runs) + ' run(s) skipped due to overlap')
+        job.scheduled_at = next_scheduled_at
+        job.due_at = next_scheduled_at + random.uniform(0, job.jitter)
+
+    def get_metrics(self) -> dict:
+        return {job.name: job.get_metrics() for job in self.jobs}
@@ -0,0 +1,11 @@
+-- ELISA DB: the [date] of the newest Karma event seen per event type, kept by SQLConnectorELISADB.update_karma_watermarks
+-- [source] is the Karma event type, [updated] is the time of the last update
+IF OBJECT_ID('[dbo].[Karma_watermarks]', 'U') IS NULL
+BEGIN
+    CREATE TABLE [dbo].[Karma_watermarks] (
+        [source] nvarchar(255) NOT NULL,
+        [watermark] datetime NOT NULL,
+        [updated] datetime NOT NULL,
+        CONSTRAINT [PK_Karma_watermarks] PRIMARY KEY CLUSTERED ([source])
+    );
+END
@@ -0,0 +1,12 @@
+-- KarmaDB: top contributors of a page, read by SQLConnectorKARMADB.select_contribution_summary
+-- [summary] is a JSON list [[contributor, characters], ...] valid for the [characters_total] of the page it was made from;
+-- [KnownPageID] has the type of [dbo].[KnownPages].[id]
+IF OBJECT_ID('[dbo].[KnownPages_contribution_summary]', 'U') IS NULL
+BEGIN
+    CREATE TABLE [dbo].[KnownPages_contribution_summary] (
+        [KnownPageID] int NOT NULL,
+        [characters_total] int NOT NULL,
+        [summary] nvarchar(max) NOT NULL,
+        CONSTRAINT [PK_KnownPages_contribution_summary] PRIMARY KEY CLUSTERED ([KnownPageID])
+    );
+END
@@ -0,0 +1,351 @@
+import logging
+import threading
+import time
+import requests
+import custom_logic
+
+
+# PushTopic of the streaming mode: an event is fired when a case is created or one of these fields is changed;
+# Time_to_Respond__c is a formula and does not fire events, it is fetched and extrapolated by StreamingCaseIngestor
+PUSH_TOPIC_NAME = 'ElisaCases'
+PUSH_TOPIC_QUERY = "SELECT Id, Status, OwnerId, FTR_Case_Owner__c FROM Case"
+PUSH_TOPIC_CHANNEL = '/topic/' + PUSH_TOPIC_NAME
+CHANGE_DATA_CAPTURE_CHANNEL = '/data/CaseChangeEvent'
+REPLAY_NEW_EVENTS = -1
+REPLAY_ALL_EVENTS = -2
+
+
+class StreamingError(custom_logic.BotExpectedError):
+    """Raised when the Bayeux server has refused a request"""
+    pass
+
+
+class StreamingAuthenticationError(StreamingError):
+    """Raised when the session of the Bayeux transport is not valid anymore"""
+    pass
+
+
+def ensure_push_topic(sf_connection, name: str = PUSH_TOPIC_NAME, query: str = PUSH_TOPIC_QUERY, api_version: str = '43.0'):
+    found_topics = sf_connection.query("SELECT Id, Query FROM PushTopic WHERE Name = '" + name + "'")
+    if len(found_topics['records']) > 0:
+        if found_topics['records'][0]['Query'] != query:
+            sf_connection.PushTopic.update(found_topics['records'][0]['Id'], {'Query': query})
+        return found_topics['records'][0]['Id']
+    result = sf_connection.PushTopic.create({'Name': name,
+                                             'Query': query,
+                                             'ApiVersion': api_version,
+                                             'NotifyForOperationCreate': True,
+                                             'NotifyForOperationUpdate': True,
+                                             'NotifyForOperationUndelete': False,
+                                             'NotifyForOperationDelete': False,
+                                             'NotifyForFields': 'Referenced'})
+    return result['id']
+
+
+def get_case_ids_from_event(data: dict) -> list:
+    # PushTopic events carry the sobject, Change Data Capture events carry recordIds in the header
+    if 'sobject' in data:
+        return [data['sobject']['Id']]
+    if 'payload' in data:
+        return list(data['payload'].get('ChangeEventHeader', {}).get('recordIds', []))
+    return []
+
+
+class HTTPBayeuxTransport(object):
+    def __init__(self, sf_session_manager: custom_logic.SFSessionManager, timeout: float = 130):
+        # long-polling transport of the Salesforce CometD endpoint, the server holds /meta/connect up to 110 seconds
+        self.sf_session_manager = sf_session_manager
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def send(self, messages: list) -> list:
+        connection = self.sf_session_manager.connection
+        endpoint = 'https://' + connection.sf_instance + '/cometd/' + connection.sf_version
+        response = self.session.post(endpoint, json=messages, timeout=self.timeout,
+                                     headers={'Authorization': 'Bearer ' + connection.session_id})
+        if response.status_code == 401:
+            raise StreamingAuthenticationError('CometD session is not valid', {'endpoint': endpoint})
+        if response.status_code != requests.codes.ok:
+            raise StreamingError('CometD request has failed', {'endpoint': endpoint, 'status_code': response.status_code,
+                                                               'response': response.text[:500]})
+        return response.json()
+
+    def reauthenticate(self):
+        self.sf_session_manager.login()
+        # the CometD cookies belong to the old session
+        self.session.cookies.clear()
+
+
+class LocalBayeuxTransport(object):
+    def __init__(self, connect_timeout: float = 1):
+        # in-process stand-in of the Salesforce CometD endpoint, publish() an event and a client will receive it;
+        # events are retained with replay ids, a subscription replays them like the real endpoint does
+        self.connect_timeout = connect_timeout
+        self.condition = threading.Condition()
+        self.events = []
+        self.last_replay_id = 0
+        self.subscriptions = {}
+        self.client_count = 0
+
+    def publish(self, channel: str, data: dict) -> int:
+        with self.condition:
+            self.last_replay_id += 1
+            data = dict(data)
+            data['event'] = dict(data.get('event', {}), replayId=self.last_replay_id)
+            self.events.append((channel, data))
+            self.condition.notify_all()
+            return self.last_replay_id
+
+    def publish_case(self, case_id: str, event_type: str = 'updated', channel: str = PUSH_TOPIC_CHANNEL) -> int:
+        return self.publish(channel, {'event': {'type': event_type}, 'sobject': {'Id': case_id}})
+
+    def send(self, messages: list) -> list:
+        answer = []
+        for message in messages:
+            channel = message['channel']
+            if channel == '/meta/handshake':
+                with self.condition:
+                    self.client_count += 1
+                    client_id = 'local-' + str(self.client_count)
+                answer.append({'channel': channel, 'id': message.get('id'), 'clientId': client_id, 'successful': True,
+                               'version': '1.0', 'supportedConnectionTypes': ['long-polling'], 'ext': {'replay': True}})
+            elif channel == '/meta/subscribe':
+                subscription = message['subscription']
+                replay_id = message.get('ext', {}).get('replay', {}).get(subscription, REPLAY_NEW_EVENTS)
+                with self.condition:
+                    if replay_id == REPLAY_NEW_EVENTS:
+                        replay_id = self.last_replay_id
+                    elif replay_id == REPLAY_ALL_EVENTS:
+                        replay_id = 0
+                    self.subscriptions[(message['clientId'], subscription)] = replay_id
+                answer.append({'channel': channel, 'id': message.get('id'), 'clientId': message['clientId'],
+                               'subscription': subscription, 'successful': True})
+            elif channel == '/meta/connect':
+                answer += self.deliver(message['clientId'])
+                answer.append({'channel': channel, 'id': message.get('id'), 'clientId': message['clientId'],
+                               'successful': True, 'advice': {'reconnect': 'retry', 'interval': 0}})
+            else:
+                answer.append({'channel': channel, 'id': message.get('id'), 'successful': False,
+                               'error': '403::Unsupported channel'})
+        return answer
+
+    def deliver(self, client_id: str) -> list:
+        deadline = time.monotonic() + self.connect_timeout
+        with self.condition:
+            while True:
+                answer = []
+                for (subscribed_client_id, subscription), replay_id in self.subscriptions.items():
+                    if subscribed_client_id != client_id:
+                        continue
+                    for channel, data in self.events:
+                        if channel == subscription and data['event']['replayId'] > replay_id:
+                            answer.append({'channel': channel, 'data': data})
+                            replay_id = data['event']['replayId']
+                    self.subscriptions[(subscribed_client_id, subscription)] = replay_id
+                remaining = deadline - time.monotonic()
+                if len(answer) > 0 or remaining <= 0:
+                    return answer
+                self.condition.wait(remaining)
+
+    def reauthenticate(self):
+        pass
+
+
+class CometDClient(object):
+    def __init__(self, transport, channel: str, replay_id: int = REPLAY_NEW_EVENTS):
+        # minimal Bayeux long-polling client with the Salesforce replay extension
+        self.transport = transport
+        self.channel = channel
+        self.replay_id = replay_id
+        self.client_id = None
+        self.message_id = 0
+        self.logging_inst = logging.getLogger()
+
+    def next_message_id(self) -> str:
+        self.message_id += 1
+        return str(self.message_id)
+
+    def request(self, message: dict) -> list:
+        message['id'] = self.next_message_id()
+        if self.client_id is not None and message['channel'] != '/meta/handshake':
+            message['clientId'] = self.client_id
+        answer = self.transport.send([message])
+        for reply in answer:
+            if reply.get('channel') == message['channel'] and reply.get('successful') is not True:
+                error = str(reply.get('error'))
+                if error.startswith('401'):
+                    raise StreamingAuthenticationError('Bayeux request was refused', {'channel': message['channel'],
+                                                                                     'error': error})
+                if reply.get('advice', {}).get('reconnect') == 'handshake':
+                    self.client_id = None
+                raise StreamingError('Bayeux request has failed', {'channel': message['channel'], 'error': error})
+        return answer
+
+    def handshake(self):
+        self.client_id = None
+        answer = self.request({'channel': '/meta/handshake', 'version': '1.0', 'minimumVersion': '1.0',
+                               'supportedConnectionTypes': ['long-polling'], 'ext': {'replay': True}})
+        self.client_id = answer[0]['clientId']
+        # the subscription resumes from the last event received, nothing is lost between reconnects
+        self.request({'channel': '/meta/subscribe', 'subscription': self.channel,
+                      'ext': {'replay': {self.channel: self.replay_id}}})
+        self.logging_inst.info('Subscribed to ' + self.channel + ' from replay id ' + str(self.replay_id))
+
+    def poll(self) -> list:
+        # one long poll, returns the data of the received events
+        if self.client_id is None:
+            self.handshake()
+        answer = []
+        for reply in self.request({'channel': '/meta/connect', 'connectionType': 'long-polling'}):
+            if reply.get('channel') == self.channel and 'data' in reply:
+                answer.append(reply['data'])
+                replay_id = reply['data'].get('event', {}).get('replayId')
+                if replay_id is not None:
+                    self.replay_id = replay_id
+        return answer
+
+
+class StreamingCaseListener(threading.Thread):
+    def __init__(self, cometd_client: CometDClient, retry_delay: float = 5, max_retry_delay: float = 300):
+        # collects ids of changed cases in the background, StreamingCaseIngestor picks them up
+        threading.Thread.__init__(self, name='StreamingCaseListener', daemon=True)
+        self.cometd_client = cometd_client
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.changed_case_ids = set()
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.events_received = 0
+        self.logging_inst = logging.getLogger()
+
+    def run(self):
+        failures = 0
+        while self.stopping.is_set() is not True:
+            try:
+                events = self.cometd_client.poll()
+                failures = 0
+            except StreamingAuthenticationError as error:
+                self.logging_inst.info('Streaming session has expired, re-authenticating: ' + str(error))
+                failures += 1
+                try:
+                    self.cometd_client.transport.reauthenticate()
+                except Exception as error:
+                    self.logging_inst.error('Failed to re-authenticate the streaming session: ' + str(error))
+                self.cometd_client.client_id = None
+                self.stopping.wait(min(self.max_retry_delay, self.retry_delay * 2 ** (failures - 1)))
+                continue
+            except Exception as error:
+                failures += 1
+                self.logging_inst.error('Streaming of cases has failed, polling keeps working: ' + str(error))
+                self.cometd_client.client_id = None
+                self.stopping.wait(min(self.max_retry_delay, self.retry_delay * 2 ** (failures - 1)))
+                continue
+            if len(events) > 0:
+                with self.lock:
+                    self.events_received += len(events)
+                    for data in events:
+                        self.changed_case_ids.update(get_case_ids_from_event(data))
+
+    def take_changed_case_ids(self) -> list:
+        with self.lock:
+            answer = list(self.changed_case_ids)
+            self.changed_case_ids = set()
+        return answer
+
+    def stop(self, timeout: float = None):
+        self.stopping.set()
+        self.join(timeout)
+
+
+class StreamingCaseIngestor(object):
+    def __init__(self, listener: StreamingCaseListener, sql_connector_instance_elisa_db: custom_logic.SQLConnectorELISADB,
+                 teams_channels_inst, routing_index=None, watch_max_sla: int = 1440, reconciliation_interval: float = 300):
+        # open unanswered cases are watched until they leave the status or watch_max_sla: the ones changed since startup,
+        # and the ones found by reconcile(), which is run at startup and then every reconciliation_interval;
+        # their Time_to_Respond__c is extrapolated from the time it was fetched, like IncrementalCaseIngestor does,
+        # and a case is inserted as soon as it enters a rule band;
+        # sql_connector_instance_elisa_db is the connector of the A rules, so both skip the rows the other has stored
+        self.listener = listener
+        self.sql_connector_instance_elisa_db = sql_connector_instance_elisa_db
+        self.teams_channels_inst = teams_channels_inst
+        self.routing_index = routing_index
+        self.watch_max_sla = watch_max_sla
+        self.reconciliation_interval = reconciliation_interval
+        self.watched_cases = {}
+        # case_id -> rule_start of the bands the case was inserted for
+        self.inserted = {}
+        self.logging_inst = logging.getLogger()
+
+    def reconcile(self, sf_connection, sla_bands: list) -> dict:
+        # one query for the A rules and for the watch: every case which can enter a rule band before the next
+        # reconciliation is watched, whether it has fired an event or not; returns the cases of every band like
+        # custom_logic.find_cases_with_potential_sla_by_bands
+        answer = {band.rule_start: [] for band in sla_bands}
+        if len(sla_bands) == 0:
+            return answer
+        reconciliation_max_sla = max(band.rule_start for band in sla_bands) + self.reconciliation_interval / 60
+        found_cases_list = custom_logic.find_cases_with_potential_sla(
+            sf_connection=sf_connection, max_allowed_sla=min(self.watch_max_sla, reconciliation_max_sla),
+            min_allowed_sla=min(band.rule_end for band in sla_bands))
+        fetched_at = time.monotonic()
+        for case_dict in found_cases_list:
+            self.watch(case_dict, fetched_at)
+            for rule_start in custom_logic.classify_case_sla_bands(case_dict['Time_to_Respond__c'], sla_bands):
+                answer[rule_start].append(case_dict)
+        self.logging_inst.debug('StreamingCaseIngestor: reconciliation, ' + str(len(found_cases_list)) + ' case(s) found, ' +
+                                str(len(self.watched_cases)) + ' watched case(s)')
+        return answer
+
+    def watch(self, case_dict: dict, fetched_at: float):
+        if 'target_notification_channel' not in case_dict:
+            case_dict['target_notification_channel'] = custom_logic.find_target_teams_channel_for_case_sla(
+                case_dict['OwnerId'], case_dict['Previous_Owner__c'], case_dict['Product__c'], self.teams_channels_inst,
+                routing_index=self.routing_index)
+        self.watched_cases[case_dict['Id']] = (case_dict, fetched_at)
+
+    def process(self, sf_connection, sla_bands: list) -> int:
+        # returns the number of inserted cases
+        changed_case_ids = self.listener.take_changed_case_ids()
+        if len(changed_case_ids) > 0:
+            self.update_watched_cases(sf_connection, changed_case_ids)
+        now = time.monotonic()
+        new_case_rows = []
+        for case_id, (case_dict, fetched_at) in list(self.watched_cases.items()):
+            estimated_sla = case_dict['Time_to_Respond__c'] - (now - fetched_at) / 60
+            if estimated_sla <= 0:
+                self.forget(case_id)
+                continue
+            for rule_start in custom_logic.classify_case_sla_bands(estimated_sla, sla_bands):
+                if rule_start not in self.inserted.get(case_id, ()):
+                    new_case_rows.append((case_dict, rule_start))
+        if len(new_case_rows) == 0:
+            return 0
+        result = self.sql_connector_instance_elisa_db.insert_into_dbo_cases_batch(
+            case_rows=[(case_dict, str(rule_start)) for case_dict, rule_start in new_case_rows])
+        if result is None:
+            return 0
+        for case_dict, rule_start in new_case_rows:
+            self.inserted.setdefault(case_dict['Id'], set()).add(rule_start)
+        return result[0]
+
+    def update_watched_cases(self, sf_connection, case_ids: list):
+        found_cases = custom_logic.find_cases_by_ids(sf_connection=sf_connection, case_ids=case_ids)
+        fetched_at = time.monotonic()
+        found_case_ids = set()
+        for case_dict in found_cases:
+            found_case_ids.add(case_dict['Id'])
+            time_to_respond = case_dict['Time_to_Respond__c']
+            if case_dict['Status'] in ('New', 'Open') and case_dict['FTR_Case_Owner__c'] is None and \
+                    time_to_respond is not None and 0 < time_to_respond <= self.watch_max_sla:
+                self.watch(case_dict, fetched_at)
+            else:
+                self.forget(case_dict['Id'])
+        for case_id in case_ids:
+            if case_id not in found_case_ids:
+                self.forget(case_id)
+        self.logging_inst.debug('StreamingCaseIngestor: ' + str(len(case_ids)) + ' changed case(s), ' +
+                                str(len(self.watched_cases)) + ' watched case(s)')
+
+    def forget(self, case_id: str):
+        self.watched_cases.pop(case_id, None)
+        self.inserted.pop(case_id, None)
@@ -0,0 +1,142 @@
+"""Records the routing decisions of the if/elif tree which preceded routing.py into routing_golden_corpus.json.
+
+The tree is taken from main.py of LEGACY_REVISION and run as it was, with the sends recorded instead of made:
+    python tests/make_routing_golden_corpus.py [revision]
+"""
+import json
+import os
+import re
+import subprocess
+import sys
+import textwrap
+from datetime import datetime, timedelta
+
+LEGACY_REVISION = '2136e16'  # the last revision with the routing tree in main.py
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'routing_golden_corpus.json')
+DEFAULT_CHANNEL = 'target_notification_channel'
+RULE_A2 = 31
+RULE_A3 = 10
+STYLES = ['APJ + EMEA', 'EMEA', 'EMEA + US', 'US', 'US + APJ', 'APJ', 'Weekend EMEA', 'Weekend US']
+# A1 twice, A2 on both edges, A3 on the edge and inside
+SLAS = [61, 32, 31, 11, 10, 0]
+# inside and on both edges of every case shift
+TIMES = ['00:00', '04:29', '04:30', '08:29', '08:30', '10:29', '10:30', '12:29', '12:30', '16:29', '16:30']
+STYLE_TIMES = ['00:00', '04:29', '04:30', '04:59', '05:00', '06:59', '07:00', '11:59', '12:00', '16:29', '16:30', '16:59',
+               '17:00', '22:59', '23:00', '23:59']
+
+
+def extract(source: str, first_line: str, last_line: str) -> str:
+    lines = source.splitlines()
+    start = next(number for number, line in enumerate(lines) if line.strip().startswith(first_line))
+    end = next(number for number in range(start, len(lines)) if lines[number].strip().startswith(last_line))
+    return textwrap.dedent('\n'.join(lines[start:end + 1]))
+
+
+def compile_block(name: str, arguments: str, block: str):
+    # the block runs inside a loop, as it did in main_execution, so its continue statements stay valid
+    namespace = {}
+    exec('def ' + name + '(' + arguments + '):\n    for _ in (0,):\n' + textwrap.indent(block, '        ') +
+         '\n    return locals()', namespace)
+    return namespace[name]
+
+
+class Recorder(object):
+    def __init__(self):
+        self.channels = []
+
+    def __getattr__(self, name):
+        # MainLogger: critial is a typo of the tree, it raises as it did
+        if name == 'critial':
+            raise AttributeError(name)
+        return lambda *args, **kwargs: None
+
+
+class WebHooks(dict):
+    def __missing__(self, key):
+        return key
+
+
+class TeamsChannels(object):
+    webhooks_dict = WebHooks()
+
+
+class Threat(object):
+    def __init__(self, current_sla):
+        self.current_SLA = current_sla
+        self.info_tuple = (None, 'row id')
+        self.target_notification_channel = DEFAULT_CHANNEL
+
+
+def fixed_datetime(now: datetime):
+    class FixedDatetime(datetime):
+        @classmethod
+        def utcnow(cls):
+            return now
+    return FixedDatetime
+
+
+def main():
+    revision = sys.argv[1] if len(sys.argv) > 1 else LEGACY_REVISION
+    source = subprocess.check_output(['git', 'show', revision + ':main.py'],
+                                     cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).decode('utf-8')
+    route = compile_block('route', 'Threat, co, PCOQ, c_rule_logic_style, rule_a2, rule_a3, '
+                                   'teams_channels_inst_func, sql_connector_instance_func, MainLogger, datetime, '
+                                   'channel_notification_sequence',
+                          extract(source, 'if Threat.current_SLA > rule_a2 and Threat.info_tuple[1]:', 'continue'))
+    get_style = compile_block('get_style', 'PROCEED_WITH_SLA_RULES, MainLogger, datetime',
+                              extract(source, 'current_day_of_week = datetime.utcnow()', 'exit(1)'))
+    queues = sorted(set(re.findall(r"'(Tier[^']*)'", source))) + ['Tier Special']
+    owners = [[co, pcoq] for co in queues for pcoq in [None] + queues]
+
+    channels = []
+    decisions = []
+    unique_decisions = {}
+    for time_of_day in TIMES:
+        now = datetime.strptime('2026-10-19 ' + time_of_day, '%Y-%m-%d %H:%M')
+        for style in STYLES:
+            for sla in SLAS:
+                row = []
+                for co, pcoq in owners:
+                    recorder = Recorder()
+                    route(Threat(sla), co, pcoq, style, RULE_A2, RULE_A3, TeamsChannels(), None, recorder,
+                          fixed_datetime(now), lambda web_hook_url, sql_connector, threat: recorder.channels.append(web_hook_url))
+                    for channel in recorder.channels:
+                        if channel not in channels:
+                            channels.append(channel)
+                    row.append([channels.index(channel) for channel in recorder.channels])
+                key = json.dumps(row)
+                unique_decisions.setdefault(key, len(unique_decisions))
+                decisions.append([time_of_day, style, sla, unique_decisions[key]])
+
+    styles = []
+    day = datetime(2026, 1, 1)
+    while day.year == 2026:
+        # every weekend, one weekday of every week and the days around the daylight saving switches of the tree
+        if day.weekday() in (2, 5, 6) or (day.month, day.day) in ((3, 10), (3, 11), (11, 3), (11, 4)):
+            for time_of_day in STYLE_TIMES:
+                now = datetime.strptime(day.strftime('%Y-%m-%d ') + time_of_day, '%Y-%m-%d %H:%M')
+                styles.append([now.strftime('%Y-%m-%dT%H:%M'),
+                               get_style(True, Recorder(), fixed_datetime(now))['c_rule_logic_style']])
+        day += timedelta(days=1)
+
+    corpus = {'revision': revision,
+              'rule_a2': RULE_A2,
+              'rule_a3': RULE_A3,
+              'default_channel': DEFAULT_CHANNEL,
+              'date': '2026-10-19',
+              'owners': owners,
+              'channels': channels,
+              # [time of day, rule logic style, current SLA, index of the notified channels of every owner in channel_rows]
+              'decisions': decisions,
+              'channel_rows': [json.loads(key) for key in unique_decisions],
+              # [UTC time, rule logic style]
+              'styles': styles}
+    with open(CORPUS_PATH, 'w') as corpus_file:
+        json.dump(corpus, corpus_file, separators=(',', ':'))
+        corpus_file.write('\n')
+    print('Recorded ' + str(len(decisions) * len(owners)) + ' routing decisions and ' + str(len(styles)) +
+          ' rule logic styles into ' + CORPUS_PATH)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+import json
+import os
+import unittest
+from datetime import datetime
+
+import routing
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'routing_golden_corpus.json')
+
+
+class WebHooks(dict):
+    # the corpus stores channel names, every name is its own webhook
+    def __missing__(self, key):
+        return key
+
+
+class GoldenCorpusTest(unittest.TestCase):
+    # routing_golden_corpus.json is recorded from the if/elif tree by make_routing_golden_corpus.py
+    @classmethod
+    def setUpClass(cls):
+        with open(CORPUS_PATH) as corpus_file:
+            cls.corpus = json.load(corpus_file)
+
+    def test_case_router_matches_legacy_tree(self):
+        corpus = self.corpus
+        checked = 0
+        for time_of_day, style, sla, row_index in corpus['decisions']:
+            utc_current_time = datetime.strptime(corpus['date'] + ' ' + time_of_day, '%Y-%m-%d %H:%M')
+            case_router = routing.CaseRouter(WebHooks(), style, utc_current_time,
+                                             rule_a2=corpus['rule_a2'], rule_a3=corpus['rule_a3'])
+            rule_band = case_router.get_rule_band(sla, 'row id')
+            for (co, pcoq), expected in zip(corpus['owners'], corpus['channel_rows'][row_index]):
+                channels = [case_router.get_webhook(channel_name, corpus['default_channel'])
+                            for channel_name in case_router.route(rule_band, co, pcoq)]
+                self.assertEqual([corpus['channels'][channel] for channel in expected], channels,
+                                 (time_of_day, style, sla, co, pcoq))
+                checked += 1
+        self.assertEqual(len(corpus['decisions']) * len(corpus['owners']), checked)
+
+    def test_rule_logic_style_matches_legacy_tree(self):
+        for utc_current_time, style in self.corpus['styles']:
+            self.assertEqual(style, routing.get_rule_logic_style(datetime.strptime(utc_current_time, '%Y-%m-%dT%H:%M')),
+                             utc_current_time)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import random
+import unittest
+
+import scheduler
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.now += seconds
+
+
+class SchedulerTest(unittest.TestCase):
+    # the jobs of main: ingestion every 60s with up to 5s of jitter, dispatch every 60s after the ingestion has started
+    interval = 60
+    ingestion_jitter = 5
+    dispatch_first_run_delay = 15
+
+    def make_scheduler(self, ingestion_duration: float, cycles: int):
+        clock = FakeClock()
+        job_scheduler = scheduler.Scheduler(clock=clock, sleep=clock.sleep)
+        runs = []
+
+        def job(name: str, duration: float):
+            def run():
+                runs.append((name, clock.now))
+                clock.now += duration
+                if name == 'Dispatch' and len([run for run in runs if run[0] == 'Dispatch']) == cycles:
+                    job_scheduler.stop()
+            return run
+        job_scheduler.add_job('A rules', job('A rules', ingestion_duration), interval=self.interval,
+                              jitter=self.ingestion_jitter)
+        job_scheduler.add_job('Karma event rules', job('Karma event rules', ingestion_duration), interval=self.interval,
+                              jitter=self.ingestion_jitter)
+        job_scheduler.add_job('Dispatch', job('Dispatch', 1), interval=self.interval,
+                              first_run_delay=self.dispatch_first_run_delay)
+        return job_scheduler, runs
+
+    def assert_dispatch_follows_ingestion(self, runs: list, cycles: int):
+        # every dispatch runs after both ingestion jobs of its cycle and before the ones of the next cycle
+        names = [name for name, started_at in runs]
+        self.assertEqual(cycles, names.count('Dispatch'))
+        cycle = []
+        for name in names:
+            if name == 'Dispatch':
+                self.assertEqual(['A rules', 'Karma event rules'], sorted(cycle))
+                cycle = []
+            else:
+                cycle.append(name)
+
+    def test_dispatch_runs_after_ingestion_of_the_same_cycle(self):
+        random.seed(1)
+        job_scheduler, runs = self.make_scheduler(ingestion_duration=2, cycles=50)
+        job_scheduler.run_forever()
+        self.assert_dispatch_follows_ingestion(runs, 50)
+        dispatch_times = [started_at for name, started_at in runs if name == 'Dispatch']
+        self.assertEqual([self.dispatch_first_run_delay + cycle * self.interval for cycle in range(50)], dispatch_times)
+
+    def test_long_ingestion_delays_dispatch_of_its_cycle(self):
+        # ingestion outlasting the dispatch offset makes the dispatch late, it does not move it before the ingestion
+        random.seed(2)
+        job_scheduler, runs = self.make_scheduler(ingestion_duration=12, cycles=20)
+        job_scheduler.run_forever()
+        self.assert_dispatch_follows_ingestion(runs, 20)
+
+    def test_overlapping_runs_are_skipped(self):
+        clock = FakeClock()
+        job_scheduler = scheduler.Scheduler(clock=clock, sleep=clock.sleep)
+        job = job_scheduler.add_job('Slow', lambda: clock.sleep(130), interval=60)
+        job_scheduler.run_pending()
+        self.assertEqual(2, job.skipped_runs)
+        self.assertEqual(180, job.scheduled_at)
+
+
+if __name__ == '__main__':
+    unittest.main()
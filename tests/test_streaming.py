@@ -0,0 +1,78 @@
+import time
+import unittest
+
+try:
+    import streaming
+except ImportError:
+    # streaming imports custom_logic, which needs the packages of requirements.txt and configuration.py
+    streaming = None
+
+
+@unittest.skipIf(streaming is None, 'the dependencies of custom_logic are not installed')
+class LocalBayeuxTransportTest(unittest.TestCase):
+    channel = '/topic/ElisaCases'
+
+    def setUp(self):
+        self.transport = streaming.LocalBayeuxTransport(connect_timeout=0.05)
+        self.client = streaming.CometDClient(transport=self.transport, channel=self.channel)
+
+    @staticmethod
+    def get_case_ids(events: list) -> list:
+        answer = []
+        for data in events:
+            answer += streaming.get_case_ids_from_event(data)
+        return answer
+
+    def test_published_event_is_polled(self):
+        # the first poll subscribes from the new events, nothing was published yet
+        self.assertEqual([], self.client.poll())
+        self.assertIsNotNone(self.client.client_id)
+        replay_id = self.transport.publish_case('500A')
+        self.assertEqual(['500A'], self.get_case_ids(self.client.poll()))
+        self.assertEqual(replay_id, self.client.replay_id)
+        self.assertEqual([], self.client.poll())
+
+    def test_events_are_replayed_after_handshake(self):
+        self.client.poll()
+        self.transport.publish_case('500A')
+        self.assertEqual(['500A'], self.get_case_ids(self.client.poll()))
+        # the connection is lost, the events published meanwhile are replayed from the last one received
+        self.client.client_id = None
+        self.transport.publish_case('500B')
+        self.transport.publish_case('500C')
+        self.assertEqual(['500B', '500C'], self.get_case_ids(self.client.poll()))
+        self.assertEqual('local-2', self.client.client_id)
+
+    def test_new_client_starts_from_the_given_replay_id(self):
+        first_replay_id = self.transport.publish_case('500A')
+        self.transport.publish_case('500B')
+        client = streaming.CometDClient(transport=self.transport, channel=self.channel, replay_id=first_replay_id)
+        self.assertEqual(['500B'], self.get_case_ids(client.poll()))
+        client = streaming.CometDClient(transport=self.transport, channel=self.channel,
+                                        replay_id=streaming.REPLAY_ALL_EVENTS)
+        self.assertEqual(['500A', '500B'], self.get_case_ids(client.poll()))
+
+    def test_listener_collects_changed_case_ids(self):
+        listener = streaming.StreamingCaseListener(self.client)
+        listener.start()
+        try:
+            # the listener subscribes from the new events, so it has to be connected before the publish
+            deadline = time.monotonic() + 5
+            while self.client.client_id is None and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.transport.publish_case('500A')
+            self.transport.publish_case('500B')
+            self.transport.publish_case('500A')
+            changed_case_ids = set()
+            while changed_case_ids != {'500A', '500B'} and time.monotonic() < deadline:
+                changed_case_ids.update(listener.take_changed_case_ids())
+                time.sleep(0.01)
+            self.assertEqual({'500A', '500B'}, changed_case_ids)
+            self.assertEqual([], listener.take_changed_case_ids())
+        finally:
+            listener.stop(timeout=5)
+        self.assertFalse(listener.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()